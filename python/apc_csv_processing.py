@@ -5,10 +5,13 @@ import argparse
 import codecs
 from collections import OrderedDict
 import datetime
+import heapq
 import locale
 import logging
 import os
+from StringIO import StringIO
 import sys
+import threading
 
 import openapc_toolkit as oat
 
@@ -31,6 +34,10 @@ class CSVColumn(object):
                "\033[93m{ov}\033[0m by \033[93m{nv}\033[0m in this " +
                "column\n6) No, and never overwrite in this column\n>")
 
+    # Shared by all columns: When rows are enriched concurrently, conflicts
+    # have to be resolved one at a time so prompts never interleave.
+    _prompt_lock = threading.RLock()
+
     def __init__(self, column_type, requirement, index=None, column_name="", overwrite=OW_ASK):
         self.column_type = column_type
         self.requirement = requirement
@@ -39,8 +46,11 @@ class CSVColumn(object):
         self.overwrite = overwrite
         self.overwrite_whitelist = {}
         self.overwrite_blacklist = {}
+        # If set to an oat.ConflictLog, conflicts which would require asking
+        # the user are recorded there and the old value is kept for now.
+        self.conflict_log = None
 
-    def check_overwrite(self, old_value, new_value):
+    def check_overwrite(self, old_value, new_value, row_num=None):
         if old_value == new_value:
             return old_value
         # Priority: Empty or NA values will always be overwritten.
@@ -51,6 +61,10 @@ class CSVColumn(object):
         # Do not replace an existing old value with NA
         if new_value == "NA":
             return old_value
+        with CSVColumn._prompt_lock:
+            return self._resolve_conflict(old_value, new_value, row_num)
+
+    def _resolve_conflict(self, old_value, new_value, row_num):
         if self.overwrite == CSVColumn.OW_ALWAYS:
             return new_value
         if self.overwrite == CSVColumn.OW_NEVER:
@@ -60,6 +74,10 @@ class CSVColumn(object):
                 return old_value
         if old_value in self.overwrite_whitelist:
             return new_value
+        if self.conflict_log is not None:
+            self.conflict_log.record(row_num, self.column_type, old_value,
+                                     new_value)
+            return old_value
         msg = CSVColumn._OW_MSG.format(ov=old_value, name=self.column_name,
                                        nv=new_value)
         msg = msg.encode("utf-8")
@@ -163,7 +181,47 @@ ARG_HELP_STRINGS = {
              "number. May be used together with '-end' to select a specific " +
              "segment.",
     "end": "Do not process the whole file, but end at this line number. May " +
-           "be used together with '-start' to select a specific segment."
+           "be used together with '-start' to select a specific segment.",
+    "workers": "Number of lines to be enriched concurrently (default: 1). " +
+               "Metadata lookups for different lines will run in parallel, " +
+               "the order of lines in the output file is preserved.",
+    "timeout": "Timeout in seconds for requests to metadata APIs " +
+               "(default: 30).",
+    "cache_dir": "Directory for the persistent DOI metadata cache " +
+                 "(default: " + oat.DEFAULT_CACHE_DIR + "). Crossref and " +
+                 "Pubmed lookup results are stored there and reused in " +
+                 "later runs, as well as the index of an offline DOAJ dump.",
+    "no_cache": "Do not use the persistent DOI metadata cache.",
+    "cache_ttl": "Number of days after which cached DOI metadata expires " +
+                 "(default: 30).",
+    "batch_size": "Resolve DOIs in batches of this size instead of one " +
+                  "request per line. Batch lookups use the Crossref REST " +
+                  "API and combined Europe PMC queries, DOIs not found " +
+                  "there are looked up individually.",
+    "max_retries": "How often a failed request to a metadata API is " +
+                   "retried before the line is marked as failed " +
+                   "(default: 5).",
+    "retry_budget": "Maximum number of retries for the whole run. Once " +
+                    "exhausted, failed requests are not retried anymore " +
+                    "(default: no limit).",
+
+    "resume": "Continue an interrupted run. Every enriched line is " +
+              "recorded in a journal file (out.csv.journal) as soon as " +
+              "it is finished. With this option, lines already found in " +
+              "the journal are not processed again and out.csv is rebuilt " +
+              "from the journal and the newly enriched lines. The journal " +
+              "is only used if the input file has not changed since.",
+    "defer_conflicts": "Do not ask for a decision whenever imported data " +
+                       "conflicts with existing values. The existing value " +
+                       "is kept and the conflict is recorded in a side file " +
+                       "(out.csv.conflicts), so the enrichment can run " +
+                       "unattended. Use resolve_conflicts.py afterwards to " +
+                       "decide on all conflicts and update out.csv.",
+    "yes": "Run without asking any questions, f.e. when started by another " +
+           "program. The metadata aggregation starts right away, the " +
+           "process stops with an error wherever a decision would be " +
+           "needed. Requires --defer-conflicts or --overwrite, as there is " +
+           "no one to decide on conflicting values."
 }
 
 def main():
@@ -213,8 +271,32 @@ def main():
                         type=int, help=ARG_HELP_STRINGS["url"])
     parser.add_argument("-start", type=int, help=ARG_HELP_STRINGS["start"])
     parser.add_argument("-end", type=int, help=ARG_HELP_STRINGS["end"])
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help=ARG_HELP_STRINGS["workers"])
+    parser.add_argument("-t", "--timeout", type=float, default=30,
+                        help=ARG_HELP_STRINGS["timeout"])
+    parser.add_argument("--cache-dir", default=oat.DEFAULT_CACHE_DIR,
+                        help=ARG_HELP_STRINGS["cache_dir"])
+    parser.add_argument("--no-cache", action="store_true",
+                        help=ARG_HELP_STRINGS["no_cache"])
+    parser.add_argument("--cache-ttl", type=float, default=30,
+                        help=ARG_HELP_STRINGS["cache_ttl"])
+    parser.add_argument("--batch-size", type=int,
+                        help=ARG_HELP_STRINGS["batch_size"])
+    parser.add_argument("--max-retries", type=int, default=5,
+                        help=ARG_HELP_STRINGS["max_retries"])
+    parser.add_argument("--retry-budget", type=int,
+                        help=ARG_HELP_STRINGS["retry_budget"])
+    parser.add_argument("--resume", action="store_true",
+                        help=ARG_HELP_STRINGS["resume"])
+    parser.add_argument("--defer-conflicts", action="store_true",
+                        help=ARG_HELP_STRINGS["defer_conflicts"])
+    parser.add_argument("-y", "--yes", action="store_true",
+                        help=ARG_HELP_STRINGS["yes"])
 
     args = parser.parse_args()
+    if args.yes and not (args.defer_conflicts or args.overwrite):
+        parser.error("--yes requires --defer-conflicts or --overwrite")
     enc = None # CSV file encoding
 
     handler = logging.StreamHandler(sys.stderr)
@@ -225,6 +307,13 @@ def main():
     logging.root.addHandler(bufferedHandler)
     logging.root.setLevel(logging.INFO)
 
+    oat.http_client.timeout = args.timeout
+    oat.http_client.scheduler.max_retries = args.max_retries
+    oat.http_client.scheduler.retry_budget = args.retry_budget
+    if not args.no_cache:
+        oat.metadata_cache = oat.MetadataCache(args.cache_dir,
+                                               args.cache_ttl * 86400)
+
     if args.locale:
         norm = locale.normalize(args.locale)
         if norm != args.locale:
@@ -237,7 +326,7 @@ def main():
         except locale.Error as loce:
             msg = "Setting locale to {} failed: {}".format(norm, loce.message)
             oat.print_r(msg)
-            sys.exit()
+            sys.exit(1)
 
     if args.encoding:
         try:
@@ -253,7 +342,7 @@ def main():
                    "encodings) or omit this argument to enable automated " +
                    "guessing.")
             oat.print_r(msg)
-            sys.exit()
+            sys.exit(1)
 
     result = oat.analyze_csv_file(args.csv_file, line_limit=500)
     if result["success"]:
@@ -261,7 +350,7 @@ def main():
         print csv_analysis
     else:
         print result["error_msg"]
-        sys.exit()
+        sys.exit(1)
 
     if enc is None:
         enc = csv_analysis.enc
@@ -272,26 +361,31 @@ def main():
         print ("Error: No encoding given for CSV file and automated " +
                "detection failed. Please set the encoding manually via the " +
                "--enc argument")
-        sys.exit()
+        sys.exit(1)
 
 
     doaj_offline_analysis = None
     if args.offline_doaj:
         if os.path.isfile(args.offline_doaj):
-            doaj_offline_analysis = oat.DOAJOfflineAnalysis(args.offline_doaj)
+            cache_dir = None if args.no_cache else args.cache_dir
+            doaj_offline_analysis = oat.DOAJOfflineAnalysis(args.offline_doaj,
+                                                            cache_dir)
         else:
             oat.print_r("Error: " + args.offline_doaj + " does not seem "
                         "to be a file!")
 
-    csv_file = open(args.csv_file, "r")
-    reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
+    # Column count, header and column heuristics are derived from the sample
+    # taken by analyze_csv_file. The aggregation pass is the only full read
+    # of the file.
+    sample = StringIO(csv_analysis.sample)
+    reader = oat.UnicodeReader(sample, dialect=dialect, encoding=enc)
 
     first_row = reader.next()
     num_columns = len(first_row)
     print "\nCSV file has {} columns.".format(num_columns)
 
-    csv_file.seek(0)
-    reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
+    sample.seek(0)
+    reader = oat.UnicodeReader(sample, dialect=dialect, encoding=enc)
 
     if args.overwrite:
         ow_strategy = CSVColumn.OW_ALWAYS
@@ -320,28 +414,6 @@ def main():
         ("doaj", CSVColumn("doaj", CSVColumn.NONE, None, overwrite=ow_strategy))
     ])
 
-    # Do not quote the values in the 'period' and 'euro' columns
-    quotemask = [
-        True,
-        False,
-        False,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-    ]
-
     header = None
     if has_header:
         for row in reader:
@@ -466,7 +538,7 @@ def main():
                        "use the column name(s) mentioned in the message above)")
             print ("2) Use command line parameters when calling this script " +
                    "to identify the missing columns (use -h for help) ")
-            sys.exit()
+            sys.exit(1)
         else:
             print ("WARNING: Not all mandatory column types in the CSV file " +
                    "could be automatically identified - forced to continue.")
@@ -520,48 +592,112 @@ def main():
                "identified. Metadata aggregation is still possible, but " +
                "every entry in the CSV file will need a valid DOI.")
 
-    start = raw_input("\nStart metadata aggregation? (y/n):")
-    while start not in ["y", "n"]:
-        start = raw_input("Please type 'y' or 'n':")
-    if start == "n":
-        sys.exit()
+    if not args.yes:
+        start = raw_input("\nStart metadata aggregation? (y/n):")
+        while start not in ["y", "n"]:
+            start = raw_input("Please type 'y' or 'n':")
+        if start == "n":
+            sys.exit()
 
     print "\n    *** Starting metadata aggregation ***\n"
 
-    enriched_content = []
-
-    csv_file.seek(0)
+    csv_file = open(args.csv_file, "r")
     reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
-    header_processed = False
-    row_num = 0
 
-    for row in reader:
-        row_num += 1
-        if not row:
-            continue # skip empty lines
-        if not header_processed:
-            header_processed = True
-            enriched_content.append(column_map.keys())
-            if has_header:
-                # If the CSV file has a header, we are currently there - skip it
-                # to get to the first data row
+    journal = oat.CheckpointJournal("out.csv.journal", args.csv_file,
+                                    column_map.keys())
+    completed_rows = {}
+    if args.resume:
+        try:
+            completed_rows = journal.load()
+        except ValueError as ve:
+            oat.print_r("ERROR: " + str(ve) + " Run again without --resume " +
+                        "to start over.")
+            sys.exit(1)
+        msg = "Resuming: {} lines were already enriched in an earlier run."
+        oat.print_g(msg.format(len(completed_rows)))
+    journal.open(resume=args.resume)
+
+    conflict_log = None
+    if args.defer_conflicts:
+        conflict_log = oat.ConflictLog("out.csv.conflicts")
+        conflict_log.open(resume=args.resume)
+        for column in column_map.values():
+            column.conflict_log = conflict_log
+
+    def numbered_rows():
+        header_processed = False
+        row_num = 0
+        for row in reader:
+            row_num += 1
+            if not row:
+                continue # skip empty lines
+            if not header_processed:
+                header_processed = True
+                if has_header:
+                    # If the CSV file has a header, we are currently there - skip it
+                    # to get to the first data row
+                    continue
+            if args.start and args.start > row_num:
                 continue
-        if args.start and args.start > row_num:
-            continue
-        if args.end and args.end < row_num:
-            continue
-        print "---Processing line number " + str(row_num) + "---"
-        enriched_row = oat.process_row(row, row_num, column_map, num_columns,
-                                       args.no_crossref, args.no_pubmed,
-                                       args.no_doaj, doaj_offline_analysis,
-                                       args.bypass_cert_verification)
-        enriched_content.append(enriched_row)
+            if args.end and args.end < row_num:
+                continue
+            if row_num in completed_rows:
+                continue
+            yield row_num, row
+
+    rows = numbered_rows()
+    crossref_results = None
+    pubmed_results = None
+    doi_index = column_map["doi"].index
+    if args.batch_size and doi_index is not None:
+        if not args.no_crossref:
+            crossref_results = {}
+        if not args.no_pubmed:
+            pubmed_results = {}
+        rows = oat.prefetch_doi_metadata(rows, doi_index, args.batch_size,
+                                         crossref_results, pubmed_results)
+
+    enriched_rows = oat.process_rows(rows, column_map, num_columns,
+                                     args.workers,
+                                     no_crossref_lookup=args.no_crossref,
+                                     no_pubmed_lookup=args.no_pubmed,
+                                     no_doaj_lookup=args.no_doaj,
+                                     doaj_offline_analysis=doaj_offline_analysis,
+                                     bypass_cert_verification=args.bypass_cert_verification,
+                                     crossref_results=crossref_results,
+                                     pubmed_results=pubmed_results)
+    # Both sequences are ordered by line number, merging them restores the
+    # order of the input file.
+    all_rows = heapq.merge(sorted(completed_rows.items()), enriched_rows)
+
+    def enriched_content():
+        yield column_map.keys()
+        for line, (row_num, enriched_row) in enumerate(all_rows, 2):
+            if row_num not in completed_rows:
+                if conflict_log is not None:
+                    conflict_log.commit(row_num, line)
+                journal.append(row_num, enriched_row)
+            yield enriched_row
+
+    # Rows are written as soon as they are enriched, nothing is kept in memory
+    with open('out.csv', 'w') as out:
+        writer = oat.OpenAPCUnicodeWriter(out, oat.OPENAPC_QUOTEMASK, True, True, 1)
+        writer.write_rows(enriched_content())
 
     csv_file.close()
-
-    with open('out.csv', 'w') as out:
-        writer = oat.OpenAPCUnicodeWriter(out, quotemask, True, True)
-        writer.write_rows(enriched_content)
+    journal.close()
+    if conflict_log is not None:
+        conflict_log.close()
+        if conflict_log.count:
+            msg = ("{} conflicts between existing and imported values were " +
+                   "deferred, run resolve_conflicts.py to decide on them.")
+            oat.print_y(msg.format(conflict_log.count))
+
+    if not args.no_doaj:
+        memo = oat.doaj_lookup_memo
+        msg = "DOAJ lookups: {} ISSNs looked up, {} answered from earlier rows."
+        oat.print_b(msg.format(memo.misses, memo.hits))
 
     if not bufferedHandler.buffer:
         oat.print_g("Metadata enrichment successful, no errors occured")
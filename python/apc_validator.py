@@ -0,0 +1,628 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import argparse
+from collections import namedtuple, OrderedDict
+import cPickle
+import hashlib
+import json
+from multiprocessing import cpu_count, Pool
+import os
+import sys
+
+import openapc_toolkit as oat
+
+ARG_HELP_STRINGS = {
+    "csv_files": "OpenAPC data files to validate (default: data/apc_se.csv). " +
+                 "Duplicate DOIs and journal consistency are checked over " +
+                 "all files together.",
+    "output": "Write a report of all failures to this file in JSON format " +
+              "('-' for standard output)",
+    "workers": "Number of worker processes validating files in parallel " +
+               "(default: number of CPUs)",
+    "state_file": "Keep the validation state in this file, so later runs " +
+                  "only check new or changed rows and the groups they " +
+                  "belong to (default: a file derived from the first CSV " +
+                  "file in the cache directory)",
+    "full": "Check all rows and groups, without reading or updating the " +
+            "state file"
+}
+
+# A whitelist for denoting publisher identity (Possible consequence of business buy outs or fusions)
+# If one publisher name is stored in the left list of an entry and another in the right one,
+# they will not be treated as different by the name_consistency test.
+PUBLISHER_IDENTITY = [
+    (["Springer Nature"], ["Nature Publishing Group", "Springer Science + Business Media"]),
+    (["Springer Science + Business Media"], ["BioMed Central", "American Vacuum Society"]),
+    (["Wiley-Blackwell"], ["EMBO"]),
+    (["Pion Ltd"], ["SAGE Publications"]),
+    (["Wiley-Blackwell"], ["American Association of Physicists in Medicine (AAPM)"])
+]
+
+
+# A whitelist for denoting changes in journal ownership.
+JOURNAL_OWNER_CHANGED = {
+    "1744-8069": ["SAGE Publications", "Springer Science + Business Media"],
+    "1990-2573": ["European Optical Society", "Springer Nature"]
+}
+
+# A whiltelist for denoting changes in journal full open access policy. ISSNs
+# listed here will not be checked for equal "is_hybrid" status by the name_consistency
+# test. Note that we make not further attempts in determining the correct hybrid
+# status for any journal listed here (like trying to track a point of time were the
+# policy change occured), it is up to the contributing institutions to deliver
+# correct data in these cases.
+JOURNAL_HYBRID_STATUS_CHANGED = [
+    "2041-1723", # Nature Communications
+    "14749718", # Aging Cell
+    "1555-8932", # Genes & Nutrition
+    "1756-1833", # BMJ (fully OA status disputed, "added value" content not OA)
+    "1461-1457", # International Journal of Neuropsychopharmacology
+    "1552-5783", # Investigative Opthalmology & Visual Science, OA since 01/2016
+    "0001-4966", # The Journal of the Acoustical Society of America, archives hybrid and non-hybrid sub-journals
+    "0887-0446", # Psychology & Health, status unclear -> Possible mistake in Konstanz U data
+    "0066-4804" # Antimicrobial Agents and Chemotherapy -> delayed OA journal. Borderline case, needs further discussion
+]
+
+# Number of columns in the OpenAPC data schema
+ROW_LENGTH = 18
+
+# Number of rows validate_file passes to check_rows at once. Large enough to
+# batch the ISSN checks, small enough to keep few rows in memory.
+CHECK_BATCH_SIZE = 1000
+
+# The ISSN columns rows are grouped by for the consistency check, along with
+# the name of the ISSN kind used in messages
+ISSN_COLUMNS = OrderedDict([("issn", ""), ("issn_print", "Print "),
+                            ("issn_electronic", "Electronic ")])
+
+# The values of a row needed for the consistency check of its ISSN groups
+GroupEntry = namedtuple("GroupEntry", ["file_name", "line_number", "publisher",
+                                       "journal_full_title", "is_hybrid", "issn"])
+
+def has_value(field):
+    return len(field) > 0 and field != "NA"
+
+def in_whitelist(issn, first_publisher, second_publisher):
+    for entry in PUBLISHER_IDENTITY:
+        if first_publisher in entry[0] and second_publisher in entry[1]:
+            return True
+        if first_publisher in entry[1] and second_publisher in entry[0]:
+            return True
+    if issn in JOURNAL_OWNER_CHANGED:
+        return (first_publisher in JOURNAL_OWNER_CHANGED[issn] and
+                second_publisher in JOURNAL_OWNER_CHANGED[issn])
+    return False
+
+def format_locations(locations):
+    """
+    Summarise (file name, line number) tuples, like "data/apc_se.csv, lines 2, 5".
+    """
+    lines = OrderedDict()
+    for file_name, line_number in locations:
+        lines.setdefault(file_name, []).append(str(line_number))
+    return "; ".join([file_name + (", line " if len(numbers) == 1 else ", lines ") + ", ".join(numbers)
+                      for file_name, numbers in lines.iteritems()])
+
+# Row checks. Each one takes a row dict and the location prefix for
+# messages and returns the message of the first failure found or None.
+
+def check_optional_fields(row, line_str):
+    if row['doi'] == "NA":
+        if not has_value(row['publisher']):
+            return (line_str + 'if no DOI is given, the column ' +
+                    '"publisher" must not be empty')
+        if not has_value(row['journal_full_title']):
+            return (line_str + 'if no DOI is given, the column ' +
+                    '"journal_full_title" must not be empty')
+        if not has_value(row['issn']):
+            return (line_str + 'if no DOI is given, the column "issn" ' +
+                    'must not be empty')
+        if not has_value(row['url']):
+            return (line_str + 'if no DOI is given, the column "url" ' +
+                    'must not be empty')
+    return None
+
+def check_field_content(row, line_str):
+    if row['doaj'] not in ["TRUE", "FALSE"]:
+        return line_str + 'value in row "doaj" must either be TRUE or FALSE'
+    if row['indexed_in_crossref'] not in ["TRUE", "FALSE"]:
+        return line_str + 'value in row "indexed_in_crossref" must either be TRUE or FALSE'
+    if row['is_hybrid'] not in ["TRUE", "FALSE"]:
+        return line_str + 'value in row "is_hybrid" must either be TRUE or FALSE'
+    if not row['doi'] == "NA":
+        doi_norm = oat.get_normalised_DOI(row['doi'])
+        if doi_norm is None:
+            return line_str + 'value in row "doi" must either be NA or represent a valid DOI'
+        if doi_norm != row['doi']:
+            return (line_str + 'value in row "doi" contains a valid DOI, but the format ' +
+                    'is not correct. It should be the simple DOI name, not ' +
+                    'handbook notation (doi:...) or a HTTP URI (http://dx.doi.org/...)')
+    return None
+
+# The columns checked by check_issns, in order
+ISSN_CHECK_COLUMNS = ["issn", "issn_print", "issn_electronic", "issn_l"]
+
+def check_issns(row, line_str, issn_masks=None):
+    """
+    Args:
+        issn_masks: A (well-formed, valid) tuple of booleans for each of
+                    the ISSN_CHECK_COLUMNS of the row, as computed for
+                    whole columns by oat.check_ISSN_columns (see
+                    check_rows). Computed for this row alone if omitted.
+    """
+    if issn_masks is None:
+        columns = oat.check_ISSN_columns([[row[column]] for column in ISSN_CHECK_COLUMNS])
+        issn_masks = [(wellformed[0], valid[0]) for wellformed, valid in columns]
+    for column, (wellformed, valid) in zip(ISSN_CHECK_COLUMNS, issn_masks):
+        issn = row[column]
+        if issn != "NA":
+            if not wellformed:
+                return (line_str + 'value "' + issn + '" is not a ' +
+                        'well-formed ISSN')
+            if not valid:
+                return (line_str + 'value "' + issn + '" is no valid ' +
+                        'ISSN (check digit mismatch)')
+    return None
+
+def check_hybrid_status(row, line_str):
+    doaj = row["doaj"]
+    is_hybrid = row["is_hybrid"]
+    issn = row["issn"]
+    title = row["journal_full_title"]
+    if doaj == "TRUE" and is_hybrid == "TRUE" and issn not in JOURNAL_HYBRID_STATUS_CHANGED:
+        msg = 'Journal "{}" ({}) is listed in the DOAJ but is marked as hybrid (DOAJ only lists fully OA journals)'
+        return line_str + msg.format(title, issn)
+    return None
+
+# Rule names and functions of the row checks, in the order they are run
+ROW_CHECKS = [
+    ("field_content", check_field_content),
+    ("optional_fields", check_optional_fields),
+    ("issns", check_issns),
+    ("hybrid_status", check_hybrid_status)
+]
+
+# Group checks, run over all files once the rows have been aggregated
+
+def check_for_doi_duplicates(doi, locations):
+    """
+    Returns:
+        A failure message if a DOI occurs in more than one location, None
+        otherwise.
+    """
+    if len(locations) > 1:
+        return ('Duplicate: DOI "' + doi + '" was encountered ' + str(len(locations)) +
+                ' times (' + '; '.join(['{}, line {}'.format(*location) for location in locations]) + ')')
+    return None
+
+def check_name_consistency(issn_column, issn, entries):
+    """
+    Check that all rows sharing an ISSN agree on publisher, journal title and
+    hybrid status. Each column is compared once over its distinct values.
+    Like in a pairwise comparison of the rows, a differing publisher name is
+    only accepted if the pair is whitelisted for the "issn" of the row, a
+    differing hybrid status if that ISSN is listed in
+    JOURNAL_HYBRID_STATUS_CHANGED.
+
+    Args:
+        issn_column: The ISSN column the rows were grouped by.
+        issn: The shared ISSN.
+        entries: A list of GroupEntry tuples.
+
+    Returns:
+        A failure message listing all conflicting values or None.
+    """
+    msg = u'Entries share a common {}ISSN ({}), but the {} differs ({})'
+    failures = []
+    for column, name in [("publisher", "publisher name"), ("journal_full_title", "journal title"),
+                         ("is_hybrid", "hybrid status")]:
+        locations_by_value = OrderedDict()
+        for entry in entries:
+            locations_by_value.setdefault(getattr(entry, column), []).append(entry[:2])
+        if len(locations_by_value) < 2:
+            continue
+        if column == "publisher":
+            conflicting = set()
+            for publ, row_issn in set((entry.publisher, entry.issn) for entry in entries):
+                for other_publ in locations_by_value:
+                    if other_publ != publ and not in_whitelist(row_issn, publ, other_publ):
+                        conflicting.update([publ, other_publ])
+            conflicting = [publ for publ in locations_by_value if publ in conflicting]
+        elif column == "is_hybrid" and all(entry.issn in JOURNAL_HYBRID_STATUS_CHANGED
+                                           for entry in entries):
+            conflicting = []
+        else:
+            conflicting = locations_by_value.keys()
+        if conflicting:
+            value_strs = [u'"{}" ({})'.format(value, format_locations(locations_by_value[value]))
+                          for value in conflicting]
+            failures.append(msg.format(ISSN_COLUMNS[issn_column], issn, name, u" vs ".join(value_strs)))
+    if failures:
+        return u"\n".join(failures)
+    return None
+
+# What the validation of a single row yields: The row failures as (rule,
+# message) tuples, with messages lacking the location prefix, and the values
+# the group checks need. issns holds the values of the ISSN_COLUMNS (None if
+# empty), doi is None if the row has none.
+RowRecord = namedtuple("RowRecord", ["failures", "doi", "issns", "publisher",
+                                     "journal_full_title", "is_hybrid", "issn"])
+
+def check_row(header, values, issn_masks=None):
+    """
+    Run the row checks on a single row.
+
+    Args:
+        issn_masks: See check_issns.
+
+    Returns:
+        A RowRecord. It does not depend on the location of the row, so it
+        can be reused for every row with the same content.
+    """
+    row = dict(zip(header, values))
+    failures = []
+    if len(values) != ROW_LENGTH:
+        failures.append(("line_length", 'Row must consist of exactly 18 items'))
+        # The other row checks rely on a complete row
+        row = dict(zip(header, values + [u""] * (len(header) - len(values))))
+    else:
+        for rule, check in ROW_CHECKS:
+            if check is check_issns:
+                msg = check_issns(row, "", issn_masks)
+            else:
+                msg = check(row, "")
+            if msg is not None:
+                failures.append((rule, msg))
+    issns = tuple([row[column] if has_value(row[column]) else None for column in ISSN_COLUMNS])
+    return RowRecord(failures, row["doi"] if has_value(row["doi"]) else None, issns,
+                     row["publisher"], row["journal_full_title"], row["is_hybrid"], row["issn"])
+
+def check_rows(header, rows):
+    """
+    Run the row checks on a batch of rows. The ISSNs of all complete rows
+    are checked at once, so every distinct ISSN is only checked once.
+
+    Returns:
+        A list of RowRecords, see check_row.
+    """
+    index = dict((column, header.index(column)) for column in ISSN_CHECK_COLUMNS)
+    complete = [values for values in rows if len(values) == ROW_LENGTH]
+    columns = oat.check_ISSN_columns([[values[index[column]] for values in complete]
+                                      for column in ISSN_CHECK_COLUMNS])
+    # Transpose the column masks to a tuple of (well-formed, valid) per row
+    row_masks = iter(zip(*[zip(wellformed, valid) for wellformed, valid in columns]))
+    records = []
+    for values in rows:
+        issn_masks = next(row_masks) if len(values) == ROW_LENGTH else None
+        records.append(check_row(header, values, issn_masks))
+    return records
+
+def read_records(csv_file):
+    """
+    Split a CSV file into records without parsing them. A record ends with
+    the first line break outside a quoted cell, that is after a line which
+    leaves an even number of quote characters in the record.
+
+    Returns:
+        A generator of (line number, lines) tuples, with the number of the
+        last line of every record.
+    """
+    lines = []
+    quotes = 0
+    line_number = 0
+    for line_number, line in enumerate(csv_file, 1):
+        lines.append(line)
+        quotes += line.count('"')
+        if quotes % 2 == 0:
+            yield (line_number, lines)
+            lines = []
+            quotes = 0
+    if lines:
+        yield (line_number, lines)
+
+def validate_file(file_name, known_hashes=frozenset()):
+    """
+    Read an OpenAPC data file in a single pass and run the row checks on
+    every row whose content has not been checked before, in batches of
+    CHECK_BATCH_SIZE rows while reading. Rows are identified by a hash of
+    their raw content, so known rows are not even parsed.
+
+    Args:
+        file_name: The file to validate.
+        known_hashes: Hashes of rows which need not be checked (see
+                      ValidationState).
+
+    Returns:
+        A dict with the file name ("file"), a (row hash, line number) tuple
+        for every row ("rows") and the RowRecords of all rows not in
+        known_hashes by row hash ("records").
+    """
+    result = {"file": file_name, "rows": [], "records": {}}
+    # The values of the rows to check in the next batch by row hash
+    unchecked = OrderedDict()
+
+    def check_unchecked():
+        records = check_rows(header, unchecked.values())
+        result["records"].update(zip(unchecked.keys(), records))
+        unchecked.clear()
+
+    with open(file_name, "r") as csv_file:
+        header = None
+        for line_number, lines in read_records(csv_file):
+            record = "".join(lines)
+            if not record.strip("\r\n"):
+                continue
+            if header is None:
+                header = next(oat.UnicodeReader(lines))
+                # Rows are checked by column name, so the header is part
+                # of every row hash
+                header_hash = hashlib.sha1(record)
+                continue
+            row_hash = header_hash.copy()
+            row_hash.update(record)
+            row_hash = row_hash.digest()
+            result["rows"].append((row_hash, line_number))
+            if (row_hash not in known_hashes and row_hash not in unchecked and
+                    row_hash not in result["records"]):
+                unchecked[row_hash] = next(oat.UnicodeReader(lines))
+                if len(unchecked) >= CHECK_BATCH_SIZE:
+                    check_unchecked()
+    if unchecked:
+        check_unchecked()
+    return result
+
+def _validate_file_task(args):
+    return validate_file(*args)
+
+def group_keys(record):
+    """
+    Returns:
+        The keys of all groups a row belongs to, ("doi", DOI) for the
+        duplicate check and (ISSN column, ISSN) for the consistency check.
+    """
+    keys = []
+    if record.doi is not None:
+        keys.append(("doi", record.doi))
+    for column, issn in zip(ISSN_COLUMNS, record.issns):
+        if issn is not None:
+            keys.append((column, issn))
+    return keys
+
+# Version of the validation state. Increase it whenever a change to the
+# checks could change the outcome for an unchanged row or group.
+STATE_VERSION = 1
+
+def _rules_fingerprint():
+    # Edits to the whitelists invalidate a stored state as well
+    rules = (STATE_VERSION, PUBLISHER_IDENTITY, sorted(JOURNAL_OWNER_CHANGED.items()),
+             JOURNAL_HYBRID_STATUS_CHANGED)
+    return hashlib.sha1(repr(rules)).hexdigest()
+
+class ValidationState(object):
+    """
+    Everything the checks need to know about the rows of a validation run,
+    kept between runs to make validation incremental.
+
+    Rows are identified by a hash of their content. A row is only checked
+    if no row with the same content was present in the last run, and a
+    group is only checked if a row joined or left it (or if it failed the
+    last time, to report it with current line numbers). The state is not
+    tied to particular files: Identical rows are checked once, wherever they
+    occur.
+    """
+
+    def __init__(self):
+        self.fingerprint = _rules_fingerprint()
+        # RowRecords by row hash
+        self.records = {}
+        # Number of occurrences of every row hash
+        self.counts = {}
+        # Sets of row hashes by group key (see group_keys)
+        self.groups = {}
+        # Keys of the groups which failed their check
+        self.failed_groups = set()
+
+    @classmethod
+    def load(cls, state_file):
+        """
+        Returns:
+            The state stored in state_file or an empty state if the file is
+            missing, damaged or was written for different rules.
+        """
+        state = cls()
+        try:
+            with open(state_file, "rb") as handle:
+                data = cPickle.load(handle)
+        except Exception:
+            return state
+        if data.get("fingerprint") == state.fingerprint:
+            state.records = {row_hash: RowRecord._make(record)
+                             for row_hash, record in data["records"].iteritems()}
+            state.counts = data["counts"]
+            state.groups = data["groups"]
+            state.failed_groups = data["failed_groups"]
+        return state
+
+    def save(self, state_file):
+        # Records are stored as plain tuples, as the module might run as
+        # __main__
+        data = {"fingerprint": self.fingerprint, "counts": self.counts, "groups": self.groups,
+                "failed_groups": self.failed_groups,
+                "records": {row_hash: tuple(record) for row_hash, record in self.records.iteritems()}}
+        tmp_file = state_file + ".tmp"
+        try:
+            state_dir = os.path.dirname(state_file)
+            if state_dir and not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+            with open(tmp_file, "wb") as handle:
+                cPickle.dump(data, handle, cPickle.HIGHEST_PROTOCOL)
+            try:
+                os.rename(tmp_file, state_file)
+            except OSError:
+                # Windows does not replace existing files on rename
+                os.remove(state_file)
+                os.rename(tmp_file, state_file)
+        except (IOError, OSError) as e:
+            oat.print_y("Could not save the validation state to " + state_file + ": " + str(e))
+
+    def update(self, results):
+        """
+        Bring the state in line with the rows found by validate_file.
+
+        Returns:
+            The keys of all groups a row joined or left.
+        """
+        counts = {}
+        for result in results:
+            self.records.update(result["records"])
+            for row_hash, _ in result["rows"]:
+                counts[row_hash] = counts.get(row_hash, 0) + 1
+        changed = [row_hash for row_hash, count in counts.iteritems()
+                   if self.counts.get(row_hash) != count]
+        removed = [row_hash for row_hash in self.counts if row_hash not in counts]
+        touched = set()
+        for row_hash in changed + removed:
+            for key in group_keys(self.records[row_hash]):
+                touched.add(key)
+                members = self.groups.setdefault(key, set())
+                if row_hash in counts:
+                    members.add(row_hash)
+                else:
+                    members.discard(row_hash)
+                    if not members:
+                        del self.groups[key]
+        for row_hash in removed:
+            del self.records[row_hash]
+        self.counts = counts
+        return touched
+
+def validate_files(file_names, workers=1, state_file=None):
+    """
+    Validate OpenAPC data files. The row checks run on every file in a
+    separate worker process (if workers > 1), duplicate DOIs and journal
+    consistency are checked over all files together afterwards.
+
+    Args:
+        file_names: The files to validate.
+        workers: The number of worker processes.
+        state_file: If given, the ValidationState of the last run is read
+                    from this file and only new or changed rows and the
+                    groups they belong to are checked again. The state of
+                    this run is stored in it afterwards.
+
+    Returns:
+        A report dict, ready to be serialised to JSON: "files" lists file
+        names and numbers of rows, "failures" all failures in file and line
+        order, followed by the duplicate and consistency failures. Each
+        failure is a dict with the name of the rule and a message, row
+        failures have a file name and line number, group failures the
+        shared DOI or ISSN ("key") and the locations of all rows involved.
+        "checked" holds the numbers of rows and groups which were actually
+        checked.
+    """
+    state = ValidationState.load(state_file) if state_file else ValidationState()
+    if workers > 1 and len(file_names) > 1:
+        known_hashes = frozenset(state.records)
+        pool = Pool(min(workers, len(file_names)))
+        try:
+            tasks = [(file_name, known_hashes) for file_name in file_names]
+            results = pool.map_async(_validate_file_task, tasks, 1).get(oat.POOL_GET_TIMEOUT)
+            pool.close()
+        finally:
+            pool.terminate()
+    else:
+        results = [validate_file(file_name, state.records) for file_name in file_names]
+    touched = state.update(results)
+
+    report = {"files": [], "failures": []}
+    # Locations of all rows by row hash, as (file index, line number) tuples
+    # to keep the order of the files
+    locations = {}
+    for index, result in enumerate(results):
+        file_name = result["file"]
+        report["files"].append({"file": file_name, "rows": len(result["rows"])})
+        for row_hash, line_number in result["rows"]:
+            locations.setdefault(row_hash, []).append((index, line_number))
+            for rule, msg in state.records[row_hash].failures:
+                line_str = '{}, line {}: '.format(file_name, line_number)
+                report["failures"].append({"rule": rule, "file": file_name,
+                                           "line": line_number, "message": line_str + msg})
+
+    check_keys = [key for key in touched | state.failed_groups if key in state.groups]
+    state.failed_groups = set()
+    doi_failures = []
+    consistency_failures = []
+    for key in check_keys:
+        kind, value = key
+        rows = sorted([(location, row_hash) for row_hash in state.groups[key]
+                       for location in locations[row_hash]])
+        # A single row is always consistent
+        if len(rows) < 2:
+            continue
+        group_locations = [(results[index]["file"], line_number)
+                           for (index, line_number), _ in rows]
+        if kind == "doi":
+            state.failed_groups.add(key)
+            doi_failures.append({"rule": "doi_duplicates", "key": value, "locations": group_locations,
+                                 "message": check_for_doi_duplicates(value, group_locations)})
+            continue
+        entries = []
+        for (file_name, line_number), (_, row_hash) in zip(group_locations, rows):
+            record = state.records[row_hash]
+            entries.append(GroupEntry(file_name, line_number, record.publisher,
+                                      record.journal_full_title, record.is_hybrid, record.issn))
+        msg = check_name_consistency(kind, value, entries)
+        if msg is not None:
+            state.failed_groups.add(key)
+            consistency_failures.append({"rule": "name_consistency", "issn_column": kind,
+                                         "key": value, "message": msg, "locations": group_locations})
+    column_order = ISSN_COLUMNS.keys()
+    report["failures"] += sorted(doi_failures, key=lambda failure: (failure["locations"], failure["key"]))
+    report["failures"] += sorted(consistency_failures, key=lambda failure: (
+        column_order.index(failure["issn_column"]), failure["key"]))
+    report["checked"] = {"rows": sum([len(result["records"]) for result in results]),
+                         "groups": len(check_keys)}
+    if state_file:
+        state.save(state_file)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_files", nargs="*", default=["data/apc_se.csv"],
+                        help=ARG_HELP_STRINGS["csv_files"])
+    parser.add_argument("-o", "--output", help=ARG_HELP_STRINGS["output"])
+    parser.add_argument("-w", "--workers", type=int, default=cpu_count(),
+                        help=ARG_HELP_STRINGS["workers"])
+    parser.add_argument("-s", "--state-file", help=ARG_HELP_STRINGS["state_file"])
+    parser.add_argument("-f", "--full", action="store_true", help=ARG_HELP_STRINGS["full"])
+    args = parser.parse_args()
+
+    state_file = None
+    if not args.full:
+        state_file = args.state_file
+        if state_file is None:
+            state_file = oat._sidecar_path(args.csv_files[0], oat.DEFAULT_CACHE_DIR,
+                                           "validation")
+    report = validate_files(args.csv_files, args.workers, state_file)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print
+        sys.exit(1 if report["failures"] else 0)
+    for failure in report["failures"]:
+        oat.print_r(failure["message"])
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
+    num_rows = sum([file_report["rows"] for file_report in report["files"]])
+    msg = "{} rows in {} file(s) validated ({} rows and {} groups checked), {} failures."
+    msg = msg.format(num_rows, len(report["files"]), report["checked"]["rows"],
+                     report["checked"]["groups"], len(report["failures"]))
+    if report["failures"]:
+        oat.print_r(msg)
+        sys.exit(1)
+    oat.print_g(msg)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import argparse
+import codecs
+import csv
+from StringIO import StringIO
+import time
+
+import openapc_toolkit as oat
+
+ARG_HELP_STRINGS = {
+    "csv_file": "An OpenAPC-conforming CSV file to use as test data " +
+                "(default: data/apc_se.csv)",
+    "scale": "Number of times the data rows are repeated to build the test " +
+             "input (default: 50)",
+    "repeat": "Number of runs per benchmark, the fastest one is reported " +
+              "(default: 3)"
+}
+
+def scaled_content(csv_file, scale):
+    """
+    Build a test input by repeating the data rows of a CSV file.
+
+    Returns:
+        The header line followed by scale copies of the remaining lines, as
+        a single byte string.
+    """
+    with open(csv_file, "r") as handle:
+        header = handle.readline()
+        body = handle.read()
+    if not body.endswith("\n"):
+        body += "\n"
+    return header + body * scale
+
+def best_time(func, test_input, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func(test_input)
+        timings.append(time.time() - start)
+    return min(timings)
+
+def read_recoding(content):
+    """
+    The reading strategy used for all encodings before the UTF-8 fast path:
+    Every line is decoded and encoded again before parsing, cells are
+    decoded afterwards.
+    """
+    reader = csv.reader(oat.UTF8Recoder(StringIO(content), "utf-8"))
+    for row in reader:
+        [unicode(s, "utf-8") for s in row]
+
+def read_recoding_dict(content):
+    """
+    The same strategy as read_recoding, mapping rows to dicts.
+    """
+    reader = csv.DictReader(oat.UTF8Recoder(StringIO(content), "utf-8"))
+    for row in reader:
+        {k: unicode(v, "utf-8") for (k, v) in row.iteritems()}
+
+def read_unicode_reader(content):
+    for row in oat.UnicodeReader(StringIO(content), encoding="utf-8"):
+        pass
+
+def read_unicode_dict_reader(content):
+    for row in oat.UnicodeDictReader(StringIO(content), encoding="utf-8"):
+        pass
+
+def parsed_rows(content):
+    return list(oat.UnicodeReader(StringIO(content)))
+
+def write_per_cell(rows):
+    """
+    The writing strategy used before the quotation rules were compiled: The
+    quotemask and keywords are checked for every cell, every line is encoded
+    and written on its own.
+    """
+    encoder = codecs.getincrementalencoder("utf-8")()
+    out = StringIO()
+    quotemask = oat.OPENAPC_QUOTEMASK
+    for row_num, row in enumerate(rows):
+        row = list(row)
+        for index in range(len(row)):
+            if row[index] in [u"TRUE", u"FALSE", u"NA"]:
+                continue
+            if row_num == 0 or (index < len(quotemask) and quotemask[index]):
+                row[index] = u'"' + row[index] + u'"'
+        out.write(encoder.encode(u",".join(row) + u"\n"))
+
+def write_openapc_writer(rows):
+    writer = oat.OpenAPCUnicodeWriter(StringIO(), oat.OPENAPC_QUOTEMASK)
+    writer.write_rows(rows)
+
+def load_dict_rows(content):
+    list(oat.UnicodeDictReader(StringIO(content)))
+
+def load_table(content):
+    reader = oat.UnicodeReader(StringIO(content))
+    oat.OpenAPCTable.from_rows(next(reader), reader)
+
+# Benchmarks are tuples of name, function to be timed and a function to
+# prepare the test input from the CSV content (None to use it directly).
+BENCHMARKS = [
+    ("CSV reading, recoding every line", read_recoding, None),
+    ("CSV reading, UnicodeReader", read_unicode_reader, None),
+    ("CSV reading to dicts, recoding every line", read_recoding_dict, None),
+    ("CSV reading to dicts, UnicodeDictReader", read_unicode_dict_reader, None),
+    ("CSV writing, per-cell rules", write_per_cell, parsed_rows),
+    ("CSV writing, OpenAPCUnicodeWriter", write_openapc_writer, parsed_rows),
+    ("Loading, list of UnicodeDictReader rows", load_dict_rows, None),
+    ("Loading, OpenAPCTable", load_table, None)
+]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_file", nargs="?", default="data/apc_se.csv",
+                        help=ARG_HELP_STRINGS["csv_file"])
+    parser.add_argument("-s", "--scale", type=int, default=50,
+                        help=ARG_HELP_STRINGS["scale"])
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help=ARG_HELP_STRINGS["repeat"])
+    args = parser.parse_args()
+
+    content = scaled_content(args.csv_file, args.scale)
+    rows = content.count("\n")
+    msg = "Test input: {} repeated {} times ({} lines, {:.1f} MB)"
+    oat.print_b(msg.format(args.csv_file, args.scale, rows,
+                           len(content) / 1024.0 / 1024.0))
+    prepared = {}
+    for name, func, prepare in BENCHMARKS:
+        test_input = content
+        if prepare is not None:
+            if prepare not in prepared:
+                prepared[prepare] = prepare(content)
+            test_input = prepared[prepare]
+        seconds = best_time(func, test_input, args.repeat)
+        print "{:<45}{:>8.3f}s {:>10.0f} lines/s".format(name, seconds,
+                                                        rows / seconds)
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,17 @@ import urllib2
 import xml.etree.ElementTree as ET
 
 def get_prefix(doi):
-    url = 'http://data.crossref.org/' + doi
+    if oat.metadata_cache is not None:
+        cached_result = oat.metadata_cache.get("crossref", doi)
+        if cached_result is not None:
+            if not cached_result["success"]:
+                return cached_result["error_msg"]
+            if cached_result["data"]["prefix"] is not None:
+                return cached_result["data"]["prefix"]
+    url = oat.CROSSREF_URL + doi
     headers = {"Accept": "application/vnd.crossref.unixsd+xml"}
-    req = urllib2.Request(url, None, headers)
     try:
-        response = urllib2.urlopen(req)
+        response = oat.http_client.request(url, headers)
         content_string = response.read()
         root = ET.fromstring(content_string)
         result = root.findall(".//cr_qr:crm-item[@name='prefix-name']", {"cr_qr": "http://www.crossref.org/qrschema/3.0"})
@@ -27,8 +33,13 @@ def get_prefix(doi):
 
 parser = argparse.ArgumentParser()
 parser.add_argument("doi_or_file", help="An OpenAPC-compatible CSV file or a single DOI to look up in crossref.")
+parser.add_argument("--cache-dir", default=oat.DEFAULT_CACHE_DIR, help="Directory of the persistent DOI metadata cache.")
+parser.add_argument("--no-cache", action="store_true", help="Do not use the persistent DOI metadata cache.")
 args = parser.parse_args()
 
+if not args.no_cache:
+    oat.metadata_cache = oat.MetadataCache(args.cache_dir)
+
 arg = args.doi_or_file
 if os.path.isfile(arg):
     csv_file = open(arg, "r")
@@ -3,7 +3,9 @@
 
 import argparse
 import codecs
+from itertools import islice
 import re
+import sys
 
 import openapc_toolkit as oat
 
@@ -11,7 +13,11 @@ ARG_HELP_STRINGS = {
     "apc_file": "The apc csv file to be enriched with linking issns. Must " +
                 "conform to the OpenAPC data schema 3.0.",
     "issn_l_file": "The issn_l mapping file which can be downloaded at " +
-                    "issn.org. This script needs the 'ISSN-to-ISSN-L variant.",
+                    "issn.org. This script needs the 'ISSN-to-ISSN-L " +
+                    "variant. Alternatively, an index file created with " +
+                    "the build-index command (much faster).",
+    "index_file": "The index file to be created from the issn_l mapping " +
+                  "file",
     "encoding": "The encoding of the apc file. Setting this argument will " +
                 "disable automatic guessing of encoding.",
     "quotemask": "A quotemask to apply to the result file after the action " +
@@ -27,13 +33,56 @@ ARG_HELP_STRINGS = {
                            "will take precedence."
 }
 
+# Number of lines whose ISSNs are checked together
+BATCH_SIZE = 10000
+
 def reformat_issn(issn):
     if "-" not in issn:
         return issn[:4] + "-"  + issn[4:]
     return issn
 
+def load_issn_l_dict(issn_l_file):
+    """
+    Read an ISSN-to-ISSN-L mapping file into a dict.
+    """
+    itself = other = 0
+    issn_l_re = re.compile("^(?P<issn>\d{4}-\d{3}[\dxX])\t(?P<issn_l>\d{4}-\d{3}[\dxX])$")
+    issn_l_dict = {}
+    with open(issn_l_file, "r") as handle:
+        for i, line in enumerate(handle):
+            if i % 100000 == 0:
+                print str(i) + " lines processed."
+            match = issn_l_re.match(line)
+            if match:
+                match_dict = match.groupdict()
+                issn_l_dict[match_dict['issn']] = match_dict['issn_l']
+                if match_dict['issn'] == match_dict['issn_l']:
+                    itself += 1
+                else:
+                    other += 1
+    print str(itself) + " ISSNs pointing to itself as ISSN-L, " + str(other) + " to another value."
+    return issn_l_dict
+
+def build_index():
+    parser = argparse.ArgumentParser(prog=sys.argv[0] + " build-index")
+    parser.add_argument("issn_l_file", help=ARG_HELP_STRINGS["issn_l_file"])
+    parser.add_argument("index_file", help=ARG_HELP_STRINGS["index_file"])
+    args = parser.parse_args(sys.argv[2:])
+
+    oat.print_g("Building index...")
+    counts = oat.ISSNLIndex.build(args.issn_l_file, args.index_file)
+    print (str(counts["itself"]) + " ISSNs pointing to itself as ISSN-L, " +
+           str(counts["other"]) + " to another value.")
+    oat.print_g("Index written to " + args.index_file)
+
 def main():
-    parser = argparse.ArgumentParser()
+    if sys.argv[1:2] == ["build-index"]:
+        build_index()
+        return
+    parser = argparse.ArgumentParser(usage="%(prog)s [-h] [-e ENCODING] " +
+                                     "[-q QUOTEMASK] [-o] apc_file " +
+                                     "issn_l_file\n       %(prog)s " +
+                                     "build-index issn_l_file index_file")
     parser.add_argument("apc_file", help=ARG_HELP_STRINGS["apc_file"])
     parser.add_argument("issn_l_file", help=ARG_HELP_STRINGS["issn_l_file"])
     parser.add_argument("-e", "--encoding", help=ARG_HELP_STRINGS["encoding"])
@@ -95,59 +144,56 @@ def main():
     reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
     
     
-    oat.print_g("Preparing mapping table...")
-    itself = other = 0
-    issn_l_re = re.compile("^(?P<issn>\d{4}-\d{3}[\dxX])\t(?P<issn_l>\d{4}-\d{3}[\dxX])$")
-    issn_l_file = open(args.issn_l_file, "r")
-    issn_l_dict = {}
-    for i, line in enumerate(issn_l_file):
-        if i % 100000 == 0:
-            print str(i) + " lines processed."
-        match = issn_l_re.match(line)
-        if match:
-            match_dict = match.groupdict()
-            issn_l_dict[match_dict['issn']] = match_dict['issn_l']
-            if match_dict['issn'] == match_dict['issn_l']:
-                itself += 1
-            else:
-                other += 1
-    print str(itself) + " ISSNs pointing to itself as ISSN-L, " + str(other) + " to another value."
+    if oat.ISSNLIndex.is_index_file(args.issn_l_file):
+        issn_l_map = oat.ISSNLIndex(args.issn_l_file)
+    else:
+        oat.print_y("Hint: Run '" + sys.argv[0] + " build-index' once to " +
+                    "avoid reading the whole mapping file on every run.")
+        oat.print_g("Preparing mapping table...")
+        issn_l_map = load_issn_l_dict(args.issn_l_file)
     oat.print_g("Starting enrichment...")
     
-    issn_matches = issn_p_matches = issn_e_matches = unmatched = different = 0
-    enriched_lines = []
-    for line in reader:
-        if len(line) == 0:
-            enriched_lines.append(line)
-            continue
-        issn = reformat_issn(line[7])
-        issn_p = reformat_issn(line[8])
-        issn_e = reformat_issn(line[9])
-        target = None
-        if issn in issn_l_dict:
-            target = issn_l_dict[issn]
-            line[10] = target
-            issn_matches += 1
-        elif issn_p in issn_l_dict:
-            target = issn_l_dict[issn_p]
-            line[10] = target
-            issn_p_matches += 1
-        elif issn_e in issn_l_dict:
-            target = issn_l_dict[issn_e]
-            line[10] = target
-            issn_e_matches += 1
-        else:
-            unmatched += 1
-        if target is not None and target not in [issn, issn_p, issn_e]:
-            different += 1
-        enriched_lines.append(line)
-    
-    print "{} issn_l values mapped by issn, {} by issn_p, {} by issn_e. {} could not be assigned.\n In {} cases the ISSN-L was different from all existing ISSN values".format(issn_matches, issn_p_matches, issn_e_matches, unmatched, different)
+    counts = {"issn": 0, "issn_p": 0, "issn_e": 0, "unmatched": 0, "different": 0}
+
+    def enriched_lines():
+        while True:
+            batch = list(islice(reader, BATCH_SIZE))
+            if not batch:
+                break
+            lines = [line for line in batch if len(line) > 0]
+            issn_columns = [[reformat_issn(line[index]) for line in lines] for index in [7, 8, 9]]
+            # Only valid ISSNs can occur in the mapping, so lookups are
+            # skipped for all others
+            valid_masks = [valid for _, valid in oat.check_ISSN_columns(issn_columns)]
+            rows = iter(zip(zip(*issn_columns), zip(*valid_masks)))
+            for line in batch:
+                if len(line) == 0:
+                    yield line
+                    continue
+                (issn, issn_p, issn_e), valid = next(rows)
+                target = None
+                for key, value, is_valid in zip(["issn", "issn_p", "issn_e"], [issn, issn_p, issn_e], valid):
+                    if is_valid:
+                        target = issn_l_map.get(value)
+                        if target is not None:
+                            line[10] = target
+                            counts[key] += 1
+                            break
+                else:
+                    counts["unmatched"] += 1
+                if target is not None and target not in [issn, issn_p, issn_e]:
+                    counts["different"] += 1
+                yield line
 
     with open('out.csv', 'w') as out:
         writer = oat.OpenAPCUnicodeWriter(out, mask, quote_rules, False)
-        writer.write_rows(enriched_lines)
-            
+        writer.write_rows(enriched_lines())
+    csv_file.close()
+    if isinstance(issn_l_map, oat.ISSNLIndex):
+        issn_l_map.close()
+
+    print "{} issn_l values mapped by issn, {} by issn_p, {} by issn_e. {} could not be assigned.\n In {} cases the ISSN-L was different from all existing ISSN values".format(counts["issn"], counts["issn_p"], counts["issn_e"], counts["unmatched"], counts["different"])
+
 
 if __name__ == '__main__':
     main()
@@ -3,28 +3,102 @@
 
 import csv
 import codecs
-from collections import OrderedDict
+import base64
+import cPickle
+import errno
+from array import array
+from collections import deque, OrderedDict
+from email.utils import mktime_tz, parsedate_tz
+import hashlib
+import httplib
 import json
 import locale
 import logging
 from logging.handlers import MemoryHandler
+import mmap
+from multiprocessing.pool import ThreadPool
+import os
+import random
 import re
+import socket
+import sqlite3
 import ssl
+from StringIO import StringIO
+import struct
 import sys
+import threading
+import time
+import urllib
 import urllib2
+import urlparse
 import xml.etree.ElementTree as ET
+import zlib
 
 try:
     import chardet
+    import chardet.universaldetector
 except ImportError:
     chardet = None
     print ("WARNING: 3rd party module 'chardet' not found - character " +
            "encoding guessing will not work")
 
+try:
+    import numpy
+except ImportError:
+    # Only used to speed up check_ISSN_columns, which works without it
+    numpy = None
+
 # regex for detecing DOIs
 DOI_RE = re.compile("^(((https?://)?(dx.)?doi.org/)|(doi:))?(?P<doi>10\.[0-9]+(\.[0-9]+)*\/\S+)")
 ISSN_RE = re.compile("^(?P<first_part>\d{4})-?(?P<second_part>\d{3})(?P<check_digit>[\dxX])$")
 
+# Python 2 cannot interrupt a blocking AsyncResult.get() without timeout
+# (KeyboardInterrupt is only delivered after the result arrives), so we always
+# wait with a very long timeout instead.
+POOL_GET_TIMEOUT = 60 * 60 * 24 * 365
+
+CROSSREF_URL = "http://data.crossref.org/"
+CROSSREF_WORKS_URL = "https://api.crossref.org/works"
+CROSSREF_PREFIXES_URL = "https://api.crossref.org/prefixes/"
+EUROPE_PMC_SEARCH_URL = "http://www.ebi.ac.uk/europepmc/webservices/rest/search"
+DOAJ_JOURNAL_SEARCH_URL = "https://doaj.org/api/v1/search/journals/"
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".openapc_cache")
+
+# analyze_csv_file looks at this many bytes from the beginning of a file
+CSV_SAMPLE_SIZE = 64 * 1024
+# The encoding detector is fed in chunks of this size
+CSV_DETECTION_CHUNK_SIZE = 4096
+# Dialect and header detection only consider this many lines of the sample
+CSV_SNIFF_LINES = 100
+# If the sample is ASCII-only, the rest of the file is scanned for the first
+# non-ASCII byte in blocks of this size
+CSV_SCAN_BLOCK_SIZE = 1024 * 1024
+NON_ASCII_RE = re.compile("[\x80-\xff]")
+
+# Quotemask for files following the OpenAPC data schema: Do not quote the
+# values in the 'period' and 'euro' columns
+OPENAPC_QUOTEMASK = [
+    True,
+    False,
+    False,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+    True,
+]
+
 # These classes were adopted from
 # https://docs.python.org/2/library/csv.html#examples
 class UTF8Recoder(object):
@@ -41,6 +115,23 @@ class UTF8Recoder(object):
     def next(self):
         return self.reader.next().encode("utf-8")
 
+def _reader_input(f, encoding):
+    """
+    Prepare a file for one of the unicode CSV readers.
+
+    The csv module can parse UTF-8 (and ASCII) input directly, so files in
+    these encodings are passed on unchanged and only the cells have to be
+    decoded. Any other input is recoded to UTF-8 line by line first.
+
+    Returns:
+        A tuple of the input for the csv module and the encoding to decode
+        the cells with.
+    """
+    codec_name = codecs.lookup(encoding).name
+    if codec_name in ["utf-8", "ascii"]:
+        return (f, codec_name)
+    return (UTF8Recoder(f, encoding), "utf-8")
+
 class UnicodeReader(object):
     """
     A CSV reader which will iterate over lines in the CSV file "f",
@@ -48,12 +139,17 @@ class UnicodeReader(object):
     """
 
     def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
+        f, self.encoding = _reader_input(f, encoding)
         self.reader = csv.reader(f, dialect=dialect, **kwds)
 
     def next(self):
         row = self.reader.next()
-        return [unicode(s, "utf-8") for s in row]
+        if not row:
+            return []
+        # Decoding the whole row at once is considerably faster than decoding
+        # every cell. The csv module rejects NUL bytes, so no cell can contain
+        # the separator.
+        return unicode("\x00".join(row), self.encoding).split(u"\x00")
 
     def __iter__(self):
         return self
@@ -65,12 +161,28 @@ class UnicodeDictReader(object):
     """
 
     def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
+        f, self.encoding = _reader_input(f, encoding)
         self.reader = csv.DictReader(f, dialect=dialect, **kwds)
 
     def next(self):
         row = self.reader.next()
-        return {k: unicode(v, "utf-8") for (k, v) in row.iteritems()}
+        try:
+            # See UnicodeReader.next
+            values = unicode("\x00".join(row.itervalues()), self.encoding)
+        except TypeError:
+            # Rows of a different length than the header contain None or
+            # list values (see csv.DictReader)
+            return {k: self._decode(v) for (k, v) in row.iteritems()}
+        return dict(zip(row.iterkeys(), values.split(u"\x00")))
+
+    def _decode(self, value):
+        # Missing cells of short rows are None (the restval), the surplus
+        # cells of long rows are collected in a list
+        if value is None:
+            return None
+        if isinstance(value, list):
+            return [unicode(v, self.encoding) for v in value]
+        return unicode(value, self.encoding)
 
     def __iter__(self):
         return self
@@ -96,74 +208,757 @@ class OpenAPCUnicodeWriter(object):
         has_header: Determines if the csv file has a header. If that's the case,
                     The values in the first row will all be quoted regardless
                     of any quotemask.
+        flush_interval: Rows are written in batches of this size, the output
+                        file is flushed after each batch. Use 1 to make each
+                        row reach the disk as soon as it has been produced.
     """
 
-    def __init__(self, f, quotemask=None, openapc_quote_rules=True, has_header=True):
+    def __init__(self, f, quotemask=None, openapc_quote_rules=True, has_header=True,
+                 flush_interval=1000):
         self.outfile = f
         self.quotemask = quotemask
         self.openapc_quote_rules = openapc_quote_rules
         self.has_header = has_header
-        self.encoder = codecs.getincrementalencoder("utf-8")()
-
-    def _prepare_row(self, row, use_quotemask):
-        for index in range(len(row)):
-            if self.openapc_quote_rules and row[index] in [u"TRUE", u"FALSE", u"NA"]:
-                # Never quote these keywords
-                continue
-            if not use_quotemask or not self.quotemask:
+        self.flush_interval = flush_interval
+        # The quotation rules are compiled once per row length: For each
+        # length, the indexes of the columns to be quoted are stored.
+        self._quoted_indexes = {}
+        self._unquoted_values = frozenset()
+        if openapc_quote_rules:
+            self._unquoted_values = frozenset([u"TRUE", u"FALSE", u"NA"])
+
+    def _get_quoted_indexes(self, length):
+        if length not in self._quoted_indexes:
+            if not self.quotemask:
                 # Always quote without a quotemask
-                row[index] = u'"' + row[index] + u'"'
-                continue
-            if index < len(self.quotemask):
-                if self.quotemask[index]:
-                    row[index] = u'"' + row[index] + u'"'
-        return row
-
-    def _write_row(self, row):
-        line = u",".join(row) + u"\n"
-        line = self.encoder.encode(line)
-        self.outfile.write(line)
+                indexes = range(length)
+            else:
+                indexes = [index for index, quote in enumerate(self.quotemask[:length])
+                           if quote]
+            self._quoted_indexes[length] = tuple(indexes)
+        return self._quoted_indexes[length]
+
+    def _format_row(self, row, quoted_indexes):
+        unquoted = self._unquoted_values
+        row = list(row)
+        for index in quoted_indexes:
+            value = row[index]
+            if value not in unquoted:
+                row[index] = u'"' + value + u'"'
+        return u",".join(row) + u"\n"
+
+    def _write_lines(self, lines):
+        self.outfile.write(u"".join(lines).encode("utf-8"))
+        self.outfile.flush()
 
     def write_rows(self, rows):
+        """
+        Write rows to the output file.
+
+        Lines are collected and written in batches of flush_interval rows,
+        the output file is flushed after each batch.
+
+        Args:
+            rows: Any iterable of rows, lists and generators alike. Rows are
+                  written as they are consumed and the iterable is not
+                  modified.
+        """
+        rows = iter(rows)
         if self.has_header:
-            self._write_row(self._prepare_row(rows.pop(0), False))
+            for header in rows:
+                self._write_lines([self._format_row(header, range(len(header)))])
+                break
+        lines = []
         for row in rows:
-            self._write_row(self._prepare_row(row, True))
+            lines.append(self._format_row(row, self._get_quoted_indexes(len(row))))
+            if len(lines) >= self.flush_interval:
+                self._write_lines(lines)
+                lines = []
+        self._write_lines(lines)
+
+def _file_hash(file_name):
+    sha1 = hashlib.sha1()
+    with open(file_name, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), ""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def _sidecar_path(file_name, cache_dir, extension):
+    """
+    Return the path of a sidecar file for data derived from a file. Sidecars
+    are kept in the "sidecars" directory of a cache directory, never next to
+    the file itself (which might be part of a read-only checkout).
+    """
+    path_hash = hashlib.sha1(os.path.abspath(file_name)).hexdigest()[:16]
+    name = "{}-{}.{}".format(os.path.basename(file_name), path_hash, extension)
+    return os.path.join(cache_dir, "sidecars", name)
+
+def _load_sidecar(file_name, sidecar_file, params):
+    """
+    Read data derived from a file which was stored by _save_sidecar.
+
+    The data is only returned if it was stored with the same params (like a
+    format version) and if the size and modification time of the file did
+    not change since. If only the modification time differs, the SHA-1 hash
+    of the file content decides (and the sidecar is updated).
+
+    Returns:
+        The stored data or None if the sidecar file is missing, damaged or
+        outdated.
+    """
+    stat = os.stat(file_name)
+    try:
+        with open(sidecar_file, "rb") as handle:
+            # A sidecar holds two pickles: A small header to validate and the
+            # data itself
+            meta = cPickle.load(handle)
+            if meta["params"] != params or meta["size"] != stat.st_size:
+                return None
+            touched = meta["mtime"] != stat.st_mtime
+            if touched and meta["sha1"] != _file_hash(file_name):
+                return None
+            data = cPickle.load(handle)
+    except Exception:
+        # A missing, damaged or incompatible sidecar is simply rebuilt
+        return None
+    if touched:
+        # Same content, but touched: Update the sidecar header
+        _save_sidecar(file_name, sidecar_file, params, data, stat, meta["sha1"])
+    return data
+
+def _save_sidecar(file_name, sidecar_file, params, data, stat, sha1=None):
+    """
+    Store data derived from a file in a sidecar file, see _load_sidecar.
+
+    Args:
+        stat: The result of os.stat for the file, taken before it was read.
+        sha1: The SHA-1 hash of the file content, computed if omitted.
+    """
+    tmp_file = sidecar_file + ".tmp"
+    try:
+        sidecar_dir = os.path.dirname(sidecar_file)
+        if not os.path.isdir(sidecar_dir):
+            os.makedirs(sidecar_dir)
+        if sha1 is None:
+            sha1 = _file_hash(file_name)
+        meta = {"params": params, "size": stat.st_size,
+                "mtime": stat.st_mtime, "sha1": sha1}
+        with open(tmp_file, "wb") as handle:
+            cPickle.dump(meta, handle, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(data, handle, cPickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(tmp_file, sidecar_file)
+        except OSError:
+            # Windows does not replace existing files on rename
+            os.remove(sidecar_file)
+            os.rename(tmp_file, sidecar_file)
+    except (IOError, OSError) as e:
+        # Sidecars are optional, f.e. the cache directory might be read-only
+        logging.debug("Could not write %s: %s", sidecar_file, e)
 
 class DOAJOfflineAnalysis(object):
+    """
+    Journal lookups in an offline copy of the DOAJ (the journal CSV dump).
 
-    def __init__(self, doaj_csv_file):
-        self.doaj_issn_map = {}
-        self.doaj_eissn_map = {}
-
-        handle = open(doaj_csv_file, "r")
-        reader = UnicodeDictReader(handle)
-        for line in reader:
-            journal_title = line["Journal title"]
-            issn = line["Journal ISSN (print version)"]
-            eissn = line["Journal EISSN (online version)"]
-            if issn:
-                self.doaj_issn_map[issn] = journal_title
-            if eissn:
-                self.doaj_eissn_map[eissn] = journal_title
+    Print and electronic ISSNs are merged into a single map, keyed by
+    issn_to_int, so ISSNs are found with or without hyphen. Where an ISSN
+    occurs as both, the print ISSN takes precedence. The map is compiled
+    into an index file in the cache directory, which is only rebuilt when the
+    dump changes.
+    """
+
+    # Increase whenever the index content changes
+    INDEX_VERSION = 1
+
+    def __init__(self, doaj_csv_file, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        Args:
+            doaj_csv_file: Path of the DOAJ journal CSV dump.
+            cache_dir: The directory to keep the index in. If None, the dump
+                       is always compiled and no index is written.
+        """
+        params = {"version": DOAJOfflineAnalysis.INDEX_VERSION}
+        stat = os.stat(doaj_csv_file)
+        self.doaj_map = None
+        if cache_dir is not None:
+            index_file = _sidecar_path(doaj_csv_file, cache_dir, "index")
+            self.doaj_map = _load_sidecar(doaj_csv_file, index_file, params)
+        if self.doaj_map is None:
+            self.doaj_map = self._compile(doaj_csv_file)
+            if cache_dir is not None:
+                _save_sidecar(doaj_csv_file, index_file, params, self.doaj_map, stat)
+
+    @staticmethod
+    def _compile(doaj_csv_file):
+        eissn_map = {}
+        issn_map = {}
+        with open(doaj_csv_file, "r") as handle:
+            reader = UnicodeDictReader(handle)
+            for line in reader:
+                journal_title = line["Journal title"]
+                for issn, target in [(line["Journal ISSN (print version)"], issn_map),
+                                     (line["Journal EISSN (online version)"], eissn_map)]:
+                    key = issn_to_int(issn)
+                    if key is not None:
+                        target[key] = journal_title
+        eissn_map.update(issn_map)
+        return eissn_map
 
     def lookup(self, any_issn):
-        if any_issn in self.doaj_issn_map:
-            return self.doaj_issn_map[any_issn]
-        elif any_issn in self.doaj_eissn_map:
-            return self.doaj_eissn_map[any_issn]
-        else:
+        key = issn_to_int(any_issn)
+        if key is None:
             return None
+        return self.doaj_map.get(key)
+
+
+class ISSNLIndex(object):
+    """
+    A read-only ISSN to ISSN-L mapping, backed by a memory-mapped index file.
+
+    The index file starts with a magic string, followed by fixed-width
+    records of two little-endian unsigned 32 bit integers (ISSN and ISSN-L,
+    see issn_to_int), sorted by ISSN. Lookups are done by binary search, so
+    opening an index is instant and only the pages touched are read.
+
+    Use ISSNLIndex.build to create an index file from the "ISSN-to-ISSN-L"
+    mapping file which can be downloaded at issn.org.
+    """
+
+    MAGIC = "ISSNL\x00\x00\x01"
+    RECORD = struct.Struct("<II")
+
+    def __init__(self, index_file):
+        self._file = open(index_file, "rb")
+        try:
+            if self._file.read(len(ISSNLIndex.MAGIC)) != ISSNLIndex.MAGIC:
+                raise ValueError(index_file + " is not an ISSN-L index file")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._count = (len(self._map) - len(ISSNLIndex.MAGIC)) // ISSNLIndex.RECORD.size
+
+    @staticmethod
+    def is_index_file(file_name):
+        with open(file_name, "rb") as handle:
+            return handle.read(len(ISSNLIndex.MAGIC)) == ISSNLIndex.MAGIC
+
+    @staticmethod
+    def build(mapping_file, index_file):
+        """
+        Convert an issn.org ISSN-to-ISSN-L mapping file into an index file.
+
+        Lines which do not contain a tab-separated pair of ISSNs (like the
+        header) are ignored. If an ISSN occurs more than once, the last
+        mapping wins.
+
+        Returns:
+            A dict with the number of ISSNs pointing to themselves ("itself")
+            and to another ISSN-L ("other").
+        """
+        counts = {"itself": 0, "other": 0}
+        records = {}
+        with open(mapping_file, "r") as handle:
+            for line in handle:
+                parts = line.strip().split("\t")
+                if len(parts) != 2:
+                    continue
+                issn, issn_l = issn_to_int(parts[0]), issn_to_int(parts[1])
+                if issn is None or issn_l is None:
+                    continue
+                records[issn] = issn_l
+        tmp_file = index_file + ".tmp"
+        pack = ISSNLIndex.RECORD.pack
+        with open(tmp_file, "wb") as handle:
+            handle.write(ISSNLIndex.MAGIC)
+            for issn in sorted(records):
+                issn_l = records[issn]
+                handle.write(pack(issn, issn_l))
+                counts["itself" if issn == issn_l else "other"] += 1
+        try:
+            os.rename(tmp_file, index_file)
+        except OSError:
+            # Windows does not replace existing files on rename
+            os.remove(index_file)
+            os.rename(tmp_file, index_file)
+        return counts
+
+    def get(self, issn):
+        """
+        Look up the ISSN-L for an ISSN (with or without hyphen).
+
+        Returns:
+            The ISSN-L in hyphenated form or None if the ISSN is malformed or
+            not contained in the index.
+        """
+        key = issn_to_int(issn)
+        if key is None:
+            return None
+        unpack_from = ISSNLIndex.RECORD.unpack_from
+        offset, size = len(ISSNLIndex.MAGIC), ISSNLIndex.RECORD.size
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            current, issn_l = unpack_from(self._map, offset + middle * size)
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return int_to_issn(issn_l)
+        return None
+
+    def __len__(self):
+        return self._count
 
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class OpenAPCTable(object):
+    """
+    A column-oriented, memory efficient representation of an OpenAPC data file.
+
+    Every column is stored as a list of values, and repeated values
+    (institutions, publishers, journal titles, TRUE/FALSE/NA...) share a
+    single string object. The "euro" and "period" columns are held in numeric
+    arrays instead. Values which would not be restored to exactly the same
+    text from their numeric form are kept as text exceptions, so that every
+    value reads back as it was found in the file. Rows with a different
+    length than the header are stored separately.
+
+    Use OpenAPCTable.load to read a CSV file.
+
+    Attributes:
+        header: The column names.
+    """
+
+    # Column names and array type codes of the numeric columns
+    NUMERIC_COLUMNS = {"euro": "d", "period": "l"}
+
+    # Increase whenever the snapshot content changes
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, header, columns=None):
+        self.header = list(header)
+        self._positions = {name: position for position, name in enumerate(self.header)}
+        self._columns = []
+        self._numeric_positions = []
+        self._text_appends = []
+        for position, name in enumerate(self.header):
+            if columns is not None:
+                column = columns[position]
+            elif name in OpenAPCTable.NUMERIC_COLUMNS:
+                column = array(OpenAPCTable.NUMERIC_COLUMNS[name])
+            else:
+                column = []
+            self._columns.append(column)
+            if isinstance(column, array):
+                self._numeric_positions.append((position, name))
+            else:
+                self._text_appends.append((position, column.append))
+        self._text_exceptions = {}
+        self._irregular_rows = {}
+        self._indexes = {}
+        self._length = 0
+
+    @classmethod
+    def load(cls, file_name, encoding="utf-8", cache_dir=DEFAULT_CACHE_DIR):
+        """
+        Read an OpenAPC CSV file. The first non-empty line is taken as the
+        header, empty lines are skipped.
+
+        Parsing CSV is slow compared to reading a binary representation, so
+        the table is stored in a snapshot file in the cache directory and
+        read from there the next time. A
+        snapshot is only used if it matches the size and modification time
+        of the CSV file. If only the modification time differs, the SHA-1
+        hash of the file content decides. Otherwise the CSV file is parsed
+        and the snapshot replaced.
+
+        Args:
+            file_name: Path of the CSV file.
+            encoding: Encoding of the CSV file.
+            cache_dir: The directory to keep the snapshot in. If None, the
+                       CSV file is always parsed and no snapshot is written.
+        """
+        params = {"version": OpenAPCTable.SNAPSHOT_VERSION, "encoding": encoding}
+        if cache_dir is not None:
+            snapshot_file = _sidecar_path(file_name, cache_dir, "snapshot")
+            stat = os.stat(file_name)
+            state = _load_sidecar(file_name, snapshot_file, params)
+            if state is not None:
+                return cls._from_state(state)
+        with open(file_name, "r") as csv_file:
+            reader = UnicodeReader(csv_file, encoding=encoding)
+            rows = (row for row in reader if row)
+            header = next(rows, [])
+            table = cls.from_rows(header, rows)
+        if cache_dir is not None:
+            _save_sidecar(file_name, snapshot_file, params, table._get_state(), stat)
+        return table
+
+    def _get_state(self):
+        """
+        Return the table content as plain data types. Numeric arrays are
+        stored as (typecode, bytes) tuples, which are a lot faster to restore
+        than pickled arrays.
+        """
+        columns = []
+        for column in self._columns:
+            if isinstance(column, array):
+                columns.append((column.typecode, column.tostring()))
+            else:
+                columns.append(column)
+        return {"header": self.header, "columns": columns,
+                "text_exceptions": self._text_exceptions,
+                "irregular_rows": self._irregular_rows,
+                "length": self._length}
+
+    @classmethod
+    def _from_state(cls, state):
+        columns = []
+        for column in state["columns"]:
+            if isinstance(column, tuple):
+                typecode, data = column
+                column = array(typecode)
+                column.fromstring(data)
+            columns.append(column)
+        table = cls(state["header"], columns)
+        table._text_exceptions = state["text_exceptions"]
+        table._irregular_rows = state["irregular_rows"]
+        table._length = state["length"]
+        return table
+
+    @classmethod
+    def from_rows(cls, header, rows):
+        table = cls(header)
+        pool = {}
+        for row in rows:
+            table._append(row, pool)
+        return table
+
+    @staticmethod
+    def _to_number(name, text):
+        """
+        Convert a numeric column value, None if it would not read back as
+        the same text.
+        """
+        try:
+            if name == "period":
+                number = int(text)
+            else:
+                number = float(text)
+        except ValueError:
+            return None
+        if OpenAPCTable._to_text(name, number) != text:
+            return None
+        return number
+
+    @staticmethod
+    def _to_text(name, number):
+        if name == "euro":
+            if number.is_integer():
+                return unicode(int(number))
+            return unicode(repr(number))
+        return unicode(number)
+
+    def _append(self, row, pool):
+        index = self._length
+        if len(row) != len(self.header):
+            self._irregular_rows[index] = row
+            row = (list(row) + [u""] * len(self.header))[:len(self.header)]
+        intern_value = pool.setdefault
+        for position, append in self._text_appends:
+            value = row[position]
+            append(intern_value(value, value))
+        for position, name in self._numeric_positions:
+            value = row[position]
+            number = OpenAPCTable._to_number(name, value)
+            try:
+                self._columns[position].append(number)
+            except (TypeError, OverflowError):
+                self._text_exceptions[(index, position)] = intern_value(value, value)
+                self._columns[position].append(float("nan") if name == "euro" else 0)
+        self._length += 1
+        self._indexes = {}
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for index in xrange(self._length):
+            yield self.row(index)
+
+    def _value(self, index, position):
+        column = self._columns[position]
+        if isinstance(column, array):
+            text = self._text_exceptions.get((index, position))
+            if text is not None:
+                return text
+            return OpenAPCTable._to_text(self.header[position], column[index])
+        return column[index]
+
+    def value(self, index, name):
+        return self._value(index, self._positions[name])
+
+    def column(self, name):
+        """
+        Return all values of a column as a list of strings. For text
+        columns, this is the internal list which must not be modified.
+        """
+        position = self._positions[name]
+        column = self._columns[position]
+        if isinstance(column, array):
+            return [self._value(index, position) for index in xrange(self._length)]
+        return column
+
+    def numeric_column(self, name):
+        """
+        Return the numeric array of the "euro" or "period" column. Values
+        which are no numbers are stored as NaN (euro) or 0 (period).
+        """
+        return self._columns[self._positions[name]]
+
+    def index(self, name):
+        """
+        Return a dict mapping each value of a column to the list of row
+        indexes it occurs in. Indexes are built once and kept until the
+        table changes.
+        """
+        if name not in self._indexes:
+            index = {}
+            for row_index, value in enumerate(self.column(name)):
+                index.setdefault(value, []).append(row_index)
+            self._indexes[name] = index
+        return self._indexes[name]
+
+    def row(self, index):
+        """
+        Return a row as a list of values, exactly as found in the file.
+        """
+        if index in self._irregular_rows:
+            return list(self._irregular_rows[index])
+        return [self._value(index, position) for position in xrange(len(self.header))]
+
+    def row_dict(self, index):
+        """
+        Return a read-only, dict-like view of a row, keyed by column names.
+        """
+        return OpenAPCRow(self, index)
+
+class OpenAPCRow(object):
+    """
+    A dict-like view of a single row in an OpenAPCTable.
+
+    The length of a row is the number of values found in the line, which
+    may differ from the number of columns.
+    """
+    __slots__ = ["table", "index"]
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, name):
+        return self.table.value(self.index, name)
+
+    def get(self, name, default=None):
+        if name in self.table._positions:
+            return self[name]
+        return default
+
+    def keys(self):
+        return list(self.table.header)
+
+    def iteritems(self):
+        for name in self.table.header:
+            yield name, self[name]
+
+    def __len__(self):
+        irregular_row = self.table._irregular_rows.get(self.index)
+        if irregular_row is not None:
+            return len(irregular_row)
+        return len(self.table.header)
+
+class CheckpointJournal(object):
+    """
+    An append-only journal of enriched rows, used to resume interrupted runs.
+
+    The journal is a text file with one JSON document per line. The first
+    line identifies the input file (path, size, modification time) and the
+    output header, every following line holds a [row_num, enriched_row]
+    pair and is flushed to disk as soon as it is written.
+
+    Attributes:
+        path: Path of the journal file.
+        meta: The identification of the current input, as written to the
+              first line.
+    """
+
+    def __init__(self, path, csv_file, header):
+        self.path = path
+        stat = os.stat(csv_file)
+        self.meta = {"csv_file": os.path.abspath(csv_file),
+                     "size": stat.st_size,
+                     "mtime": stat.st_mtime,
+                     "header": list(header)}
+        self._handle = None
+        self._lock = threading.Lock()
+        self._valid_size = None
+
+    def load(self):
+        """
+        Read the rows completed in an earlier run.
+
+        Returns:
+            A dict mapping row numbers to enriched rows. Empty if there is no
+            journal yet.
+        Raises:
+            ValueError: The journal was written for a different input file
+                        or output format.
+        """
+        completed = {}
+        if not os.path.isfile(self.path):
+            return completed
+        with open(self.path, "r") as handle:
+            lines = iter(handle.readline, "")
+            try:
+                meta = json.loads(next(lines))
+            except (StopIteration, ValueError):
+                return completed
+            if meta != self.meta:
+                msg = ("The journal {} was written for another input file " +
+                       "or the input file has changed since.")
+                raise ValueError(msg.format(self.path))
+            self._valid_size = handle.tell()
+            for line in lines:
+                try:
+                    row_num, row = json.loads(line)
+                except ValueError:
+                    # An incomplete last line, written while crashing
+                    break
+                completed[row_num] = row
+                self._valid_size = handle.tell()
+        return completed
+
+    def open(self, resume=False):
+        """
+        Open the journal for writing. Unless resume is set, an existing
+        journal will be discarded. When resuming, a damaged last line found
+        by load() is cut off before new rows are added.
+        """
+        if resume and self._valid_size is not None:
+            self._handle = open(self.path, "a")
+            self._handle.truncate(self._valid_size)
+            return
+        self._handle = open(self.path, "w")
+        self._write(self.meta)
+
+    def _write(self, document):
+        self._handle.write(json.dumps(document) + "\n")
+        self._handle.flush()
+
+    def append(self, row_num, row):
+        with self._lock:
+            self._write([row_num, row])
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+class ConflictLog(object):
+    """
+    A side file for overwrite conflicts which were deferred during enrichment.
+
+    Instead of asking the user, CSV columns may record a conflict here and
+    keep the existing value for the time being. Conflicts are collected per
+    row while the row is enriched and committed once the row's position in
+    the output file is known. Each committed conflict is written as a JSON
+    document on a line of its own, holding the number of the output record
+    ("line", the header being line 1), the input line number ("row_num"), the
+    column name and the old and new values.
+
+    Attributes:
+        path: Path of the side file.
+        count: The number of conflicts committed so far.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._pending = {}
+        self._handle = None
+        self._lock = threading.Lock()
+
+    def open(self, resume=False):
+        self._handle = open(self.path, "a" if resume else "w")
+
+    def record(self, row_num, column, old_value, new_value):
+        with self._lock:
+            conflicts = self._pending.setdefault(row_num, [])
+            conflicts.append((column, old_value, new_value))
+
+    def commit(self, row_num, line):
+        with self._lock:
+            conflicts = self._pending.pop(row_num, [])
+            for column, old_value, new_value in conflicts:
+                document = {"line": line, "row_num": row_num,
+                            "column": column, "old": old_value,
+                            "new": new_value}
+                self._handle.write(json.dumps(document) + "\n")
+                self.count += 1
+            if conflicts:
+                self._handle.flush()
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    @staticmethod
+    def load(path):
+        """
+        Read all conflicts from a side file.
+
+        Returns:
+            A list of conflict dicts, ordered by output line. A conflict
+            recorded more than once for the same line and column (which may
+            happen when a run was resumed) is only returned once.
+        """
+        conflicts = OrderedDict()
+        with open(path, "r") as handle:
+            for line in handle:
+                try:
+                    conflict = json.loads(line)
+                except ValueError:
+                    continue
+                conflicts[(conflict["line"], conflict["column"])] = conflict
+        return sorted(conflicts.values(), key=lambda c: c["line"])
 
 class CSVAnalysisResult(object):
+    """
+    The result of analyze_csv_file.
 
-    def __init__(self, blanks, dialect, has_header, enc, enc_conf):
+    Attributes:
+        blanks: The number of empty lines found in the sample.
+        dialect: The sniffed CSV dialect.
+        has_header: True if the file seems to have a header.
+        enc: The guessed encoding or None if no guess was possible.
+        enc_conf: The confidence of the encoding guess (0 to 1).
+        sample: The (still encoded) non-empty lines the analysis was based
+                on, joined to a single string.
+    """
+
+    def __init__(self, blanks, dialect, has_header, enc, enc_conf, sample=""):
         self.blanks = blanks
         self.dialect = dialect
         self.has_header = has_header
         self.enc = enc
         self.enc_conf = enc_conf
+        self.sample = sample
 
     def __str__(self):
         ret = "*****CSV file analysis*****\n"
@@ -231,7 +1026,544 @@ class BufferedErrorHandler(MemoryHandler):
 
     def shouldFlush(self, record):
         return False
-    
+
+class HTTPResponse(object):
+    """
+    A fully read HTTP response as returned by HTTPClient.
+
+    Mimics the parts of the urllib2 response interface used by the OpenAPC
+    scripts (read, geturl, getcode and info).
+    """
+    def __init__(self, url, code, headers, body):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket to limit the rate of requests.
+
+    Attributes:
+        rate: The number of tokens added per second.
+        capacity: The maximum number of tokens, determines the size of
+                  bursts which are allowed after idle periods.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, wait until one is available if necessary.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Tokens may become negative: Waiting threads queue up behind
+            # each other instead of competing for the next token.
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+class RequestScheduler(object):
+    """
+    Throttles and retries requests to metadata providers.
+
+    Every host gets its own token bucket. The initial rates are taken from
+    the RATES table (or default_rate for unknown hosts) and adapted while
+    running: Crossref announces its current limit in X-Rate-Limit headers,
+    which are followed, and the rate for a host is halved whenever it
+    responds with 429 (Too Many Requests) or 503 (Service Unavailable).
+    After that, every successful request raises the rate a bit again until
+    the configured rate is reached.
+
+    Failed requests (network errors or one of the RETRY_CODES) are retried
+    with exponential backoff and jitter, a Retry-After header sent by the
+    server takes precedence.
+
+    Attributes:
+        max_retries: Maximum number of retries for a single request.
+        retry_budget: Maximum number of retries for all requests together,
+                      None for no limit. Prevents runs from crawling along
+                      when a provider is down.
+        backoff_base: Delay in seconds before the first retry, doubled for
+                      each following one.
+        backoff_max: Upper limit for a single delay in seconds.
+    """
+
+    # Requests per second
+    RATES = {
+        "api.crossref.org": 40,
+        "data.crossref.org": 40,
+        "www.ebi.ac.uk": 10,
+        "doaj.org": 5,
+        "doi.org": 1,
+        "dx.doi.org": 1,
+        "linkinghub.elsevier.com": 1,
+        "www.sciencedirect.com": 1
+    }
+
+    RETRY_CODES = [429, 500, 502, 503, 504]
+
+    def __init__(self, rates=None, default_rate=10, max_retries=5,
+                 retry_budget=None, backoff_base=1, backoff_max=60):
+        self.rates = dict(self.RATES)
+        if rates:
+            self.rates.update(rates)
+        self.default_rate = default_rate
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                rate = self.rates.get(host, self.default_rate)
+                self._buckets[host] = TokenBucket(rate)
+            return self._buckets[host]
+
+    def wait(self, host):
+        """
+        Block until a request to host may be sent.
+        """
+        self._bucket(host).acquire()
+
+    def observe(self, host, status, headers):
+        """
+        Adapt the rate for a host to a response received from it.
+        """
+        bucket = self._bucket(host)
+        max_rate = self.rates.get(host, self.default_rate)
+        limit = headers.get("x-rate-limit-limit")
+        interval = headers.get("x-rate-limit-interval")
+        if limit and interval:
+            try:
+                max_rate = float(limit) / float(interval.rstrip("s"))
+                self.rates[host] = max_rate
+            except (ValueError, ZeroDivisionError):
+                pass
+        with self._lock:
+            if status in [429, 503]:
+                bucket.rate = max(0.1, bucket.rate / 2)
+            else:
+                bucket.rate = min(max_rate, bucket.rate * 1.05)
+
+    def retry_delay(self, attempt, error):
+        """
+        Decide if a failed request should be retried.
+
+        Args:
+            attempt: The number of retries already made for this request.
+            error: The urllib2.URLError or urllib2.HTTPError raised.
+        Returns:
+            The number of seconds to wait before the next try or None if the
+            request should not be retried.
+        """
+        retry_after = None
+        if isinstance(error, urllib2.HTTPError):
+            if error.getcode() not in self.RETRY_CODES:
+                return None
+            retry_after = self._parse_retry_after(error.info())
+        # Only retry network problems. Certificate errors or invalid URLs
+        # will not go away by waiting.
+        elif (not isinstance(error.reason, (socket.error, httplib.HTTPException))
+              or isinstance(error.reason, ssl.SSLError)):
+            return None
+        if attempt >= self.max_retries:
+            return None
+        with self._lock:
+            if self.retry_budget is not None:
+                if self.retry_budget <= 0:
+                    return None
+                self.retry_budget -= 1
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    @staticmethod
+    def _parse_retry_after(headers):
+        if headers is None:
+            return None
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0, int(value))
+        except ValueError:
+            date = parsedate_tz(value)
+            if date is None:
+                return None
+            return max(0, mktime_tz(date) - time.time())
+
+class HTTPClient(object):
+    """
+    A minimal HTTP client with per-host connection pooling.
+
+    Connections are kept alive after a request and reused by subsequent
+    requests to the same host, which saves a TCP connect (and a TLS handshake
+    for https URLs) on every metadata lookup. gzip-compressed responses are
+    requested and transparently decompressed, redirects are followed.
+    The client is thread-safe, a connection is only used by one thread
+    at a time.
+
+    Errors are reported the same way urllib2.urlopen does it: urllib2.HTTPError
+    for HTTP status codes >= 400 and urllib2.URLError for network problems.
+    Like urllib2, the client uses the proxies configured in the environment
+    (http_proxy, https_proxy and no_proxy), https requests are tunneled
+    through the proxy.
+
+    Attributes:
+        timeout: Socket timeout in seconds for connecting and reading.
+        max_redirects: Maximum number of redirects to follow for a request.
+        max_idle_connections: Maximum number of idle connections kept open
+                              per host.
+        scheduler: An optional RequestScheduler to throttle and retry
+                   requests.
+        proxies: A dict of proxy URLs by scheme, taken from the environment
+                 by default (see urllib.getproxies).
+    """
+
+    REDIRECT_CODES = [301, 302, 303, 307, 308]
+
+    def __init__(self, timeout=30, max_redirects=10, max_idle_connections=10,
+                 scheduler=None, proxies=None):
+        self.timeout = timeout
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self.max_redirects = max_redirects
+        self.max_idle_connections = max_idle_connections
+        self.scheduler = scheduler
+        self._idle_connections = {}
+        self._lock = threading.Lock()
+
+    def _get_proxy(self, scheme, host):
+        """
+        Returns:
+            The proxy URL to use for a host, split by urlparse.urlsplit, or
+            None if the host is to be contacted directly.
+        """
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(host.split(":")[0]):
+            return None
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        return urlparse.urlsplit(proxy)
+
+    @staticmethod
+    def _proxy_headers(proxy):
+        if proxy.username is None:
+            return {}
+        credentials = (urllib.unquote(proxy.username) + ":" +
+                       urllib.unquote(proxy.password or ""))
+        return {"Proxy-Authorization": "Basic " + base64.b64encode(credentials)}
+
+    def _get_connection(self, pool_key):
+        with self._lock:
+            idle = self._idle_connections.get(pool_key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, bypass_cert_verification = pool_key
+        proxy = self._get_proxy(scheme, host)
+        if proxy is not None:
+            proxy_address = (proxy.hostname, proxy.port or 80)
+        if scheme == "https":
+            if bypass_cert_verification:
+                context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            else:
+                context = ssl.create_default_context()
+            if proxy is None:
+                conn = httplib.HTTPSConnection(host, timeout=self.timeout,
+                                               context=context)
+            else:
+                # TLS is established with the host through a CONNECT tunnel
+                conn = httplib.HTTPSConnection(*proxy_address, timeout=self.timeout,
+                                               context=context)
+                conn.set_tunnel(host, headers=self._proxy_headers(proxy))
+        elif proxy is None:
+            conn = httplib.HTTPConnection(host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(*proxy_address, timeout=self.timeout)
+        return conn, False
+
+    def _release_connection(self, pool_key, conn):
+        with self._lock:
+            idle = self._idle_connections.setdefault(pool_key, [])
+            if len(idle) < self.max_idle_connections:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            for idle in self._idle_connections.values():
+                for conn in idle:
+                    conn.close()
+            self._idle_connections = {}
+
+    @staticmethod
+    def _is_stale_connection_error(error):
+        """
+        Check if an error raised before any part of the response arrived
+        means that the server had already closed the connection.
+        """
+        if isinstance(error, httplib.BadStatusLine):
+            # Raised for an empty status line, the connection was closed
+            return True
+        if isinstance(error, socket.error):
+            return error.errno in [errno.ECONNRESET, errno.EPIPE]
+        return False
+
+    def _send(self, url, headers, bypass_cert_verification):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme not in ["http", "https"]:
+            raise urllib2.URLError("unknown url type: " + parsed.scheme)
+        pool_key = (parsed.scheme, parsed.netloc, bypass_cert_verification)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        request_headers = {"Accept-Encoding": "gzip"}
+        if parsed.scheme == "http":
+            proxy = self._get_proxy(parsed.scheme, parsed.netloc)
+            if proxy is not None:
+                # A plain HTTP proxy expects the absolute URL
+                path = urlparse.urlunsplit(parsed[:4] + ("",))
+                request_headers.update(self._proxy_headers(proxy))
+        request_headers.update(headers)
+        while True:
+            conn, reused = self._get_connection(pool_key)
+            try:
+                conn.request("GET", path, headers=request_headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                # The server might have dropped an idle keep-alive
+                # connection, try again with a fresh one. Anything else
+                # (like a timeout) is left to the scheduler.
+                if reused and self._is_stale_connection_error(e):
+                    continue
+                raise urllib2.URLError(e)
+            try:
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                raise urllib2.URLError(e)
+            if response.will_close:
+                conn.close()
+            else:
+                self._release_connection(pool_key, conn)
+            return response, body
+
+    def request(self, url, headers=None, bypass_cert_verification=False):
+        """
+        Perform a GET request.
+
+        If the client has a scheduler, the request is throttled and retried
+        on failure according to it.
+
+        Args:
+            url: The URL to request.
+            headers: An optional dict of additional request headers.
+            bypass_cert_verification: If true, TLS certificates will not be
+                                      verified.
+        Returns:
+            An HTTPResponse object.
+        Raises:
+            urllib2.HTTPError: The server responded with a status code >= 400.
+            urllib2.URLError: The server could not be reached.
+        """
+        if headers is None:
+            headers = {}
+        attempt = 0
+        while True:
+            try:
+                return self._request(url, headers, bypass_cert_verification)
+            except urllib2.URLError as urle:
+                delay = None
+                if self.scheduler is not None:
+                    delay = self.scheduler.retry_delay(attempt, urle)
+                if delay is None:
+                    raise
+                msg = "Request to %s failed (%s), retrying in %.1f seconds."
+                logging.debug(msg, url, urle, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def _request(self, url, headers, bypass_cert_verification):
+        for _ in range(self.max_redirects + 1):
+            host = urlparse.urlsplit(url).netloc
+            if self.scheduler is not None:
+                self.scheduler.wait(host)
+            response, body = self._send(url, headers, bypass_cert_verification)
+            if self.scheduler is not None:
+                self.scheduler.observe(host, response.status, response.msg)
+            location = response.getheader("location")
+            if response.status in self.REDIRECT_CODES and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.getheader("content-encoding", "").lower() == "gzip":
+                try:
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                except zlib.error as ze:
+                    raise urllib2.URLError("Invalid gzip content: " + str(ze))
+            if response.status >= 400:
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, StringIO(body))
+            return HTTPResponse(url, response.status, response.msg, body)
+        raise urllib2.URLError("Too many redirects")
+
+# A client shared by all metadata lookups
+http_client = HTTPClient(scheduler=RequestScheduler())
+
+class MetadataCache(object):
+    """
+    A persistent cache for DOI metadata lookups, backed by SQLite.
+
+    Stores the result dicts of lookup functions like
+    get_metadata_from_crossref, keyed by a source name and the normalised,
+    lower-cased DOI. Successful lookups are kept for ttl seconds. Lookups
+    which failed because the DOI does not exist (HTTP 404) are cached as well
+    ("negative caching"), but expire after negative_ttl seconds. Results of
+    other errors (timeouts, server errors) are never cached.
+
+    Attributes:
+        db_path: Path to the SQLite database file.
+        ttl: Lifetime of a positive entry in seconds.
+        negative_ttl: Lifetime of a negative entry in seconds.
+    """
+
+    DB_FILE_NAME = "doi_metadata.sqlite"
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=30 * 86400,
+                 negative_ttl=7 * 86400):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.db_path = os.path.join(cache_dir, self.DB_FILE_NAME)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, timeout=30,
+                                     check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS metadata (" +
+                               "source TEXT, doi TEXT, stored REAL, " +
+                               "negative INTEGER, result TEXT, " +
+                               "PRIMARY KEY (source, doi))")
+
+    @staticmethod
+    def _key(doi_string):
+        doi = get_normalised_DOI(doi_string)
+        if doi is None:
+            doi = doi_string.strip()
+        return doi.lower()
+
+    def get(self, source, doi_string):
+        """
+        Return a cached result dict or None if there is no valid entry.
+        """
+        with self._lock:
+            cursor = self._conn.execute("SELECT stored, negative, result " +
+                                        "FROM metadata WHERE source = ? " +
+                                        "AND doi = ?",
+                                        (source, self._key(doi_string)))
+            entry = cursor.fetchone()
+        if entry is None:
+            return None
+        stored, negative, result = entry
+        ttl = self.negative_ttl if negative else self.ttl
+        if stored + ttl < time.time():
+            return None
+        return json.loads(result)
+
+    def put(self, source, doi_string, result, negative=False):
+        """
+        Store a result dict. It must be serializable to JSON.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO metadata VALUES " +
+                               "(?, ?, ?, ?, ?)",
+                               (source, self._key(doi_string), time.time(),
+                                int(negative), json.dumps(result)))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# The cache used by the DOI lookup functions. Disabled by default, scripts
+# may assign a MetadataCache object.
+metadata_cache = None
+
+class LRUCache(object):
+    """
+    A thread-safe in-memory mapping with least-recently-used eviction.
+
+    Attributes:
+        maxsize: Maximum number of entries. When exceeded, the entry which
+                 was least recently accessed is evicted.
+        hits: Number of get() calls which found an entry.
+        misses: Number of get() calls which did not find an entry.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the value stored for key or None.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+# Results of DOAJ journal lookups (online or offline) by ISSN, shared by all
+# rows processed in a run.
+doaj_lookup_memo = LRUCache()
+
 def get_normalised_DOI(doi_string):
     doi_match = DOI_RE.match(doi_string.strip())
     if not doi_match:
@@ -266,8 +1598,181 @@ def is_valid_ISSN(issn_string):
             return True
     return False
 
+# Weights of the first seven digits of an ISSN in the check digit calculation
+ISSN_WEIGHTS = [8, 7, 6, 5, 4, 3, 2]
+
+def _valid_ISSN_check_digits(issns):
+    """
+    Verify the check digits of well-formed ISSNs, given as byte strings of
+    the eight characters without hyphen (with an upper case X).
 
-def analyze_csv_file(file_path, line_limit=None):
+    Returns:
+        A list of booleans.
+    """
+    if not issns:
+        return []
+    if numpy is not None:
+        # One row of digit values per ISSN, "X" ends up as 40
+        digits = numpy.frombuffer("".join(issns), dtype=numpy.uint8).reshape(-1, 8)
+        digits = digits.astype(numpy.int32) - ord("0")
+        check_digits = numpy.where(digits[:, 7] == ord("X") - ord("0"), 10, digits[:, 7])
+        totals = digits[:, :7].dot(ISSN_WEIGHTS)
+        return ((11 - totals % 11) % 11 == check_digits).tolist()
+    valid = []
+    for issn in issns:
+        total = sum([int(digit) * weight for digit, weight in zip(issn, ISSN_WEIGHTS)])
+        check_digit = 10 if issn[7] == "X" else int(issn[7])
+        valid.append((11 - total % 11) % 11 == check_digit)
+    return valid
+
+def check_ISSN_columns(columns):
+    """
+    Check whole columns of ISSN values at once.
+
+    Every distinct value is only checked once, no matter how often it occurs
+    in the columns. The check digits of all well-formed values are verified
+    in a single pass, using array arithmetic if NumPy is available.
+
+    Args:
+        columns: A list of columns, each one a sequence of strings.
+
+    Returns:
+        A list with a tuple of two masks for every column. Both are lists of
+        booleans with one entry per value, the first one tells if the value
+        is a well-formed ISSN (see is_wellformed_ISSN), the second one if it
+        is a valid ISSN (see is_valid_ISSN).
+    """
+    distinct = set()
+    for column in columns:
+        distinct.update(column)
+    normalised = OrderedDict()
+    for value in distinct:
+        issn_match = ISSN_RE.match(value.strip())
+        if issn_match is not None:
+            normalised[value] = str("".join(issn_match.groups()).upper())
+    valid = dict(zip(normalised.keys(), _valid_ISSN_check_digits(normalised.values())))
+    return [([value in normalised for value in column], [valid.get(value, False) for value in column])
+            for column in columns]
+
+def issn_to_int(issn_string):
+    """
+    Encode a well-formed ISSN (with or without hyphen) as an integer.
+
+    The seven digits and the check digit (X counting as 10) are combined to
+    digits * 11 + check digit, so the numeric order matches the order of the
+    ISSN strings and every value fits into an unsigned 32 bit integer.
+
+    Returns:
+        The integer or None if the ISSN is not well-formed.
+    """
+    issn_match = ISSN_RE.match(issn_string.strip())
+    if issn_match is None:
+        return None
+    match_dict = issn_match.groupdict()
+    check_digit = match_dict["check_digit"]
+    check_digit = 10 if check_digit in ["X", "x"] else int(check_digit)
+    return int(match_dict["first_part"] + match_dict["second_part"]) * 11 + check_digit
+
+def int_to_issn(issn_int):
+    """
+    Reverse issn_to_int, returning the ISSN in hyphenated form.
+    """
+    digits, check_digit = divmod(issn_int, 11)
+    digits = "{:07d}".format(digits)
+    check_digit = "X" if check_digit == 10 else str(check_digit)
+    return digits[:4] + "-" + digits[4:] + check_digit
+
+
+def _detect_utf8(content):
+    """
+    Check if a byte string is valid UTF-8.
+
+    Text in other encodings (except plain ASCII) is very unlikely to form
+    valid UTF-8 sequences, so this check is a lot more reliable (and faster)
+    than statistical guessing if it succeeds. A multi-byte sequence cut off at
+    the end of the string is ignored.
+
+    Returns:
+        A tuple of encoding and confidence, (None, None) if content is not
+        valid UTF-8.
+    """
+    if content.startswith(codecs.BOM_UTF8):
+        return ("utf-8-sig", 1.0)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(content)
+    except UnicodeDecodeError:
+        return (None, None)
+    return ("utf-8", 1.0)
+
+def _detect_encoding(content):
+    """
+    Detect the encoding of a byte string, see _detect_utf8. If it is not
+    UTF-8, chardet's detector is fed in chunks and stopped as soon as it is
+    confident.
+
+    Returns:
+        A tuple of encoding and confidence, (None, None) if the encoding
+        could not be detected.
+    """
+    enc, enc_conf = _detect_utf8(content)
+    if enc is None and chardet:
+        detector = chardet.universaldetector.UniversalDetector()
+        for offset in range(0, len(content), CSV_DETECTION_CHUNK_SIZE):
+            detector.feed(content[offset:offset + CSV_DETECTION_CHUNK_SIZE])
+            if detector.done:
+                break
+        detector.close()
+        enc = detector.result["encoding"]
+        enc_conf = detector.result["confidence"]
+    return (enc, enc_conf)
+
+def _find_non_ascii(csv_file, sample_size):
+    """
+    Read on from the current position of a file until the first non-ASCII
+    byte.
+
+    Returns:
+        The content from the beginning of the line containing that byte, at
+        least sample_size bytes of it (if the file is long enough), or an
+        empty string if the rest of the file is ASCII-only.
+    """
+    rest = ""
+    for block in iter(lambda: csv_file.read(CSV_SCAN_BLOCK_SIZE), ""):
+        block = rest + block
+        match = NON_ASCII_RE.search(block)
+        if match is None:
+            # Keep the last incomplete line
+            rest = block[block.rfind("\n") + 1:]
+            continue
+        content = block[block.rfind("\n", 0, match.start()) + 1:]
+        if len(content) < sample_size:
+            content += csv_file.read(sample_size - len(content))
+        return content
+    return ""
+
+def analyze_csv_file(file_path, line_limit=None, sample_size=CSV_SAMPLE_SIZE):
+    """
+    Determine dialect, header and encoding of a CSV file.
+
+    The analysis looks at a sample from the beginning of the file, so dialect
+    and header detection take a small and fixed amount of time and memory
+    regardless of the file size. A sample which is valid UTF-8 is reported as
+    such right away, otherwise chardet's detector is fed in chunks and stopped
+    as soon as it is confident. An ASCII-only sample says nothing about the
+    rest of the file, so in that case the encoding is detected from the
+    content around the first non-ASCII byte (reading up to the whole file).
+    Dialect and header detection only use the first CSV_SNIFF_LINES lines of
+    the sample.
+
+    Args:
+        file_path: Path of the CSV file.
+        line_limit: Maximum number of non-empty lines to include in the sample.
+        sample_size: Size of the sample in bytes. Lines are added until it is
+                     reached, the sample always ends with a complete line.
+    Returns:
+        A dict with a "success" key. If true, "data" holds a
+        CSVAnalysisResult, "error_msg" otherwise.
+    """
     try:
         csv_file = open(file_path, "r")
     except IOError as ioe:
@@ -275,40 +1780,56 @@ def analyze_csv_file(file_path, line_limit=None):
                                                                  ioe.strerror)
         return {"success": False, "error_msg": error_msg}
 
-    content = ""
-
-    blanks = 0
-    lines_processed = 0
-    for line in csv_file:
-        if line.strip(): # omit blank lines
-            content += line
-            lines_processed += 1
-            if line_limit and lines_processed > line_limit:
+    with csv_file:
+        lines = []
+        blanks = 0
+        size = 0
+        for line in iter(csv_file.readline, ""):
+            size += len(line)
+            if line.strip(): # omit blank lines
+                lines.append(line)
+                if line_limit and len(lines) > line_limit:
+                    break
+            else:
+                blanks += 1
+            if size >= sample_size:
                 break
-        else:
-            blanks += 1
+        content = "".join(lines)
 
-    if chardet:
-        chardet_result = chardet.detect(content)
-        enc = chardet_result["encoding"]
-        enc_conf = chardet_result["confidence"]
-    else:
-        enc = None
-        enc_conf = None
+        enc, enc_conf = _detect_encoding(content)
+        if enc == "utf-8" and NON_ASCII_RE.search(content) is None:
+            rest = _find_non_ascii(csv_file, sample_size)
+            if rest:
+                enc, enc_conf = _detect_encoding(rest)
 
     sniffer = csv.Sniffer()
+    sniff_sample = "".join(lines[:CSV_SNIFF_LINES])
     try:
-        dialect = sniffer.sniff(content)
-        has_header = sniffer.has_header(content)
+        dialect = sniffer.sniff(sniff_sample)
+        has_header = sniffer.has_header(sniff_sample)
     except csv.Error as csve:
         error_msg = ("Error: An error occured while analyzing the file: '" +
                      csve.message + "'. Maybe it is no valid CSV file?")
         return {"success": False, "error_msg": error_msg}
-    result = CSVAnalysisResult(blanks, dialect, has_header, enc, enc_conf)
-    csv_file.close()
+    result = CSVAnalysisResult(blanks, dialect, has_header, enc, enc_conf,
+                               content)
     return {"success": True, "data": result}
-    
+
 def get_csv_file_content(file_name, enc=None):
+    header, rows = stream_csv_file_content(file_name, enc)
+    return (header, list(rows))
+
+def stream_csv_file_content(file_name, enc=None):
+    """
+    Open a CSV file for reading row by row.
+
+    Works like get_csv_file_content, but the content rows are not read
+    into memory. The file is closed once the last row has been consumed.
+
+    Returns:
+        A tuple of the header (a list containing the header row or an empty
+        list) and a generator over the remaining rows.
+    """
     result = analyze_csv_file(file_name, 500)
     if result["success"]:
         csv_analysis = result["data"]
@@ -330,15 +1851,19 @@ def get_csv_file_content(file_name, enc=None):
     
     csv_file = open(file_name, "r")
 
-    content = []
     reader = UnicodeReader(csv_file, dialect=dialect, encoding=enc)
     header = []
     if csv_analysis.has_header:
         header.append(reader.next())
-    for row in reader:
-        content.append(row)
-    csv_file.close()
-    return (header, content)
+
+    def content():
+        try:
+            for row in reader:
+                yield row
+        finally:
+            csv_file.close()
+
+    return (header, content())
     
 def has_value(field):
     return len(field) > 0 and field != "NA"
@@ -348,17 +1873,12 @@ def oai_harvest(basic_url, metadata_prefix=None, oai_set=None, processing=None,
     Harvest OpenAPC records via OAI-PMH
     """
     if selective_harvest:
-        # create lists of all exisiting dois, pmids and urls
+        # create sets of all exisiting dois, pmids and urls
         keys = ["doi", "pmid", "url"]
         lists = {}
+        core_table = OpenAPCTable.load("../data/apc_de.csv")
         for key in keys:
-            lists[key] = []
-        with open("../data/apc_de.csv", "r") as core_file:
-            reader = UnicodeDictReader(core_file, encoding="utf-8")
-            for line in reader:
-                for key in keys:
-                    if has_value(line[key]):
-                        lists[key].append(line[key])
+            lists[key] = set([value for value in core_table.index(key) if has_value(value)])
     collection_xpath = ".//oai_2_0:record//oai_2_0:metadata//intact:collection"
     token_xpath = ".//oai_2_0:resumptionToken"
     processing_regex = re.compile("'(?P<target>\w*?)':'(?P<generator>.*?)'")
@@ -400,9 +1920,9 @@ def oai_harvest(basic_url, metadata_prefix=None, oai_set=None, processing=None,
     articles = [collection_content.values()] # use as header
     while url is not None:
         try:
-            request = urllib2.Request(url)
+            request_url = url
             url = None
-            response = urllib2.urlopen(request)
+            response = http_client.request(request_url)
             content_string = response.read()
             root = ET.fromstring(content_string)
             collections = root.findall(collection_xpath, namespaces)
@@ -475,6 +1995,9 @@ def get_metadata_from_crossref(doi_string):
         If data extraction failed, 'success' will be False and the dict will
         contain a second entry 'error_msg' with a string value
         stating the reason.
+
+        If a metadata_cache is set, the result is taken from the cache when
+        possible.
     """
     xpaths = {
         ".//cr_qr:crm-item[@name='publisher-name']": "publisher",
@@ -497,12 +2020,16 @@ def get_metadata_from_crossref(doi_string):
     if doi is None:
         error_msg = u"Parse Error: '{}' is no valid DOI".format(doi_string)
         return {"success": False, "error_msg": error_msg}
-    url = 'http://data.crossref.org/' + doi
+    if metadata_cache is not None:
+        cached_result = metadata_cache.get("crossref", doi)
+        if cached_result is not None:
+            return cached_result
+    url = CROSSREF_URL + doi
     headers = {"Accept": "application/vnd.crossref.unixsd+xml"}
-    req = urllib2.Request(url, None, headers)
     ret_value = {'success': True}
+    not_found = False
     try:
-        response = urllib2.urlopen(req)
+        response = http_client.request(url, headers)
         content_string = response.read()
         root = ET.fromstring(content_string)
         doi_element = root.findall(".//cr_qr:doi", namespaces)
@@ -521,6 +2048,7 @@ def get_metadata_from_crossref(doi_string):
         ret_value['data'] = crossref_data
     except urllib2.HTTPError as httpe:
         ret_value['success'] = False
+        not_found = httpe.getcode() == 404
         code = str(httpe.getcode())
         ret_value['error_msg'] = "HTTPError: {} - {}".format(code, httpe.reason)
     except urllib2.URLError as urle:
@@ -532,20 +2060,193 @@ def get_metadata_from_crossref(doi_string):
     except ValueError as ve:
         ret_value['success'] = False
         ret_value['error_msg'] = str(ve)
+    if metadata_cache is not None and (ret_value['success'] or not_found):
+        metadata_cache.put("crossref", doi, ret_value, not_found)
     return ret_value
 
+# Names of DOI prefix owners as reported by the Crossref REST API
+crossref_prefix_names = LRUCache(1000)
+
+def get_crossref_prefix_name(prefix):
+    """
+    Look up the name of a DOI prefix owner in Crossref (f.e. 10.1007 ->
+    Springer Nature). Returns None if the lookup failed.
+    """
+    name = crossref_prefix_names.get(prefix)
+    if name is not None:
+        return name
+    url = CROSSREF_PREFIXES_URL + prefix
+    try:
+        response = http_client.request(url, {"Accept": "application/json"})
+        name = json.loads(response.read())["message"]["name"]
+    except (urllib2.URLError, ValueError, KeyError, TypeError) as e:
+        msg = u"Crossref: Could not determine the name of prefix %s: %s"
+        logging.debug(msg, prefix, e)
+        return None
+    crossref_prefix_names.put(prefix, name)
+    return name
+
+# The metadata_cache source of results from the Crossref REST API
+CROSSREF_REST_CACHE_SOURCE = "crossref_rest"
+
+def _crossref_work_to_result(work):
+    """
+    Convert a work record from the Crossref REST API to the result format
+    of get_metadata_from_crossref.
+    """
+    doi_type = work.get("type")
+    if doi_type != "journal-article":
+        msg = ("Unsupported DOI type '" + str(doi_type) + "' (OpenAPC " +
+               "only supports journal articles)")
+        return {"success": False, "error_msg": msg}
+    def first(values):
+        return values[0] if values else None
+    issn_types = work.get("issn-type", [])
+    prefix = work.get("prefix")
+    crossref_data = {
+        "publisher": work.get("publisher"),
+        "prefix": get_crossref_prefix_name(prefix) if prefix else None,
+        "journal_full_title": first(work.get("container-title")),
+        "issn": first(work.get("ISSN")),
+        "issn_print": first([issn["value"] for issn in issn_types
+                             if issn.get("type") == "print"]),
+        "issn_electronic": first([issn["value"] for issn in issn_types
+                                  if issn.get("type") == "electronic"]),
+        "license_ref": first([lic["URL"] for lic in work.get("license", [])
+                              if "URL" in lic])
+    }
+    return {"success": True, "data": crossref_data}
+
+def get_metadata_from_crossref_batch(doi_strings, batch_size=50):
+    """
+    Look up metadata for many DOIs in crossref with as few requests as possible.
+
+    This method uses the works endpoint of the Crossref REST API, which is
+    able to filter for several DOIs in a single query. The DOIs are
+    deduplicated and resolved in groups of batch_size. DOIs present in the
+    metadata_cache are not requested again, new results are added to it.
+
+    Args:
+        doi_strings: An iterable of DOI strings, in any notation accepted by
+                     get_metadata_from_crossref.
+        batch_size: The maximum number of DOIs to resolve in one request.
+    Returns:
+        A dict mapping normalised, lower-cased DOIs to result dicts as
+        returned by get_metadata_from_crossref. Note that the 'prefix' value
+        is the name of the prefix owner as known to the REST API. As the
+        fields are derived differently, results are cached separately from
+        those of get_metadata_from_crossref (as "crossref_rest"). DOIs which
+        could not be resolved in a batch (not indexed by the works endpoint,
+        not parseable or a failed request) are not contained, callers should
+        fall back to get_metadata_from_crossref for them.
+    """
+    results = {}
+    dois = OrderedDict()
+    for doi_string in doi_strings:
+        doi = get_normalised_DOI(doi_string)
+        # Commas separate filter values and cannot be escaped
+        if doi is None or "," in doi:
+            continue
+        key = doi.lower()
+        if key in results or key in dois:
+            continue
+        if metadata_cache is not None:
+            cached_result = metadata_cache.get(CROSSREF_REST_CACHE_SOURCE, doi)
+            if cached_result is not None:
+                results[key] = cached_result
+                continue
+        dois[key] = doi
+    keys = dois.keys()
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        doi_filter = ",".join(["doi:" + urllib.quote(dois[key], safe="/:")
+                               for key in batch])
+        url = (CROSSREF_WORKS_URL + "?rows=" + str(len(batch)) +
+               "&filter=" + doi_filter)
+        try:
+            response = http_client.request(url, {"Accept": "application/json"})
+            works = json.loads(response.read())["message"]["items"]
+        except urllib2.HTTPError as httpe:
+            msg = "Crossref: Batch lookup of %s DOIs failed (HTTPError: %s - %s)"
+            logging.warning(msg, len(batch), httpe.getcode(), httpe.reason)
+            continue
+        except urllib2.URLError as urle:
+            msg = "Crossref: Batch lookup of %s DOIs failed (URLError: %s)"
+            logging.warning(msg, len(batch), urle.reason)
+            continue
+        except (ValueError, KeyError, TypeError) as e:
+            msg = "Crossref: Batch lookup of %s DOIs failed (Invalid JSON: %s)"
+            logging.warning(msg, len(batch), e)
+            continue
+        for work in works:
+            key = work.get("DOI", "").lower()
+            if key not in dois:
+                continue
+            results[key] = _crossref_work_to_result(work)
+            if metadata_cache is not None and results[key]["success"]:
+                metadata_cache.put(CROSSREF_REST_CACHE_SOURCE, key, results[key])
+    return results
+
+def prefetch_doi_metadata(numbered_rows, doi_index, batch_size=50,
+                          crossref_results=None, pubmed_results=None):
+    """
+    Resolve the DOIs of rows in batches, ahead of their processing.
+
+    A generator which passes (row_num, row) tuples through unchanged. Before
+    a group of batch_size rows is handed on, the DOIs found in these rows are
+    resolved with a single batch request and the results are stored in the
+    given dict, which can be passed on to process_row.
+
+    Args:
+        numbered_rows: An iterable of (row_num, row) tuples.
+        doi_index: The index of the DOI column in a row.
+        batch_size: The number of rows to collect DOIs from for one batch.
+        crossref_results: If not None, a dict which will be updated with the
+                          results of get_metadata_from_crossref_batch.
+        pubmed_results: If not None, a dict which will be updated with the
+                        results of get_metadata_from_pubmed_batch.
+    """
+    window = []
+    for numbered_row in numbered_rows:
+        window.append(numbered_row)
+        if len(window) < batch_size:
+            continue
+        _prefetch_window(window, doi_index, batch_size, crossref_results,
+                         pubmed_results)
+        for item in window:
+            yield item
+        window = []
+    if window:
+        _prefetch_window(window, doi_index, batch_size, crossref_results,
+                         pubmed_results)
+        for item in window:
+            yield item
+
+def _prefetch_window(window, doi_index, batch_size, crossref_results,
+                     pubmed_results):
+    dois = [row[doi_index] for _, row in window if len(row) > doi_index]
+    if crossref_results is not None:
+        crossref_results.update(get_metadata_from_crossref_batch(dois,
+                                                                 batch_size))
+    if pubmed_results is not None:
+        pubmed_results.update(get_metadata_from_pubmed_batch(dois,
+                                                             batch_size))
+
 def get_metadata_from_pubmed(doi_string):
     doi = get_normalised_DOI(doi_string)
     if doi is None:
         return {"success": False,
                 "error_msg": u"Parse Error: '{}' is no valid DOI".format(doi_string)
                }
-    url = "http://www.ebi.ac.uk/europepmc/webservices/rest/search?query=doi:"
-    url += doi
-    req = urllib2.Request(url)
+    if metadata_cache is not None:
+        cached_result = metadata_cache.get("pubmed", doi)
+        if cached_result is not None:
+            return cached_result
+    url = EUROPE_PMC_SEARCH_URL + "?query=doi:" + doi
     ret_value = {'success': True}
+    not_found = False
     try:
-        response = urllib2.urlopen(req)
+        response = http_client.request(url)
         content_string = response.read()
         root = ET.fromstring(content_string)
         pubmed_data = {}
@@ -562,13 +2263,93 @@ def get_metadata_from_pubmed(doi_string):
         ret_value['data'] = pubmed_data
     except urllib2.HTTPError as httpe:
         ret_value['success'] = False
+        not_found = httpe.getcode() == 404
         code = str(httpe.getcode())
         ret_value['error_msg'] = "HTTPError: {} - {}".format(code, httpe.reason)
     except urllib2.URLError as urle:
         ret_value['success'] = False
         ret_value['error_msg'] = "URLError: {}".format(urle.reason)
+    if metadata_cache is not None and (ret_value['success'] or not_found):
+        metadata_cache.put("pubmed", doi, ret_value, not_found)
     return ret_value
 
+def get_metadata_from_pubmed_batch(doi_strings, batch_size=50):
+    """
+    Look up PMIDs and PMCIDs for many DOIs with as few requests as possible.
+
+    The DOIs are deduplicated and combined into Europe PMC search queries
+    of batch_size DOIs each (DOI:"a" OR DOI:"b" ...). Result pages are
+    followed with cursor marks. DOIs present in the metadata_cache are not
+    requested again, new results are added to it.
+
+    Args:
+        doi_strings: An iterable of DOI strings, in any notation accepted by
+                     get_metadata_from_pubmed.
+        batch_size: The maximum number of DOIs to combine in one query.
+    Returns:
+        A dict mapping normalised, lower-cased DOIs to result dicts as
+        returned by get_metadata_from_pubmed. DOIs from a failed request are
+        not contained, callers should fall back to get_metadata_from_pubmed
+        for them.
+    """
+    results = {}
+    dois = OrderedDict()
+    for doi_string in doi_strings:
+        doi = get_normalised_DOI(doi_string)
+        if doi is None or '"' in doi:
+            continue
+        key = doi.lower()
+        if key in results or key in dois:
+            continue
+        if metadata_cache is not None:
+            cached_result = metadata_cache.get("pubmed", doi)
+            if cached_result is not None:
+                results[key] = cached_result
+                continue
+        dois[key] = doi
+    keys = dois.keys()
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        query = " OR ".join(['DOI:"' + dois[key] + '"' for key in batch])
+        batch_data = {}
+        cursor = "*"
+        try:
+            while cursor is not None:
+                url = (EUROPE_PMC_SEARCH_URL + "?format=json&resultType=lite" +
+                       "&pageSize=1000&cursorMark=" + urllib.quote(cursor) +
+                       "&query=" + urllib.quote(query))
+                response = http_client.request(url)
+                json_dict = json.loads(response.read())
+                hits = json_dict["resultList"]["result"]
+                for hit in hits:
+                    key = hit.get("doi", "").lower()
+                    # Like get_metadata_from_pubmed, use the first result
+                    if key in dois and key not in batch_data:
+                        batch_data[key] = {"pmid": hit.get("pmid"),
+                                           "pmcid": hit.get("pmcid")}
+                next_cursor = json_dict.get("nextCursorMark")
+                if not hits or next_cursor == cursor:
+                    next_cursor = None
+                cursor = next_cursor
+        except urllib2.HTTPError as httpe:
+            msg = "Pubmed: Batch lookup of %s DOIs failed (HTTPError: %s - %s)"
+            logging.warning(msg, len(batch), httpe.getcode(), httpe.reason)
+            continue
+        except urllib2.URLError as urle:
+            msg = "Pubmed: Batch lookup of %s DOIs failed (URLError: %s)"
+            logging.warning(msg, len(batch), urle.reason)
+            continue
+        except (ValueError, KeyError, TypeError) as e:
+            msg = "Pubmed: Batch lookup of %s DOIs failed (Invalid JSON: %s)"
+            logging.warning(msg, len(batch), e)
+            continue
+        for key in batch:
+            data = batch_data.get(key, {"pmid": None, "pmcid": None})
+            results[key] = {"success": True, "data": data}
+            if metadata_cache is not None:
+                metadata_cache.put("pubmed", key, results[key])
+    return results
+
 def lookup_journal_in_doaj(issn, bypass_cert_verification=False):
     """
     Take an ISSN and check if the corresponding journal exists in DOAJ.
@@ -600,14 +2381,9 @@ def lookup_journal_in_doaj(issn, bypass_cert_verification=False):
     """
     headers = {"Accept": "application/json"}
     ret_value = {'data_received': True}
-    url = "https://doaj.org/api/v1/search/journals/issn:" + issn
-    req = urllib2.Request(url, None, headers)
+    url = DOAJ_JOURNAL_SEARCH_URL + "issn:" + issn
     try:
-        if bypass_cert_verification:
-            empty_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            response = urllib2.urlopen(req, context=empty_context)
-        else:
-            response = urllib2.urlopen(req)
+        response = http_client.request(url, headers, bypass_cert_verification)
         content_string = response.read()
         json_dict = json.loads(content_string)
         ret_data = {}
@@ -635,7 +2411,8 @@ def lookup_journal_in_doaj(issn, bypass_cert_verification=False):
 def process_row(row, row_num, column_map, num_required_columns,
                 no_crossref_lookup=False, no_pubmed_lookup=False,
                 no_doaj_lookup=False, doaj_offline_analysis=False,
-                bypass_cert_verification=False):
+                bypass_cert_verification=False, crossref_results=None,
+                pubmed_results=None):
     """
     Enrich a single row of data and reformat it according to Open APC standards.
 
@@ -661,6 +2438,13 @@ def process_row(row, row_num, column_map, num_required_columns,
         bypass_cert_verification: If true, certificate validation will be
                                   skipped when connecting to metadata
                                   providers via TLS.
+        crossref_results: An optional dict of pre-resolved crossref results,
+                          as returned by get_metadata_from_crossref_batch.
+                          The crossref API is only queried if the row's DOI
+                          is missing from it.
+        pubmed_results: An optional dict of pre-resolved pubmed results, as
+                        returned by get_metadata_from_pubmed_batch. Works
+                        like crossref_results.
 
      Returns:
         A list of values which represents the enriched and re-arranged variant
@@ -738,11 +2522,15 @@ def process_row(row, row_num, column_map, num_required_columns,
             logging.warning(msg)
         # include crossref metadata
         if not no_crossref_lookup:
-            crossref_result = get_metadata_from_crossref(doi)
+            crossref_result = None
+            if crossref_results and norm_doi is not None:
+                crossref_result = crossref_results.get(norm_doi.lower())
+            if crossref_result is None:
+                crossref_result = get_metadata_from_crossref(doi)
             if crossref_result["success"]:
                 logging.info("Crossref: DOI resolved: " + doi)
                 current_row["indexed_in_crossref"] = "TRUE"
-                data = crossref_result["data"]
+                data = dict(crossref_result["data"])
                 prefix = data.pop("prefix")
                 for key, value in data.iteritems():
                     if value is not None:
@@ -793,14 +2581,18 @@ def process_row(row, row_num, column_map, num_required_columns,
                                "doi %s.")
                         logging.debug(msg, key, doi)
                     old_value = current_row[key]
-                    current_row[key] = column_map[key].check_overwrite(old_value, new_value)
+                    current_row[key] = column_map[key].check_overwrite(old_value, new_value, row_num)
             else:
                 msg = "Line %s: Crossref: Error while trying to resolve DOI %s: %s"
                 logging.error(msg, row_num, doi, crossref_result["error_msg"])
                 current_row["indexed_in_crossref"] = "FALSE"
         # include pubmed metadata
         if not no_pubmed_lookup:
-            pubmed_result = get_metadata_from_pubmed(doi)
+            pubmed_result = None
+            if pubmed_results and norm_doi is not None:
+                pubmed_result = pubmed_results.get(norm_doi.lower())
+            if pubmed_result is None:
+                pubmed_result = get_metadata_from_pubmed(doi)
             if pubmed_result["success"]:
                 logging.info("Pubmed: DOI resolved: " + doi)
                 data = pubmed_result["data"]
@@ -813,7 +2605,7 @@ def process_row(row, row_num, column_map, num_required_columns,
                                "doi %s.")
                         logging.debug(msg, key, doi)
                     old_value = current_row[key]
-                    current_row[key] = column_map[key].check_overwrite(old_value, new_value)
+                    current_row[key] = column_map[key].check_overwrite(old_value, new_value, row_num)
             else:
                 msg = "Line %s: Pubmed: Error while trying to resolve DOI %s: %s"
                 logging.error(msg, row_num, doi, pubmed_result["error_msg"])
@@ -833,13 +2625,28 @@ def process_row(row, row_num, column_map, num_required_columns,
             # temporarily to prevent the DOAJ lookup from failing.
             if re.match("^\d{7}[\dxX]$", issn):
                 issn = issn[:4] + "-" + issn[4:]
-            # look up in an offline copy of the DOAJ if requested...
+            # Journals repeat a lot, so try the results of earlier rows first
+            doaj_data = doaj_lookup_memo.get(issn)
+            if doaj_data is None:
+                # look up in an offline copy of the DOAJ if requested...
+                if doaj_offline_analysis:
+                    title = doaj_offline_analysis.lookup(issn)
+                    doaj_data = {"in_doaj": title is not None, "title": title}
+                # ...or query the online API
+                else:
+                    doaj_res = lookup_journal_in_doaj(issn, bypass_cert_verification)
+                    if not doaj_res["data_received"]:
+                        msg = (u"Line %s: DOAJ: Error while trying to look up " +
+                               "ISSN %s: %s")
+                        logging.error(msg, row_num, issn, doaj_res["error_msg"])
+                        continue
+                    doaj_data = doaj_res["data"]
+                doaj_lookup_memo.put(issn, doaj_data)
             if doaj_offline_analysis:
-                lookup_result = doaj_offline_analysis.lookup(issn)
-                if lookup_result:
+                if doaj_data["in_doaj"]:
                     msg = (u"DOAJ: Journal ISSN (%s) found in DOAJ " +
                            "offline copy ('%s').")
-                    logging.info(msg, issn, lookup_result)
+                    logging.info(msg, issn, doaj_data["title"])
                     new_value = "TRUE"
                     break
                 else:
@@ -847,28 +2654,76 @@ def process_row(row, row_num, column_map, num_required_columns,
                            "offline copy.")
                     new_value = "FALSE"
                     logging.info(msg, issn)
-            # ...or query the online API
             else:
-                doaj_res = lookup_journal_in_doaj(issn, bypass_cert_verification)
-                if doaj_res["data_received"]:
-                    if doaj_res["data"]["in_doaj"]:
-                        msg = u"DOAJ: Journal ISSN (%s) found in DOAJ ('%s')."
-                        logging.info(msg, issn, doaj_res["data"]["title"])
-                        new_value = "TRUE"
-                        break
-                    else:
-                        msg = u"DOAJ: Journal ISSN (%s) not found in DOAJ."
-                        logging.info(msg, issn)
-                        new_value = "FALSE"
+                if doaj_data["in_doaj"]:
+                    msg = u"DOAJ: Journal ISSN (%s) found in DOAJ ('%s')."
+                    logging.info(msg, issn, doaj_data["title"])
+                    new_value = "TRUE"
+                    break
                 else:
-                    msg = (u"Line %s: DOAJ: Error while trying to look up " +
-                           "ISSN %s: %s")
-                    logging.error(msg, row_num, issn, doaj_res["error_msg"])
+                    msg = u"DOAJ: Journal ISSN (%s) not found in DOAJ."
+                    logging.info(msg, issn)
+                    new_value = "FALSE"
         old_value = current_row["doaj"]
         current_row["doaj"] = column_map["doaj"].check_overwrite(old_value,
-                                                                 new_value)
+                                                                 new_value,
+                                                                 row_num)
     return current_row.values()
 
+def _process_numbered_row(row, row_num, column_map, num_required_columns,
+                          kwargs):
+    # Announce the row in the thread doing the lookups, so the messages
+    # logged for it follow this line
+    print "---Processing line number " + str(row_num) + "---"
+    return process_row(row, row_num, column_map, num_required_columns,
+                       **kwargs)
+
+def process_rows(numbered_rows, column_map, num_required_columns, workers=1,
+                 **kwargs):
+    """
+    Enrich a sequence of rows, optionally using a pool of worker threads.
+
+    This is a wrapper around process_row. Since the enrichment process is
+    dominated by waiting for metadata APIs, several rows can be processed at
+    once by worker threads. Results are always yielded in input order, the
+    number of rows in flight is bounded to a small multiple of the number of
+    workers.
+
+    Args:
+        numbered_rows: An iterable of (row_num, row) tuples.
+        column_map: An OrderedDict of CSVColumn Objects, see process_row.
+        num_required_columns: The required length of a row, see process_row.
+        workers: The number of rows to be processed concurrently. 1 means
+                 sequential processing in the calling thread.
+        kwargs: Any additional keyword arguments will be passed to
+                process_row.
+    Yields:
+        (row_num, enriched_row) tuples in the same order as numbered_rows.
+    """
+    if workers <= 1:
+        for row_num, row in numbered_rows:
+            yield row_num, _process_numbered_row(row, row_num, column_map,
+                                                 num_required_columns, kwargs)
+        return
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for row_num, row in numbered_rows:
+            async_result = pool.apply_async(_process_numbered_row,
+                                            (row, row_num, column_map,
+                                             num_required_columns, kwargs))
+            pending.append((row_num, async_result))
+            if len(pending) >= workers * 4:
+                row_num, async_result = pending.popleft()
+                yield row_num, async_result.get(POOL_GET_TIMEOUT)
+        while pending:
+            row_num, async_result = pending.popleft()
+            yield row_num, async_result.get(POOL_GET_TIMEOUT)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
 
 def get_column_type_from_whitelist(column_name):
     """
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import argparse
+from collections import OrderedDict
+import csv
+import os
+import sys
+
+import openapc_toolkit as oat
+
+ARG_HELP_STRINGS = {
+    "csv_file": "The enriched CSV file created by apc_csv_processing.py " +
+                "(default: out.csv)",
+    "conflicts_file": "The side file containing the deferred conflicts " +
+                      "(default: the name of the CSV file followed by " +
+                      "'.conflicts')",
+    "overwrite": "Do not ask, always replace existing values by the " +
+                 "imported ones."
+}
+
+_GROUP_MSG = (u"\033[91mConflict\033[0m in \033[93m{count}\033[0m line(s) " +
+              u"({lines}): Existing non-NA value \033[93m{ov}\033[0m in " +
+              u"column \033[93m{name}\033[0m is to be replaced by new value " +
+              u"\033[93m{nv}\033[0m.\nAllow overwrite?\n1) Yes, in all of " +
+              u"these lines\n2) Yes, and always overwrite in this column\n3) " +
+              u"No, keep the existing value in all of these lines\n4) No, and " +
+              u"never overwrite in this column\n5) Decide line by line\n>")
+
+_LINE_MSG = u"Line {line}: Replace \033[93m{ov}\033[0m by \033[93m{nv}\033[0m? (y/n):"
+
+def ask(msg, choices):
+    ret = raw_input(msg.encode("utf-8"))
+    while ret not in choices:
+        ret = raw_input("Please type one of " + ", ".join(choices) + ":")
+    return ret
+
+def group_conflicts(conflicts):
+    """
+    Group conflicts by column, old and new value.
+
+    Returns:
+        An OrderedDict mapping (column, old, new) tuples to the list of
+        output line numbers the conflict occured in.
+    """
+    groups = OrderedDict()
+    for conflict in conflicts:
+        key = (conflict["column"], conflict["old"], conflict["new"])
+        groups.setdefault(key, []).append(conflict["line"])
+    return groups
+
+def decide(groups, always_overwrite=False):
+    """
+    Ask the user how to resolve each group of conflicts.
+
+    Returns:
+        A dict mapping output line numbers to lists of (column, old, new)
+        tuples, containing all conflicts where the new value was accepted.
+    """
+    column_decisions = {}
+    accepted = {}
+    for (column, old_value, new_value), lines in groups.iteritems():
+        if always_overwrite:
+            decision = "1"
+        elif column in column_decisions:
+            decision = column_decisions[column]
+        else:
+            line_list = ", ".join([str(line) for line in lines[:10]])
+            if len(lines) > 10:
+                line_list += ", ..."
+            msg = _GROUP_MSG.format(count=len(lines), lines=line_list,
+                                    ov=old_value, name=column, nv=new_value)
+            decision = ask(msg, ["1", "2", "3", "4", "5"])
+            if decision == "2":
+                column_decisions[column] = "1"
+            elif decision == "4":
+                column_decisions[column] = "3"
+        for line in lines:
+            if decision in ["1", "2"]:
+                replace = True
+            elif decision in ["3", "4"]:
+                replace = False
+            else:
+                msg = _LINE_MSG.format(line=line, ov=old_value, nv=new_value)
+                replace = ask(msg, ["y", "n"]) == "y"
+            if replace:
+                accepted.setdefault(line, []).append((column, old_value, new_value))
+    return accepted
+
+# Columns the doaj value is derived from
+DOAJ_SOURCE_COLUMNS = ["issn", "issn_print", "issn_electronic"]
+
+def _read_records(csv_file):
+    """
+    Parse a CSV file record by record, keeping the raw text of each record
+    (which may span several lines if a quoted value contains a line break).
+
+    Returns:
+        A generator of (record number, values, raw text) tuples.
+    """
+    raw_lines = []
+    def lines():
+        for line in csv_file:
+            raw_lines.append(line)
+            yield line
+    for record_num, values in enumerate(csv.reader(lines()), 1):
+        yield record_num, values, "".join(raw_lines)
+        del raw_lines[:]
+
+def patch_csv_file(csv_file, accepted):
+    """
+    Apply accepted conflicts to an enriched CSV file in a single pass.
+
+    Records without accepted conflicts are copied unchanged. A replacement is
+    skipped if the value found in the file is not the expected old value
+    anymore (f.e. if the file has already been patched).
+
+    The doaj value is not looked up again. If an ISSN of a record is
+    replaced, the record is reported instead, as its doaj value might be
+    outdated.
+
+    Args:
+        csv_file: The enriched CSV file.
+        accepted: A dict as returned by decide, mapping record numbers (the
+                  header being record 1) to accepted replacements.
+
+    Returns:
+        A tuple of the number of changed records and a list of the numbers
+        of records with a replaced ISSN.
+    """
+    tmp_file = csv_file + ".tmp"
+    changed = 0
+    issn_changed = []
+    with open(csv_file, "rb") as source, open(tmp_file, "wb") as target:
+        writer = oat.OpenAPCUnicodeWriter(target, oat.OPENAPC_QUOTEMASK, True, False)
+        header = None
+        for record_num, values, raw in _read_records(source):
+            if header is None:
+                header = [unicode(value, "utf-8") for value in values]
+            if record_num not in accepted:
+                target.write(raw)
+                continue
+            row = [unicode(value, "utf-8") for value in values]
+            replaced = []
+            for column, old_value, new_value in accepted[record_num]:
+                index = header.index(column)
+                if row[index] != old_value:
+                    msg = u"Line {}: Expected '{}' in column {}, found '{}' - skipped."
+                    oat.print_y(msg.format(record_num, old_value, column, row[index]))
+                    continue
+                row[index] = new_value
+                replaced.append(column)
+            writer.write_rows([row])
+            changed += 1
+            if set(replaced) & set(DOAJ_SOURCE_COLUMNS):
+                issn_changed.append(record_num)
+    try:
+        os.rename(tmp_file, csv_file)
+    except OSError:
+        # Windows does not replace existing files on rename
+        os.remove(csv_file)
+        os.rename(tmp_file, csv_file)
+    return changed, issn_changed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_file", nargs="?", default="out.csv",
+                        help=ARG_HELP_STRINGS["csv_file"])
+    parser.add_argument("-c", "--conflicts-file",
+                        help=ARG_HELP_STRINGS["conflicts_file"])
+    parser.add_argument("-o", "--overwrite", action="store_true",
+                        help=ARG_HELP_STRINGS["overwrite"])
+    args = parser.parse_args()
+
+    conflicts_file = args.conflicts_file or args.csv_file + ".conflicts"
+    if not os.path.isfile(conflicts_file):
+        oat.print_r("Error: " + conflicts_file + " does not seem to be a file!")
+        sys.exit()
+
+    conflicts = oat.ConflictLog.load(conflicts_file)
+    groups = group_conflicts(conflicts)
+    msg = "{} deferred conflicts found, {} distinct replacements."
+    oat.print_b(msg.format(len(conflicts), len(groups)))
+
+    accepted = decide(groups, args.overwrite)
+    if not accepted:
+        oat.print_g("No replacements accepted, " + args.csv_file + " remains unchanged.")
+        return
+    changed, issn_changed = patch_csv_file(args.csv_file, accepted)
+    oat.print_g("{} lines in {} updated.".format(changed, args.csv_file))
+    if issn_changed:
+        msg = ("The ISSNs in {} line(s) ({}) were replaced, their doaj value " +
+               "might be outdated. Please check it or enrich these lines again.")
+        line_list = ", ".join([str(line) for line in issn_changed[:10]])
+        if len(issn_changed) > 10:
+            line_list += ", ..."
+        oat.print_y(msg.format(len(issn_changed), line_list))
+
+if __name__ == '__main__':
+    main()
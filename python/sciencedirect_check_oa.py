@@ -3,10 +3,10 @@
 
 import argparse
 import codecs
+import itertools
 import logging
 import re
 import sys
-import time
 import urllib2
 
 import openapc_toolkit as oat
@@ -64,8 +64,8 @@ def main():
             oat.print_r(msg)
             sys.exit()
 
-    head, content = oat.get_csv_file_content(args.csv_file, enc)
-    content = head + content
+    head, content = oat.stream_csv_file_content(args.csv_file, enc)
+    content = itertools.chain(head, content)
 
     header = {"User-Agent": "Mozilla/5.0 Firefox/45.0"}
 
@@ -88,10 +88,8 @@ def main():
                     "{}...").format(line_num, institution, period, journal)
         oat.print_b(init_msg)
         url = 'http://doi.org/' + doi
-        req = urllib2.Request(url, None, header)
-        ret_value = {'success': True}
         try:
-            response = urllib2.urlopen(req)
+            response = oat.http_client.request(url, header)
             target = response.geturl()
             resolve_msg = u"DOI {} resolved, led us to {}".format(doi, target)
             if "sciencedirect.com" not in target:
@@ -114,7 +112,6 @@ def main():
                     error_msg = (u"No PDF link found! (line {}, DOI: {}, " +
                                  "landing page: {})").format(line_num, doi, target)
                     logging.error(error_msg)
-            time.sleep(1)
         except urllib2.HTTPError as httpe:
             code = str(httpe.getcode())
             oat.print_r("HTTPError: {} - {}".format(code, httpe.reason))
@@ -32,10 +32,14 @@
 import argparse
 import codecs
 import locale
+from multiprocessing import Pool
+import os
+import shutil
 import sys
+import tempfile
 import urllib2
 import xml.etree.ElementTree as ET
-from subprocess import call
+from subprocess import call, STDOUT
 from openpyxl import load_workbook
 import unicodecsv as csv
 import time
@@ -80,6 +84,11 @@ class Config(object):
         "headers": "Ignore any CSV headers (if present) and try to determine " +
                    "relevant columns heuristically.",
         "verbose": "Be more verbose during the cleaning process.",
+        "cache_dir": "Directory of the persistent DOI metadata cache shared with the enrichment process.",
+        "no_cache": "Do not use the persistent DOI metadata cache.",
+        "parallel": "Clean and enrich the institution files in this many parallel processes. Workers do not ask " +
+                    "questions: Unknown publisher names are left as they are and enrichment conflicts are " +
+                    "deferred and resolved afterwards. The master file is backed up and merged once at the end.",
     }
 
     ERROR_MSGS = {
@@ -107,6 +116,12 @@ class Config(object):
         parser.add_argument("-l", "--locale", help=self.ARG_HELP_STRINGS["locale"])
         parser.add_argument("-i", "--ignore-header", action="store_true",
                             help=self.ARG_HELP_STRINGS["headers"])
+        parser.add_argument("--cache-dir", default=oat.DEFAULT_CACHE_DIR,
+                            help=self.ARG_HELP_STRINGS["cache_dir"])
+        parser.add_argument("--no-cache", action="store_true",
+                            help=self.ARG_HELP_STRINGS["no_cache"])
+        parser.add_argument("-p", "--parallel", type=int, default=0, metavar="PROCESSES",
+                            help=self.ARG_HELP_STRINGS["parallel"])
 
         args = parser.parse_args()
 
@@ -142,6 +157,26 @@ def main():
     # Create a user interface object to interact with user
     cob_user_interface = UserInterface()
 
+    if args.parallel > 0:
+        # Clean and enrich all files in worker processes. The workers open their own cache connections, so this
+        # happens before the cache is opened here.
+        lst_enriched_file_names = cob_data_processor.process_files_in_parallel(lst_apc_files, args)
+
+    # Share the DOI metadata cache with the enrichment process
+    if not args.no_cache:
+        oat.metadata_cache = oat.MetadataCache(args.cache_dir)
+
+    if args.parallel > 0:
+        if lst_enriched_file_names:
+            # Let the user decide on the conflicts the workers deferred
+            for str_enriched_file_name in lst_enriched_file_names:
+                cob_data_processor.resolve_deferred_conflicts(str_enriched_file_name)
+
+            # Backup master file and add the new enriched data of all files at once
+            cob_file_manager.backup_master_file(Config.STR_APC_SE_FILE)
+            cob_data_processor.add_new_data_to_master_file(lst_enriched_file_names, cob_user_interface)
+        lst_apc_files = []
+
     # Process files one at a time
     for str_input_file_name in lst_apc_files:
 
@@ -149,14 +184,14 @@ def main():
         str_input_file_name, str_output_file_name, str_enriched_file_name = cob_file_manager.create_file_names(
             str_input_file_name)
 
-        # Read and clean data for one file
-        lst_cleaned_data = cob_data_processor.collect_apc_data(str_input_file_name, args)
+        # Read and clean data for one file, rows are streamed from the input file to the cleaned file
+        gen_cleaned_data = cob_data_processor.collect_apc_data(str_input_file_name, args)
 
         # Save the file for further processing - Write cleaned data to file
-        cob_data_processor.write_cleaned_data(str_output_file_name, lst_cleaned_data)
+        cob_data_processor.write_cleaned_data(str_output_file_name, gen_cleaned_data)
 
         # Run the German enrichment process and copy files
-        cob_data_processor.run_enrichment_process(str_output_file_name)
+        cob_data_processor.run_enrichment_process(str_output_file_name, args)
 
         # Copy Bielfeld out file to institution directory
         cob_file_manager.copy_enrichment_out(str_enriched_file_name)
@@ -165,7 +200,7 @@ def main():
         cob_file_manager.backup_master_file(Config.STR_APC_SE_FILE)
 
         # Add new enriched data to master file
-        cob_data_processor.add_new_data_to_master_file(str_enriched_file_name, cob_user_interface)
+        cob_data_processor.add_new_data_to_master_file([str_enriched_file_name], cob_user_interface)
 
     # Report errors
     if len(cob_data_processor.lst_error_messages) > 0:
@@ -178,6 +213,107 @@ def main():
 # ======================================================================================================================
 
 
+# ======================================================================================================================
+def init_worker(args):
+    """ Initialise a worker process of the parallel mode: Open an own connection to the DOI metadata cache """
+    if not args.no_cache:
+        oat.metadata_cache = oat.MetadataCache(args.cache_dir)
+
+# ======================================================================================================================
+
+
+# ======================================================================================================================
+def process_file_in_worker(tpl_task):
+    """ Clean and enrich one institution file without interacting with the user. The output of the cleaning and the
+    enrichment process is collected, so the main process can report it file by file.
+    :param tpl_task: Tuple of the file name (as in the file list) and the command line arguments
+    :return: Result dict, data holds the collected output and, on success, the enriched file name and a list of
+             messages for the user
+    """
+    str_file_name, args = tpl_task
+    str_work_dir = tempfile.mkdtemp(prefix='apc_se_')
+    fp_output = open(os.path.join(str_work_dir, 'output.log'), 'w+')
+    obj_stdout = sys.stdout
+    sys.stdout = OutputLog(fp_output)
+    try:
+        dct_result = clean_and_enrich_file(str_file_name, args, str_work_dir)
+    finally:
+        sys.stdout = obj_stdout
+        fp_output.seek(0)
+        str_output = fp_output.read()
+        fp_output.close()
+        shutil.rmtree(str_work_dir, ignore_errors=True)
+    dct_result['data']['output'] = str_output
+    return dct_result
+
+# ======================================================================================================================
+
+
+# ======================================================================================================================
+class OutputLog(object):
+    """ Stands in for sys.stdout in a worker process, unicode is written as UTF-8 like it would be to the terminal """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, fp_log):
+        """ """
+        self.fp_log = fp_log
+    # ------------------------------------------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def write(self, str_text):
+        if isinstance(str_text, unicode):
+            str_text = str_text.encode('utf-8')
+        self.fp_log.write(str_text)
+    # ------------------------------------------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __getattr__(self, str_name):
+        # flush, fileno (for the output of subprocesses) and the like
+        return getattr(self.fp_log, str_name)
+    # ------------------------------------------------------------------------------------------------------------------
+
+# ======================================================================================================================
+
+
+# ======================================================================================================================
+def clean_and_enrich_file(str_file_name, args, str_work_dir):
+    """ The work of process_file_in_worker, run with its output redirected
+    :param str_work_dir: Directory to run the enrichment process in
+    :return: Result dict, data holds the enriched file name and a list of messages for the user
+    """
+    cob_file_manager = FileManager()
+    cob_data_processor = DataProcessor()
+    cob_data_processor.bool_interactive = False
+    try:
+        str_input_file_name, str_output_file_name, str_enriched_file_name = cob_file_manager.create_file_names(
+            str_file_name)
+        gen_cleaned_data = cob_data_processor.collect_apc_data(str_input_file_name, args)
+        cob_data_processor.write_cleaned_data(str_output_file_name, gen_cleaned_data)
+        int_return_code = cob_data_processor.run_enrichment_process(str_output_file_name, args, str_work_dir)
+        str_out_file = os.path.join(str_work_dir, 'out.csv')
+        # The enrichment process does not always set an exit code when it stops
+        if int_return_code != 0 or not os.path.isfile(str_out_file):
+            raise RuntimeError('Enrichment process failed (exit code {})'.format(int_return_code))
+        cob_file_manager.copy_enrichment_out(str_enriched_file_name, str_out_file)
+        # Keep the deferred conflicts next to the enriched file, replacing those of an earlier run
+        str_conflicts_file = os.path.join(str_work_dir, 'out.csv.conflicts')
+        if os.path.isfile(str_enriched_file_name + '.conflicts'):
+            os.remove(str_enriched_file_name + '.conflicts')
+        if os.path.isfile(str_conflicts_file) and os.path.getsize(str_conflicts_file) > 0:
+            shutil.copy(str_conflicts_file, str_enriched_file_name + '.conflicts')
+    except SystemExit as e:
+        # The cleaning stops by calling sys.exit, f.e. on duplicate DOIs
+        return {'success': False, 'data': {},
+                'error_msg': '{}: Processing stopped ({})'.format(str_file_name, e.code or 'see its output')}
+    except Exception as e:
+        return {'success': False, 'data': {}, 'error_msg': '{}: {}: {}'.format(str_file_name, type(e).__name__, e)}
+    return {'success': True, 'data': {'file': str_enriched_file_name,
+                                      'messages': cob_data_processor.lst_worker_messages},
+            'error_msg': None}
+
+# ======================================================================================================================
+
+
 # ======================================================================================================================
 class DataProcessor(object):
     """ Data cleaning and processing """
@@ -186,53 +322,97 @@ class DataProcessor(object):
     lst_error_messages = []
 
     # ------------------------------------------------------------------------------------------------------------------
-    def add_new_data_to_master_file(self, str_enriched_file_name, cob_user_interface):
-        """ Check how much of the newly enriched data that should be added """
+    def __init__(self):
+        """ """
+        # Ask the user where decisions are needed, false in the worker processes of the parallel mode
+        self.bool_interactive = True
+        # Messages collected in a worker process, to be reported by the main process
+        self.lst_worker_messages = []
+    # ------------------------------------------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def process_files_in_parallel(self, lst_apc_files, args):
+        """ Clean and enrich files in a pool of worker processes
+        :return: List of the enriched file names of all successfully processed files, in the order of the file list
+        """
+        print('\nINFO: Processing {} files in {} parallel processes'.format(len(lst_apc_files), args.parallel))
+        obj_pool = Pool(args.parallel, init_worker, (args,))
+        try:
+            lst_tasks = [(str_file_name, args) for str_file_name in lst_apc_files]
+            lst_results = obj_pool.map_async(process_file_in_worker, lst_tasks, 1).get(oat.POOL_GET_TIMEOUT)
+            obj_pool.close()
+        finally:
+            obj_pool.terminate()
+            obj_pool.join()
+
+        lst_enriched_file_names = []
+        for str_file_name, dct_result in zip(lst_apc_files, lst_results):
+            # Report the output of the workers one file after the other
+            UserInterface.print_divider(u'Output for {}'.format(str_file_name), True)
+            sys.stdout.write(dct_result['data']['output'])
+            UserInterface.print_divider(u'End of output for {}'.format(str_file_name), False, True)
+            if dct_result['success']:
+                lst_enriched_file_names.append(dct_result['data']['file'])
+                self.lst_error_messages.extend(dct_result['data']['messages'])
+            else:
+                self.lst_error_messages.append('!ERROR: ' + dct_result['error_msg'])
+        return lst_enriched_file_names
+    # ------------------------------------------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def resolve_deferred_conflicts(self, str_enriched_file_name):
+        """ Run the interactive conflict resolution for the conflicts a worker deferred, if there are any """
+        if os.path.isfile(str_enriched_file_name + '.conflicts'):
+            print('\nINFO: Resolving deferred conflicts in {}'.format(str_enriched_file_name))
+            call([os.path.abspath('../resolve_conflicts.py'), str_enriched_file_name])
+    # ------------------------------------------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def add_new_data_to_master_file(self, lst_enriched_file_names, cob_user_interface):
+        """ Check how much of the newly enriched data that should be added
+        :param lst_enriched_file_names: Enriched files to merge into the master file, in this order
+        """
 
         str_apc_se_file = Config.STR_APC_SE_FILE
 
+        # Read the master file as a columnar table, the DOI column is scanned
+        # without building a row for every line first
+        obj_master_table = oat.OpenAPCTable.load(str_apc_se_file)
+
         # Keep the header of the master file for separate writing to the final result
-        lst_master_file_header = []
+        lst_master_file_header = obj_master_table.header
 
-        # Read master file into a matrix of data - Maybe this should be a dictionary?
+        # Rows of the master file by DOI
         dct_master_data = {}
-        lst_master_dois = []
-        with open(str_apc_se_file, 'rb') as csvfile:
-            obj_csv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            for lst_row in obj_csv_reader:
-                str_doi = lst_row[3].lower().strip()
-                if str_doi == 'doi':
-                    lst_master_file_header = lst_row
-                    continue
-                if str_doi not in lst_master_dois and str_doi not in dct_master_data.keys():
-                    lst_master_dois.append(str_doi)
-                    dct_master_data[str_doi] = lst_row
-                else:
-                    print '!Error: Duplicate DOI {}'.format(str_doi)
-        csvfile.close()
-
-        with open(str_enriched_file_name, 'rb') as csvfile:
-            obj_csv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-            for lst_row in obj_csv_reader:
-                str_doi = lst_row[3].lower().strip()
-                if str_doi == 'doi':
-                    continue
-                if str_doi not in dct_master_data.keys():
-                    dct_master_data[str_doi] = lst_row
-                    print(u'INFO: Added new data {}'.format(u' '.join(lst_row)))
-                    continue
-                else:
-                    print('DOI present {}'.format(str_doi))
-                    print('Present:\t{}'.format(dct_master_data[str_doi]))
-                    print('New:\t\t{}'.format(lst_row))
-                    if lst_row == dct_master_data[str_doi]:
-                        print('INFO: Data are exactly the same. Skipping new record.')
+        for int_index, str_doi in enumerate(obj_master_table.column('doi')):
+            str_doi = str_doi.lower().strip()
+            if str_doi not in dct_master_data:
+                dct_master_data[str_doi] = obj_master_table.row(int_index)
+            else:
+                print '!Error: Duplicate DOI {}'.format(str_doi)
+
+        for str_enriched_file_name in lst_enriched_file_names:
+            with open(str_enriched_file_name, 'rb') as csvfile:
+                obj_csv_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+                for lst_row in obj_csv_reader:
+                    str_doi = lst_row[3].lower().strip()
+                    if str_doi == 'doi':
+                        continue
+                    if str_doi not in dct_master_data:
+                        dct_master_data[str_doi] = lst_row
+                        print(u'INFO: Added new data {}'.format(u' '.join(lst_row)))
                         continue
                     else:
-                        print('Data differs. Choose item:')
-                        lst_chosen_data = cob_user_interface.ask_user(dct_master_data[str_doi], lst_row)
-                        dct_master_data[str_doi] = lst_chosen_data
-        csvfile.close()
+                        print('DOI present {}'.format(str_doi))
+                        print('Present:\t{}'.format(dct_master_data[str_doi]))
+                        print('New:\t\t{}'.format(lst_row))
+                        if lst_row == dct_master_data[str_doi]:
+                            print('INFO: Data are exactly the same. Skipping new record.')
+                            continue
+                        else:
+                            print('Data differs. Choose item:')
+                            lst_chosen_data = cob_user_interface.ask_user(dct_master_data[str_doi], lst_row)
+                            dct_master_data[str_doi] = lst_chosen_data
 
         # Make master dictionary to a list and sort it
         lst_master_data = [lst_row for str_doi, lst_row in dct_master_data.iteritems()]
@@ -273,47 +453,58 @@ class DataProcessor(object):
     # ------------------------------------------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------------------------------------------
-    def run_enrichment_process(self, str_output_file_name):
-        """ """
+    def run_enrichment_process(self, str_output_file_name, args, str_work_dir=None):
+        """ Run the enrichment on a cleaned file, the result is written to out.csv
+        :param str_work_dir: Run without asking the user in this directory (instead of the current one), conflicts
+                             are deferred to out.csv.conflicts
+        :return: The exit code of the enrichment process
+        """
+
+        # Pass on the cache settings
+        lst_cache_args = ["--no-cache"] if args.no_cache else ["--cache-dir", args.cache_dir]
 
         # Run the DE process for enrichment as a shell command
         print('\nINFO: Running enrichment process on file {}'.format(str_output_file_name))
-        call(["../apc_csv_processing.py", "-l", "sv_SE.UTF-8", str_output_file_name])
+        if str_work_dir is None:
+            return call(["../apc_csv_processing.py", "-l", "sv_SE.UTF-8"] + lst_cache_args + [str_output_file_name])
+
+        lst_command = [os.path.abspath("../apc_csv_processing.py"), "-l", "sv_SE.UTF-8", "--defer-conflicts", "--yes"]
+        lst_command += lst_cache_args + [os.path.abspath(str_output_file_name)]
+        # Nobody can answer in a worker, the enrichment stops with an error wherever it would ask. Its output goes
+        # where the output of the worker goes.
+        sys.stdout.flush()
+        with open(os.devnull, 'r') as obj_devnull:
+            return call(lst_command, cwd=str_work_dir, stdin=obj_devnull, stdout=sys.stdout, stderr=STDOUT)
 
     # ------------------------------------------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------------------------------------------
     def collect_apc_data(self, str_file_name, args):
-        """ Method to collect data from institions suppliced CSV or TSV files """
-
-        # A list for the cleaned data
-        lst_cleaned_data = []
+        """ Method to collect data from institions suppliced CSV, TSV or Excel files
+        :return: Generator of cleaned rows
+        """
 
         print '\nINFO: Processing file: {} \n==================================================== \n'.format(
             str_file_name)
 
         str_input_file_name = Config.STR_DATA_DIRECTORY + str_file_name
-        lst_new_apc_data = self.clean_apc_data(str_input_file_name, args)
-
-        for lst_row in lst_new_apc_data:
-            lst_cleaned_data.append(lst_row)
+        obj_row_source = create_row_source(str_input_file_name, args)
 
-        return lst_cleaned_data
+        return self.clean_apc_data(obj_row_source, args)
 
     # ------------------------------------------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------------------------------------------
-    def clean_apc_data(self, str_input_file, args):
-        """ Process APC file """
+    def clean_apc_data(self, obj_row_source, args):
+        """ Process APC file, yield cleaned rows
+        :param obj_row_source: Row source delivering the rows of the input file, see create_row_source
+        """
 
         # Create a publisher name normalising object
-        obj_publisher_normaliser = PublisherNormaliser()
+        obj_publisher_normaliser = PublisherNormaliser(self.bool_interactive)
 
-        cleaned_content = []
         error_messages = []
 
-        enc = None # CSV file encoding
-
         # Keep a list of processed DOI's to check for duplicates - what to do if found?
         lst_dois_processed = []
 
@@ -329,65 +520,21 @@ class DataProcessor(object):
                 print "Setting locale to " + norm + " failed: " + loce.message
                 sys.exit()
 
-        if args.encoding:
-            try:
-                codec = codecs.lookup(args.encoding)
-                print ("Encoding '{}' found in Python's codec collection " +
-                       "as '{}'").format(args.encoding, codec.name)
-                enc = args.encoding
-            except LookupError:
-                print ("Error: '" + args.encoding + "' not found Python's " +
-                       "codec collection. Either look for a valid name here " +
-                       "(https://docs.python.org/2/library/codecs.html#standard-" +
-                       "encodings) or omit this argument to enable automated " +
-                       "guessing.")
-                sys.exit()
+        has_header = obj_row_source.has_header
 
-        # Read file data into result dictionary object
-        result = oat.analyze_csv_file(str_input_file)
-
-        if result["success"]:
-            csv_analysis = result["data"]
-            print csv_analysis
-        else:
-            print result["error_msg"]
-            sys.exit()
-
-        if enc is None:
-            enc = csv_analysis.enc
-
-        dialect = csv_analysis.dialect
-        has_header = csv_analysis.has_header
-
-        if enc is None:
-            print ("Error: No encoding given for CSV file and automated " +
-                   "detection failed. Please set the encoding manually via the " +
-                   "--enc argument")
-            sys.exit()
-
-        print '\nProcessing file {}'.format(str_input_file)
-        csv_file = open(str_input_file, "r")
-
-        reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
-
-        first_row = reader.next()
-        num_columns = len(first_row)
-        print "\nCSV file has {} columns.".format(num_columns)
-
-        csv_file.seek(0)
-        reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
+        print '\nProcessing file {}'.format(obj_row_source.str_file_name)
 
         print "\nNOTE:    *** Starting cleaning of file *** \n"
 
-        cleaned_content = []
-        error_messages = []
-
         row_num = 0
 
-        for row in reader:
+        for row in obj_row_source:
 
             row_num += 1
 
+            if row_num == 1:
+                print "\nInput file has {} columns.".format(len(row))
+
             # print "--- Processing line number {} ---".format(str(row_num))
 
             # Check input if verbose mode
@@ -414,7 +561,7 @@ class DataProcessor(object):
             # First non-empty row should be the header
             if has_header and row_num == 1:
                 header = row
-                cleaned_content.append(header)
+                yield header
                 continue
 
             # Put the DOI in a string for later use
@@ -478,9 +625,7 @@ class DataProcessor(object):
             if args.verbose:
                 print current_row
 
-            cleaned_content.append(current_row)
-
-        csv_file.close()
+            yield current_row
 
         if not error_messages:
             oat.print_g("Metadata cleaning successful, no errors occured\n")
@@ -489,26 +634,39 @@ class DataProcessor(object):
             for msg in error_messages:
                 print msg + "\n"
 
-        # Write new publisher names to file
-        obj_publisher_normaliser.write_new_publisher_name_map()
-
-        return cleaned_content
+        # Write new publisher names to file, worker processes leave the map unchanged
+        if self.bool_interactive:
+            obj_publisher_normaliser.write_new_publisher_name_map()
+        else:
+            self.lst_worker_messages.extend(obj_publisher_normaliser.lst_unresolved_names)
 
     # ------------------------------------------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------------------------------------------
-    def write_cleaned_data(self, str_output_file_name, lst_cleaned_content):
+    def write_cleaned_data(self, str_output_file_name, gen_cleaned_content):
+        """ Write cleaned rows to a TSV file for the enrichment process
+        :param gen_cleaned_content: Iterable of cleaned rows, consumed while writing
+        """
 
         print 'INFO: Writing result to file {}'.format(str_output_file_name)
 
-        with open(str_output_file_name, 'w') as out:
+        # Write to a temporary file first, so an aborted cleaning does not leave a partial file behind
+        str_tmp_file_name = str_output_file_name + '.tmp'
+        with open(str_tmp_file_name, 'w') as out:
 
-            for lst_line in lst_cleaned_content:
+            for lst_line in gen_cleaned_content:
                 if Config.BOOL_VERBOSE:
                     print lst_line
                 if lst_line:
                     out.write(u'\t'.join(lst_line).encode("utf-8"))
                     out.write(u'\n')
+
+        try:
+            os.rename(str_tmp_file_name, str_output_file_name)
+        except OSError:
+            # Windows does not replace existing files on rename
+            os.remove(str_output_file_name)
+            os.rename(str_tmp_file_name, str_output_file_name)
     # ------------------------------------------------------------------------------------------------------------------
 
 
@@ -560,7 +718,6 @@ class FileManager(object):
             str_output_file_name = Config.STR_DATA_DIRECTORY + str_input_file_name.replace(r'.tsv', r'_cleaned.tsv')
         elif r'.xlsx' in str_input_file_name:
             str_output_file_name = Config.STR_DATA_DIRECTORY + str_input_file_name.replace(r'.xlsx', r'_cleaned.tsv')
-            str_input_file_name = self.convert_excel_to_tsv(str_input_file_name)
         else:
             sys.exit('!Error: File {} is not in proper format for processing'.format(str_input_file_name))
 
@@ -571,47 +728,6 @@ class FileManager(object):
 
     # ------------------------------------------------------------------------------------------------------------------
 
-    # ------------------------------------------------------------------------------------------------------------------
-    def convert_excel_to_tsv(self, str_excel_file):
-        """ If we have an Excel file as input, convert it to TSV for OA toolkit processing """
-
-        # Make a TSV name to return to caller
-        str_tsv_file = str_excel_file.replace(r'.xlsx',r'.tsv')
-
-        str_excel_dir_file = Config.STR_DATA_DIRECTORY + str_excel_file
-        str_tsv_dir_file = Config.STR_DATA_DIRECTORY + str_tsv_file
-        # fp_tsv_file = open(str_tsv_dir_file, 'w')
-
-        wb = load_workbook(filename=str_excel_dir_file, read_only=True)
-        ws = wb.active  # ['Blad1']
-
-        mx_converted_data = []
-
-        for row in ws.rows:
-            lst_row = []
-            col_number = 0
-            for cell in row:
-                col_number += 1
-                if col_number > 11:
-                    break
-                if cell.value != 'None':
-                    lst_row.append(unicode(cell.value))
-                else:
-                    lst_row.append('')
-            # print lst_row
-            mx_converted_data.append(lst_row)
-
-            # fp_tsv_file.write(u'\t'.join(lst_row).encode("utf-8"))
-            # fp_tsv_file.write('\n')
-
-        with open(str_tsv_dir_file, 'wb') as csvfile:
-            obj_tsv_writer = csv.writer(csvfile, delimiter='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            for lst_row in mx_converted_data:
-                obj_tsv_writer.writerow(lst_row)
-
-        return str_tsv_file
-    # ------------------------------------------------------------------------------------------------------------------
-
     # ------------------------------------------------------------------------------------------------------------------
     def backup_master_file(self, str_apc_se_file):
         """ Make a backup of master file before processing it
@@ -626,11 +742,12 @@ class FileManager(object):
     # ------------------------------------------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------------------------------------------
-    def copy_enrichment_out(self, str_enriched_file_name):
-        """ Copy the output from python/se/out.csv to the organisation directory """
+    def copy_enrichment_out(self, str_enriched_file_name, str_out_file='out.csv'):
+        """ Copy the output from python/se/out.csv (or another enrichment result) to the organisation directory """
 
-        print('\nCopying python/se/out.csv to {}'.format(str_enriched_file_name))
-        call(["cp", 'out.csv', str_enriched_file_name])
+        print('\nCopying {} to {}'.format(str_out_file, str_enriched_file_name))
+        # Raises IOError if the copy fails, a missing enrichment result must not go unnoticed
+        shutil.copy(str_out_file, str_enriched_file_name)
     # ------------------------------------------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------------------------------------------
@@ -667,6 +784,107 @@ class FileManager(object):
 # ======================================================================================================================
 
 
+# ======================================================================================================================
+def create_row_source(str_file_name, args):
+    """ Create the row source matching the type of an input file. A row source is iterated for the rows of an
+    institution's APC file as lists of unicode strings, read lazily, and tells in has_header if the first row is a
+    header.
+    :param str_file_name: Path of the input file
+    :param args: Command line arguments (encoding)
+    :return: An ExcelRowSource for Excel files, a CSVRowSource otherwise
+    """
+    if str_file_name.endswith(r'.xlsx'):
+        return ExcelRowSource(str_file_name)
+    return CSVRowSource(str_file_name, args.encoding)
+
+# ======================================================================================================================
+
+
+# ======================================================================================================================
+class CSVRowSource(object):
+    """ Rows of a CSV or TSV file, encoding and dialect are determined by the OpenAPC toolkit """
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, str_file_name, str_encoding=None):
+        """ Analyse the file, exit if its encoding can not be determined """
+        self.str_file_name = str_file_name
+
+        if str_encoding:
+            try:
+                codec = codecs.lookup(str_encoding)
+                print ("Encoding '{}' found in Python's codec collection " +
+                       "as '{}'").format(str_encoding, codec.name)
+            except LookupError:
+                print ("Error: '" + str_encoding + "' not found Python's " +
+                       "codec collection. Either look for a valid name here " +
+                       "(https://docs.python.org/2/library/codecs.html#standard-" +
+                       "encodings) or omit this argument to enable automated " +
+                       "guessing.")
+                sys.exit()
+
+        # Read file data into result dictionary object
+        result = oat.analyze_csv_file(str_file_name)
+
+        if result["success"]:
+            csv_analysis = result["data"]
+            print csv_analysis
+        else:
+            print result["error_msg"]
+            sys.exit()
+
+        self.str_encoding = str_encoding or csv_analysis.enc
+        self.dialect = csv_analysis.dialect
+        self.has_header = csv_analysis.has_header
+
+        if self.str_encoding is None:
+            print ("Error: No encoding given for CSV file and automated " +
+                   "detection failed. Please set the encoding manually via the " +
+                   "--enc argument")
+            sys.exit()
+    # ------------------------------------------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __iter__(self):
+        with open(self.str_file_name, 'r') as csv_file:
+            for lst_row in oat.UnicodeReader(csv_file, dialect=self.dialect, encoding=self.str_encoding):
+                yield lst_row
+    # ------------------------------------------------------------------------------------------------------------------
+
+# ======================================================================================================================
+
+
+# ======================================================================================================================
+class ExcelRowSource(object):
+    """ Rows of the active sheet of an Excel workbook, streamed in openpyxl's read-only mode """
+
+    # Only the columns of the OpenAPC schema are read
+    INT_MAX_COLUMNS = 11
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self, str_file_name):
+        """ Open the workbook, the first row is taken as header if all its cells are text """
+        self.str_file_name = str_file_name
+        self.obj_worksheet = load_workbook(filename=str_file_name, read_only=True).active
+        lst_first_row = next(self.iter_values(), [])
+        self.has_header = all(value is None or isinstance(value, basestring) for value in lst_first_row)
+    # ------------------------------------------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def iter_values(self):
+        """ Yield the raw cell values of each row, limited to the OpenAPC columns """
+        for obj_row in self.obj_worksheet.iter_rows():
+            yield [cell.value for cell in obj_row[:self.INT_MAX_COLUMNS]]
+    # ------------------------------------------------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __iter__(self):
+        for lst_values in self.iter_values():
+            yield [u'' if value is None else unicode(value) for value in lst_values]
+    # ------------------------------------------------------------------------------------------------------------------
+
+# ======================================================================================================================
+
+
 # ======================================================================================================================
 class UserInterface(object):
     """ Class for methods for interacting with user """
@@ -770,8 +988,13 @@ class PublisherNormaliser(object):
     STR_PUBLISHER_NAME_MAP_FILE = Config.STR_DATA_DIRECTORY + 'publisher_name_map.tsv'
 
     # ------------------------------------------------------------------------------------------------------------------
-    def __init__(self):
-        """ Create name mapping dictionary for processing """
+    def __init__(self, bool_interactive=True):
+        """ Create name mapping dictionary for processing
+        :param bool_interactive: If False, names which are not in the map are kept instead of asking the user and
+                                 are collected in lst_unresolved_names
+        """
+        self.bool_interactive = bool_interactive
+        self.lst_unresolved_names = []
         self.dct_publisher_name_map = {}
         fp_publisher_map = open(self.STR_PUBLISHER_NAME_MAP_FILE, 'r')
         for str_row in fp_publisher_map:
@@ -797,6 +1020,14 @@ class PublisherNormaliser(object):
                 print('!ERROR: {}'.format(dct_crossref_result['error_reason']))
                 print 'WARNING: No normalisation of name {}'.format(str_publisher_name_in)
                 return str_publisher_name_in
+            elif not self.bool_interactive:
+                self.lst_unresolved_names.append(
+                    u'WARNING: Publisher name "{}" not normalised (Crossref: "{}" / "{}", DOI {})'.format(
+                        str_publisher_name_in, dct_crossref_result['publisher'], dct_crossref_result['prefix'],
+                        str_doi))
+                # Remember the name for this run only, the map file is not written in this mode
+                self.dct_publisher_name_map[str_publisher_name_lower] = str_publisher_name_in
+                return str_publisher_name_in
             else:
                 str_publisher_name_normalised = self.ask_user(str_publisher_name_in, dct_crossref_result)
             return str_publisher_name_normalised
@@ -851,11 +1082,22 @@ class PublisherNormaliser(object):
             publisher = '',
             prefix = '',
         )
-        url = 'http://data.crossref.org/' + doi
+        # Use metadata from an earlier Crossref lookup if possible
+        if oat.metadata_cache is not None:
+            dct_cached_result = oat.metadata_cache.get('crossref', doi)
+            if dct_cached_result is not None and not dct_cached_result['success']:
+                dct_crossref_lookup_result['error'] = True
+                dct_crossref_lookup_result['error_reason'] = dct_cached_result['error_msg']
+                return dct_crossref_lookup_result
+            if dct_cached_result is not None and None not in (dct_cached_result['data']['publisher'],
+                                                              dct_cached_result['data']['prefix']):
+                dct_crossref_lookup_result['publisher'] = dct_cached_result['data']['publisher']
+                dct_crossref_lookup_result['prefix'] = dct_cached_result['data']['prefix']
+                return dct_crossref_lookup_result
+        url = oat.CROSSREF_URL + doi
         headers = {"Accept": "application/vnd.crossref.unixsd+xml"}
-        req = urllib2.Request(url, None, headers)
         try:
-            response = urllib2.urlopen(req)
+            response = oat.http_client.request(url, headers)
             content_string = response.read()
             root = ET.fromstring(content_string)
             prefix_name_result = root.findall(".//cr_qr:crm-item[@name='prefix-name']",
@@ -912,7 +1154,7 @@ class CSVColumn(object):
     # ------------------------------------------------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------------------------------------------------
-    def check_overwrite(self, old_value, new_value):
+    def check_overwrite(self, old_value, new_value, row_num=None):
         if old_value == new_value:
             return old_value
         # Priority: Empty or NA values will always be overwritten.
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import os
+import sys
+
+import pytest
+
+openpyxl = pytest.importorskip("openpyxl")
+pytest.importorskip("unicodecsv")
+
+import process_apc_files
+
+Args = namedtuple("Args", ["encoding"])
+
+HEADER = [u"institution", u"period", u"euro", u"doi", u"is_hybrid", u"publisher"]
+
+def write_workbook(path, rows):
+    workbook = openpyxl.Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    workbook.save(str(path))
+
+class TestCSVRowSource(object):
+
+    def test_rows(self, tmpdir):
+        path = tmpdir.join("apc.tsv")
+        path.write(u"\t".join(HEADER).encode("utf-8") + "\n" +
+                   u"KTH\t2016\t1200,50\t10.1/a\tFALSE\tSpringer Nature\n".encode("utf-8") +
+                   u"SLU\t2016\t900\t10.1/b\tTRUE\tÉditions Ümlaut\n".encode("utf-8"), mode="wb")
+        row_source = process_apc_files.create_row_source(str(path), Args(None))
+        assert isinstance(row_source, process_apc_files.CSVRowSource)
+        assert row_source.has_header
+        assert list(row_source) == [HEADER,
+                                    [u"KTH", u"2016", u"1200,50", u"10.1/a", u"FALSE", u"Springer Nature"],
+                                    [u"SLU", u"2016", u"900", u"10.1/b", u"TRUE", u"Éditions Ümlaut"]]
+
+    def test_encoding_argument(self, tmpdir):
+        path = tmpdir.join("apc.csv")
+        path.write(u"KTH,2016,900,10.1/b,TRUE,Éditions Ümlaut\n".encode("latin-1"), mode="wb")
+        row_source = process_apc_files.CSVRowSource(str(path), "latin-1")
+        assert list(row_source) == [[u"KTH", u"2016", u"900", u"10.1/b", u"TRUE", u"Éditions Ümlaut"]]
+
+class TestExcelRowSource(object):
+
+    def test_rows(self, tmpdir):
+        path = tmpdir.join("apc.xlsx")
+        write_workbook(path, [HEADER + [u"comment"] * 6,
+                              [u"KTH", 2016, 1200.5, u"10.1/a", None, u"Springer Nature"] + [u"x"] * 6])
+        row_source = process_apc_files.create_row_source(str(path), Args(None))
+        assert isinstance(row_source, process_apc_files.ExcelRowSource)
+        assert row_source.has_header
+        # Cell values are turned into strings, columns beyond the OpenAPC schema are dropped
+        assert list(row_source) == [HEADER + [u"comment"] * 5,
+                                    [u"KTH", u"2016", u"1200.5", u"10.1/a", u"", u"Springer Nature"] + [u"x"] * 5]
+
+    @pytest.mark.parametrize("first_row, has_header", [
+        ([u"institution", None, u"euro"], True),
+        ([u"KTH", 2016, 1200.5], False),
+        ([u"KTH", u"2016", True], False)
+    ])
+    def test_header_detection(self, tmpdir, first_row, has_header):
+        path = tmpdir.join("apc.xlsx")
+        write_workbook(path, [first_row, [u"KTH", 2016, 1200.5]])
+        assert process_apc_files.ExcelRowSource(str(path)).has_header == has_header
+
+def fake_enrichment(self, str_output_file_name, args, str_work_dir=None):
+    """ Stands in for apc_csv_processing.py, turns the cleaned TSV file into out.csv """
+    with open(str_output_file_name) as tsv_file, open(os.path.join(str_work_dir or ".", "out.csv"), "w") as out:
+        for line in tsv_file:
+            out.write(",".join(['"' + value + '"' for value in line.rstrip("\n").split("\t")]) + "\n")
+    print "Enriched " + os.path.basename(str_output_file_name)
+    return 0
+
+@pytest.fixture
+def data_dir(tmpdir, monkeypatch):
+    data_dir = tmpdir.mkdir("data")
+    data_dir.mkdir("kth").join("apc.csv").write(
+        ",".join(HEADER) + "\n" +
+        "KTH,2016,1200,10.1/a,FALSE,springer\n" +
+        "KTH,2016,900,10.1/b,TRUE,Elsevier BV\n")
+    data_dir.mkdir("slu").join("apc.tsv").write(
+        "\t".join(HEADER) + "\n" +
+        "SLU\t2017\t1500\t10.1/c\tFALSE\tSpringer\n" +
+        "SLU\t2017\t1800\t10.1/d\tTRUE\tSpringer Nature\n")
+    data_dir.join("file_list.txt").write("kth/apc.csv\nslu/apc.tsv\n")
+    data_dir.join("publisher_name_map.tsv").write("springer\tSpringer Nature\nspringer nature\tSpringer Nature\n" +
+                                                  "elsevier bv\tElsevier\nelsevier\tElsevier\n")
+    monkeypatch.setattr(process_apc_files.Config, "STR_DATA_DIRECTORY", str(data_dir) + os.sep)
+    monkeypatch.setattr(process_apc_files.Config, "STR_APC_FILE_LIST", str(data_dir.join("file_list.txt")))
+    monkeypatch.setattr(process_apc_files.Config, "STR_APC_SE_FILE", str(data_dir.join("apc_se.csv")))
+    monkeypatch.setattr(process_apc_files.PublisherNormaliser, "STR_PUBLISHER_NAME_MAP_FILE",
+                        str(data_dir.join("publisher_name_map.tsv")))
+    monkeypatch.setattr(process_apc_files.DataProcessor, "run_enrichment_process", fake_enrichment)
+    # The sequential mode runs the enrichment in the current directory
+    monkeypatch.chdir(tmpdir)
+    return data_dir
+
+def run_main(data_dir, monkeypatch, *args):
+    """ Run the script on a fresh master file
+    :return: The content of the master file and of the enriched files
+    """
+    data_dir.join("apc_se.csv").write(",".join(HEADER) + "\n")
+    monkeypatch.setattr(sys, "argv", ["process_apc_files.py", "--no-cache"] + list(args))
+    process_apc_files.main()
+    return [data_dir.join(name).read() for name in ["apc_se.csv", "kth/apc_enriched.csv", "slu/apc_enriched.csv"]]
+
+def test_parallel_processing(data_dir, monkeypatch, capsys):
+    sequential = run_main(data_dir, monkeypatch)
+    capsys.readouterr()
+    parallel = run_main(data_dir, monkeypatch, "--parallel", "2")
+    assert parallel == sequential
+    assert sequential[0].splitlines()[1:] == ["KTH,2016,1200,10.1/a,FALSE,Springer Nature",
+                                              "KTH,2016,900,10.1/b,TRUE,Elsevier",
+                                              "SLU,2017,1500,10.1/c,FALSE,Springer Nature",
+                                              "SLU,2017,1800,10.1/d,TRUE,Springer Nature"]
+    # The output of the workers is reported file by file
+    output = capsys.readouterr()[0]
+    for str_file_name in ["kth/apc.csv", "slu/apc.tsv"]:
+        file_output = output[output.index("[Output for " + str_file_name):
+                             output.index("[End of output for " + str_file_name)]
+        assert "Processing file: " + str_file_name in file_output
+        assert "Enriched apc_cleaned.tsv" in file_output
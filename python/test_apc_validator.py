@@ -0,0 +1,86 @@
+import pytest
+
+import apc_validator
+
+HEADER = ("institution,period,euro,doi,is_hybrid,publisher,journal_full_title,issn,issn_print," +
+          "issn_electronic,issn_l,license_ref,indexed_in_crossref,pmid,pmcid,ut,url,doaj\n")
+
+def make_row(doi, publisher="Springer", issn="0921-898X", is_hybrid="TRUE", doaj="FALSE"):
+    values = ["bth", "2016", "2200", doi, is_hybrid, publisher, "Small Business Economics",
+              issn, issn, "NA", "NA", "NA", "TRUE", "NA", "NA", "NA", "NA", doaj]
+    return ",".join(values) + "\n"
+
+@pytest.fixture
+def csv_files(tmpdir):
+    first = tmpdir.join("first.csv")
+    first.write(HEADER + make_row("10.1/a") + make_row("10.1/b") + "bth,2016\n")
+    second = tmpdir.join("second.csv")
+    second.write(HEADER + make_row("10.1/a", publisher="Elsevier") + make_row("10.1/c", doaj="TRUE"))
+    return [str(first), str(second)]
+
+def test_validate_files(csv_files):
+    report = apc_validator.validate_files(csv_files)
+    assert report["files"] == [{"file": csv_files[0], "rows": 3}, {"file": csv_files[1], "rows": 2}]
+    rules = [(failure["rule"], failure.get("line")) for failure in report["failures"]]
+    assert rules == [("line_length", 4), ("hybrid_status", 3), ("doi_duplicates", None),
+                     ("name_consistency", None), ("name_consistency", None)]
+    duplicate = report["failures"][2]
+    assert duplicate["locations"] == [(csv_files[0], 2), (csv_files[1], 2)]
+    consistency = report["failures"][3]
+    assert consistency["key"] == "0921-898X"
+    assert consistency["message"] == (u'Entries share a common ISSN (0921-898X), but the publisher ' +
+                                      u'name differs ("Springer" ({0}, lines 2, 3; {1}, line 3) vs ' +
+                                      u'"Elsevier" ({1}, line 2))').format(*csv_files)
+
+def test_parallel_validation(csv_files):
+    assert apc_validator.validate_files(csv_files, 2) == apc_validator.validate_files(csv_files)
+
+def test_check_batches(csv_files, monkeypatch):
+    report = apc_validator.validate_files(csv_files)
+    monkeypatch.setattr(apc_validator, "CHECK_BATCH_SIZE", 1)
+    assert apc_validator.validate_files(csv_files) == report
+
+def test_publisher_whitelist():
+    entries = [apc_validator.GroupEntry("a.csv", 2, "Springer Nature", "J", "TRUE", "1234-5678"),
+               apc_validator.GroupEntry("a.csv", 3, "Nature Publishing Group", "J", "TRUE", "1234-5678")]
+    assert apc_validator.check_name_consistency("issn", "1234-5678", entries) is None
+    entries.append(apc_validator.GroupEntry("a.csv", 4, "Elsevier", "J", "FALSE", "2041-1723"))
+    msg = apc_validator.check_name_consistency("issn_print", "1234-5678", entries)
+    # The hybrid status change whitelisted for the ISSN of the third row does
+    # not cover the other rows
+    assert msg.splitlines() == [u'Entries share a common Print ISSN (1234-5678), but the publisher name ' +
+                                u'differs ("Springer Nature" (a.csv, line 2) vs "Nature Publishing ' +
+                                u'Group" (a.csv, line 3) vs "Elsevier" (a.csv, line 4))',
+                                u'Entries share a common Print ISSN (1234-5678), but the hybrid status ' +
+                                u'differs ("TRUE" (a.csv, lines 2, 3) vs "FALSE" (a.csv, line 4))']
+
+def test_owner_change_whitelist():
+    entries = [apc_validator.GroupEntry("a.csv", 2, "SAGE Publications", "J", "TRUE", "1744-8069"),
+               apc_validator.GroupEntry("a.csv", 3, "Springer Science + Business Media", "J", "TRUE",
+                                        "1744-8069")]
+    assert apc_validator.check_name_consistency("issn_print", "1744-8069", entries) is None
+    # The owner change is only accepted for rows of the whitelisted ISSN
+    entries.append(apc_validator.GroupEntry("a.csv", 4, "SAGE Publications", "J", "TRUE", "1234-5678"))
+    msg = apc_validator.check_name_consistency("issn_print", "1744-8069", entries)
+    assert msg == (u'Entries share a common Print ISSN (1744-8069), but the publisher name differs ' +
+                   u'("SAGE Publications" (a.csv, lines 2, 4) vs "Springer Science + Business Media" ' +
+                   u'(a.csv, line 3))')
+
+def test_incremental_validation(csv_files, tmpdir):
+    state_file = str(tmpdir.join("sidecars", "state.validation"))
+    report = apc_validator.validate_files(csv_files, state_file=state_file)
+    assert report["checked"]["rows"] == 5
+    report = apc_validator.validate_files(csv_files, state_file=state_file)
+    # Only the failing groups are checked again, to report current locations
+    assert report["checked"] == {"rows": 0, "groups": 3}
+    # Fix the inconsistent publisher, drop a row and insert a new one
+    with open(csv_files[1], "w") as second:
+        second.write(HEADER + make_row("10.1/d") + make_row("10.1/a"))
+    report = apc_validator.validate_files(csv_files, state_file=state_file)
+    # The second row equals one in the first file, the group of 10.1/c is gone
+    assert report["checked"] == {"rows": 1, "groups": 4}
+    full_report = apc_validator.validate_files(csv_files)
+    del full_report["checked"], report["checked"]
+    assert report == full_report
+    rules = [(failure["rule"], failure.get("line")) for failure in report["failures"]]
+    assert rules == [("line_length", 4), ("doi_duplicates", None)]
@@ -0,0 +1,645 @@
+# -*- coding: UTF-8 -*-
+
+import BaseHTTPServer
+import codecs
+import gzip
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+import json
+import threading
+import time
+import urllib2
+import urlparse
+
+import py
+import pytest
+
+import openapc_toolkit as oat
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves canned responses registered in the server's routes dict.
+
+    A route maps a request path (including the query string) to a tuple of
+    (status code, headers dict, body).
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connection_count += 1
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        route = self.server.routes.get(self.path)
+        if route is None:
+            route = self.server.routes.get(self.path.split("?")[0])
+        if route is None:
+            route = (404, {}, "Not Found")
+        if callable(route):
+            route = route(self)
+        status, headers, body = route
+        self.send_response(status)
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_CONNECT(self):
+        # Acts as a proxy refusing to open tunnels
+        self.server.requests.append(("CONNECT " + self.path, dict(self.headers)))
+        self.send_response(403)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.routes = {}
+        self.requests = []
+        self.connection_count = 0
+        self.url = "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # Clients hang up early on purpose, f.e. after a timeout
+        pass
+
+@pytest.fixture
+def server():
+    stand_in = StandInServer()
+    thread = threading.Thread(target=stand_in.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield stand_in
+    stand_in.shutdown()
+    stand_in.server_close()
+
+def gzipped(content):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+        gz.write(content)
+    return buf.getvalue()
+
+class TestHTTPClient(object):
+
+    def test_keep_alive(self, server):
+        server.routes["/a"] = (200, {}, "first")
+        server.routes["/b"] = (200, {}, "second")
+        client = oat.HTTPClient(timeout=5)
+        assert client.request(server.url + "/a").read() == "first"
+        assert client.request(server.url + "/b").read() == "second"
+        assert server.connection_count == 1
+        client.close()
+
+    def test_stale_connection(self, server):
+        def drop_connection(handler):
+            # Close the connection after responding, without telling the client
+            handler.close_connection = 1
+            return (200, {}, "dropped")
+        server.routes["/drop"] = drop_connection
+        server.routes["/b"] = (200, {}, "second")
+        client = oat.HTTPClient(timeout=5)
+        assert client.request(server.url + "/drop").read() == "dropped"
+        assert client.request(server.url + "/b").read() == "second"
+        assert server.connection_count == 2
+        client.close()
+
+    def test_timeout_on_reused_connection(self, server):
+        def slow(handler):
+            time.sleep(0.5)
+            return (200, {}, "slow")
+        server.routes["/a"] = (200, {}, "first")
+        server.routes["/slow"] = slow
+        client = oat.HTTPClient(timeout=0.2)
+        client.request(server.url + "/a")
+        with pytest.raises(urllib2.URLError):
+            client.request(server.url + "/slow")
+        # A timeout is not retried on a fresh connection
+        assert [path for path, _ in server.requests] == ["/a", "/slow"]
+
+    def test_gzip(self, server):
+        server.routes["/gz"] = (200, {"Content-Encoding": "gzip"}, gzipped("unpacked"))
+        client = oat.HTTPClient(timeout=5)
+        response = client.request(server.url + "/gz")
+        assert response.read() == "unpacked"
+        assert server.requests[0][1]["accept-encoding"] == "gzip"
+
+    def test_redirect(self, server):
+        server.routes["/old"] = (301, {"Location": "/new"}, "")
+        server.routes["/new"] = (200, {}, "moved")
+        client = oat.HTTPClient(timeout=5)
+        response = client.request(server.url + "/old")
+        assert response.read() == "moved"
+        assert response.geturl() == server.url + "/new"
+
+    def test_http_error(self, server):
+        client = oat.HTTPClient(timeout=5)
+        with pytest.raises(urllib2.HTTPError) as excinfo:
+            client.request(server.url + "/missing")
+        assert excinfo.value.getcode() == 404
+
+    def test_http_proxy(self, server):
+        server.routes["http://example.invalid/a?b=c"] = (200, {}, "proxied")
+        proxy_url = server.url.replace("://", "://user:secret@")
+        client = oat.HTTPClient(timeout=5, proxies={"http": proxy_url})
+        response = client.request("http://example.invalid/a?b=c")
+        assert response.read() == "proxied"
+        path, headers = server.requests[0]
+        assert path == "http://example.invalid/a?b=c"
+        assert headers["proxy-authorization"] == "Basic dXNlcjpzZWNyZXQ="
+
+    def test_https_proxy_tunnel(self, server):
+        client = oat.HTTPClient(timeout=5, proxies={"https": server.url})
+        with pytest.raises(urllib2.URLError):
+            client.request("https://example.invalid/a")
+        assert server.requests[0][0] == "CONNECT example.invalid:443"
+
+    def test_proxy_bypass(self, server, monkeypatch):
+        monkeypatch.setenv("no_proxy", "127.0.0.1")
+        server.routes["/a"] = (200, {}, "direct")
+        client = oat.HTTPClient(timeout=5, proxies={"http": "http://127.0.0.1:1"})
+        assert client.request(server.url + "/a").read() == "direct"
+
+    def test_url_error(self):
+        client = oat.HTTPClient(timeout=5)
+        with pytest.raises(urllib2.URLError):
+            client.request("http://127.0.0.1:1/")
+
+    def test_pubmed_lookup(self, server, monkeypatch):
+        xml = ("<responseWrapper><resultList><result><pmid>123</pmid>" +
+               "<pmcid>PMC456</pmcid></result></resultList></responseWrapper>")
+        server.routes["/search?query=doi:10.1/abc"] = (200, {}, xml)
+        monkeypatch.setattr(oat, "EUROPE_PMC_SEARCH_URL", server.url + "/search")
+        result = oat.get_metadata_from_pubmed("10.1/abc")
+        assert result["success"]
+        assert result["data"] == {"pmid": "123", "pmcid": "PMC456"}
+
+class TestMetadataCache(object):
+
+    def test_crossref_lookup_is_cached(self, server, monkeypatch, tmpdir):
+        xml = ("<crossref_result xmlns='http://www.crossref.org/qrschema/3.0'>" +
+               "<query_result><body><query><doi type='journal_article'>" +
+               "10.1/ABC</doi><crm-item name='publisher-name'>Test Press" +
+               "</crm-item><crm-item name='prefix-name'>Test Prefix" +
+               "</crm-item></query></body></query_result></crossref_result>")
+        server.routes["/10.1/ABC"] = (200, {}, xml)
+        monkeypatch.setattr(oat, "CROSSREF_URL", server.url + "/")
+        monkeypatch.setattr(oat, "metadata_cache", oat.MetadataCache(str(tmpdir)))
+        first = oat.get_metadata_from_crossref("10.1/ABC")
+        second = oat.get_metadata_from_crossref("https://doi.org/10.1/abc")
+        assert first["data"]["publisher"] == "Test Press"
+        assert first == second
+        assert len(server.requests) == 1
+
+    def test_negative_caching(self, server, monkeypatch, tmpdir):
+        monkeypatch.setattr(oat, "CROSSREF_URL", server.url + "/")
+        monkeypatch.setattr(oat, "metadata_cache", oat.MetadataCache(str(tmpdir)))
+        assert not oat.get_metadata_from_crossref("10.1/missing")["success"]
+        assert not oat.get_metadata_from_crossref("10.1/missing")["success"]
+        assert len(server.requests) == 1
+
+    def test_expiry(self, tmpdir):
+        cache = oat.MetadataCache(str(tmpdir), ttl=-1)
+        cache.put("pubmed", "10.1/abc", {"success": True})
+        assert cache.get("pubmed", "10.1/abc") is None
+
+def test_lru_cache():
+    cache = oat.LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_process_rows(workers, monkeypatch, capsys):
+    consumed = []
+    yielded = []
+    max_pending = [0]
+    def fake_process_row(row, row_num, column_map, num_required_columns, **kwargs):
+        # Later rows finish first
+        time.sleep(0.002 * (row_num % 5))
+        return row + [kwargs["suffix"]]
+    def numbered_rows():
+        for row_num in range(1, 41):
+            consumed.append(row_num)
+            max_pending[0] = max(max_pending[0], len(consumed) - len(yielded))
+            yield row_num, [str(row_num)]
+    monkeypatch.setattr(oat, "process_row", fake_process_row)
+    for row_num, row in oat.process_rows(numbered_rows(), None, 1, workers, suffix="x"):
+        yielded.append(row_num)
+        assert row == [str(row_num), "x"]
+    assert yielded == range(1, 41)
+    assert max_pending[0] <= max(workers * 4, 1)
+    printed = [line for line in capsys.readouterr().out.splitlines() if line.startswith("---")]
+    assert sorted(printed) == sorted(["---Processing line number {}---".format(i) for i in range(1, 41)])
+
+CROSSREF_WORKS = {
+    "10.1/one": {"DOI": "10.1/one", "type": "journal-article", "prefix": "10.1",
+                 "publisher": "Test Press", "container-title": ["Journal One"],
+                 "ISSN": ["1234-5678"],
+                 "issn-type": [{"type": "print", "value": "1234-5678"}],
+                 "license": [{"URL": "http://creativecommons.org/licenses/by/4.0"}]},
+    "10.1/two": {"DOI": "10.1/two", "type": "book-chapter", "prefix": "10.1"}
+}
+
+def crossref_works_route(handler):
+    """
+    A stand-in for the works endpoint of the Crossref REST API.
+    """
+    query = urlparse.parse_qs(urlparse.urlsplit(handler.path).query)
+    dois = [f[len("doi:"):] for f in query["filter"][0].split(",")]
+    items = [CROSSREF_WORKS[doi.lower()] for doi in dois if doi.lower() in CROSSREF_WORKS]
+    return (200, {}, json.dumps({"message": {"items": items}}))
+
+class TestCrossrefBatch(object):
+
+    @pytest.fixture(autouse=True)
+    def crossref_api(self, server, monkeypatch):
+        server.routes["/works"] = crossref_works_route
+        server.routes["/prefixes/10.1"] = (200, {}, json.dumps({"message": {"name": "Test Prefix"}}))
+        monkeypatch.setattr(oat, "CROSSREF_WORKS_URL", server.url + "/works")
+        monkeypatch.setattr(oat, "CROSSREF_PREFIXES_URL", server.url + "/prefixes/")
+        monkeypatch.setattr(oat, "crossref_prefix_names", oat.LRUCache())
+
+    def test_batch_lookup(self, server):
+        dois = ["10.1/one", "doi:10.1/ONE", "10.1/two", "10.1/unknown", "no doi"]
+        results = oat.get_metadata_from_crossref_batch(dois, batch_size=10)
+        assert sorted(results.keys()) == ["10.1/one", "10.1/two"]
+        assert results["10.1/one"]["data"] == {
+            "publisher": "Test Press", "prefix": "Test Prefix",
+            "journal_full_title": "Journal One", "issn": "1234-5678",
+            "issn_print": "1234-5678", "issn_electronic": None,
+            "license_ref": "http://creativecommons.org/licenses/by/4.0"}
+        assert not results["10.1/two"]["success"]
+        assert len(server.requests) == 2
+
+    def test_batch_size(self, server):
+        dois = ["10.1/{}".format(i) for i in range(25)]
+        oat.get_metadata_from_crossref_batch(dois, batch_size=10)
+        assert len(server.requests) == 3
+
+    def test_batch_cache(self, server, monkeypatch, tmpdir):
+        monkeypatch.setattr(oat, "metadata_cache", oat.MetadataCache(str(tmpdir)))
+        oat.get_metadata_from_crossref_batch(["10.1/one"])
+        oat.get_metadata_from_crossref_batch(["10.1/one"])
+        assert [path for path, _ in server.requests].count("/prefixes/10.1") == 1
+        assert len(server.requests) == 2
+        # Single lookups use the unixsd format and do not share the entries
+        assert oat.metadata_cache.get("crossref_rest", "10.1/one")["success"]
+        assert oat.metadata_cache.get("crossref", "10.1/one") is None
+
+    def test_prefetch(self, server):
+        rows = [(i, ["inst", "10.1/one" if i % 2 else "10.1/two"]) for i in range(7)]
+        results = {}
+        prefetched = oat.prefetch_doi_metadata(iter(rows), 1, 3, results)
+        assert list(prefetched) == rows
+        assert sorted(results.keys()) == ["10.1/one", "10.1/two"]
+        assert [path for path, _ in server.requests].count("/prefixes/10.1") == 1
+
+EUROPE_PMC_HITS = [
+    {"doi": "10.1/one", "pmid": "1", "pmcid": "PMC1"},
+    {"doi": "10.1/TWO", "pmid": "2"},
+    {"doi": "10.1/one", "pmid": "3"}
+]
+
+def europe_pmc_route(handler):
+    """
+    A stand-in for the Europe PMC search, serving one hit per page.
+    """
+    query = urlparse.parse_qs(urlparse.urlsplit(handler.path).query)
+    dois = [term.split('"')[1].lower() for term in query["query"][0].split(" OR ")]
+    hits = [hit for hit in EUROPE_PMC_HITS if hit["doi"].lower() in dois]
+    cursor = query["cursorMark"][0]
+    page = 0 if cursor == "*" else int(cursor)
+    result = {"resultList": {"result": hits[page:page + 1]},
+              "nextCursorMark": str(page + 1)}
+    return (200, {}, json.dumps(result))
+
+def test_pubmed_batch(server, monkeypatch):
+    server.routes["/search"] = europe_pmc_route
+    monkeypatch.setattr(oat, "EUROPE_PMC_SEARCH_URL", server.url + "/search")
+    results = oat.get_metadata_from_pubmed_batch(["10.1/one", "10.1/two", "10.1/three"])
+    assert results == {
+        "10.1/one": {"success": True, "data": {"pmid": "1", "pmcid": "PMC1"}},
+        "10.1/two": {"success": True, "data": {"pmid": "2", "pmcid": None}},
+        "10.1/three": {"success": True, "data": {"pmid": None, "pmcid": None}}
+    }
+    assert len(server.requests) == 4
+
+class TestRequestScheduler(object):
+
+    def test_token_bucket(self):
+        bucket = oat.TokenBucket(rate=50, capacity=1)
+        start = time.time()
+        for _ in range(6):
+            bucket.acquire()
+        assert time.time() - start >= 0.09
+
+    def test_retry_after(self, server):
+        responses = [(429, {"Retry-After": "0"}, "slow down"), (200, {}, "ok")]
+        server.routes["/limited"] = lambda handler: responses.pop(0)
+        scheduler = oat.RequestScheduler(backoff_base=0)
+        client = oat.HTTPClient(timeout=5, scheduler=scheduler)
+        assert client.request(server.url + "/limited").read() == "ok"
+        host = server.url.split("//")[1]
+        assert scheduler._bucket(host).rate < scheduler.default_rate
+
+    def test_no_retry_on_404(self, server):
+        client = oat.HTTPClient(timeout=5, scheduler=oat.RequestScheduler(backoff_base=0))
+        with pytest.raises(urllib2.HTTPError):
+            client.request(server.url + "/missing")
+        assert len(server.requests) == 1
+
+    def test_retry_limits(self, server):
+        server.routes["/down"] = (503, {}, "unavailable")
+        scheduler = oat.RequestScheduler(max_retries=3, retry_budget=5, backoff_base=0)
+        client = oat.HTTPClient(timeout=5, scheduler=scheduler)
+        for _ in range(2):
+            with pytest.raises(urllib2.HTTPError):
+                client.request(server.url + "/down")
+        # 4 tries for the first request, budget left for 2 retries on the second
+        assert len(server.requests) == 7
+
+class TestCheckpointJournal(object):
+
+    def test_resume(self, tmpdir):
+        csv_file = tmpdir.join("in.csv")
+        csv_file.write("a,b\n")
+        path = str(tmpdir.join("out.csv.journal"))
+        journal = oat.CheckpointJournal(path, str(csv_file), ["x", "y"])
+        journal.open()
+        journal.append(2, [u"1", u"2"])
+        journal.append(3, [u"3", u"4"])
+        journal.close()
+        with open(path, "a") as handle:
+            handle.write('[4, ["5"')
+        journal = oat.CheckpointJournal(path, str(csv_file), ["x", "y"])
+        assert journal.load() == {2: [u"1", u"2"], 3: [u"3", u"4"]}
+        journal.open(resume=True)
+        journal.append(4, [u"5", u"6"])
+        journal.close()
+        assert len(journal.load()) == 3
+
+    def test_changed_input(self, tmpdir):
+        csv_file = tmpdir.join("in.csv")
+        csv_file.write("a,b\n")
+        path = str(tmpdir.join("out.csv.journal"))
+        journal = oat.CheckpointJournal(path, str(csv_file), ["x", "y"])
+        journal.open()
+        journal.close()
+        csv_file.write("a,b,c\n")
+        with pytest.raises(ValueError):
+            oat.CheckpointJournal(path, str(csv_file), ["x", "y"]).load()
+
+def test_writer_accepts_generators():
+    rows = [[u"doi", u"euro"], [u"10.1/abc", u"NA"], [u"10.1/def", u"100"]]
+    out = StringIO()
+    writer = oat.OpenAPCUnicodeWriter(out, [True, False], True, True)
+    writer.write_rows(row for row in rows)
+    assert out.getvalue() == '"doi","euro"\n"10.1/abc",NA\n"10.1/def",100\n'
+    assert rows[0] == [u"doi", u"euro"]
+
+def test_conflict_log(tmpdir):
+    path = str(tmpdir.join("out.csv.conflicts"))
+    log = oat.ConflictLog(path)
+    log.open()
+    log.record(7, "publisher", u"Old Press", u"New Press")
+    log.record(5, "doaj", u"FALSE", u"TRUE")
+    log.commit(5, 2)
+    log.commit(7, 3)
+    log.close()
+    log.open(resume=True)
+    log.record(7, "publisher", u"Old Press", u"New Press")
+    log.commit(7, 3)
+    log.close()
+    conflicts = oat.ConflictLog.load(path)
+    assert [(c["line"], c["column"]) for c in conflicts] == [(2, "doaj"), (3, "publisher")]
+    assert conflicts[1]["new"] == u"New Press"
+
+class TestAnalyzeCSVFile(object):
+
+    def test_bounded_sample(self, tmpdir):
+        csv_file = tmpdir.join("apc.csv")
+        rows = ['"institution","period","euro","doi"\n', "\n"]
+        rows += ['"Uni",2016,1200.5,"10.1/{}"\n'.format(i) for i in range(5000)]
+        csv_file.write("".join(rows))
+        result = oat.analyze_csv_file(str(csv_file), sample_size=1024)
+        analysis = result["data"]
+        assert result["success"]
+        assert analysis.dialect.delimiter == ","
+        assert analysis.has_header
+        assert analysis.blanks == 1
+        assert 1024 <= len(analysis.sample) < 1100
+        assert analysis.sample.endswith("\n")
+
+    def test_long_line(self, tmpdir):
+        long_line = '"Uni","' + "x" * 70000 + '"\n'
+        csv_file = tmpdir.join("long.csv")
+        csv_file.write('"institution","journal"\n' + long_line + '"Uni","Journal"\n')
+        result = oat.analyze_csv_file(str(csv_file), sample_size=1024)
+        assert result["success"]
+        assert result["data"].sample == '"institution","journal"\n' + long_line
+
+    def test_encoding(self, tmpdir):
+        content = u'"institution","journal"\n"Uni","Annales Henri Poincaré"\n'
+        utf8_file = tmpdir.join("utf8.csv")
+        utf8_file.write(content.encode("utf-8"), mode="wb")
+        assert oat.analyze_csv_file(str(utf8_file))["data"].enc == "utf-8"
+        bom_file = tmpdir.join("bom.csv")
+        bom_file.write(codecs.BOM_UTF8 + content.encode("utf-8"), mode="wb")
+        assert oat.analyze_csv_file(str(bom_file))["data"].enc == "utf-8-sig"
+
+    def test_non_ascii_after_sample(self, tmpdir):
+        rows = ['"institution","journal"\n'] + ['"Uni","Journal {}"\n'.format(i) for i in range(10000)]
+        ascii_file = tmpdir.join("ascii.csv")
+        ascii_file.write("".join(rows))
+        assert oat.analyze_csv_file(str(ascii_file), sample_size=1024)["data"].enc == "utf-8"
+        utf8_file = tmpdir.join("utf8.csv")
+        utf8_file.write("".join(rows) + '"Uni","Caf\xc3\xa9"\n', mode="wb")
+        assert oat.analyze_csv_file(str(utf8_file), sample_size=1024)["data"].enc == "utf-8"
+        latin1_file = tmpdir.join("latin1.csv")
+        latin1_file.write("".join(rows) + '"Uni","Caf\xe9 Fran\xe7ais"\n', mode="wb")
+        for line_limit in [None, 500]:
+            enc = oat.analyze_csv_file(str(latin1_file), line_limit, sample_size=1024)["data"].enc
+            # Without chardet, the encoding is unknown - but it must not be UTF-8
+            assert enc != "utf-8"
+            if oat.chardet is not None:
+                assert codecs.lookup(enc).name in ["iso8859-1", "cp1252"]
+
+class TestUnicodeReaders(object):
+
+    CONTENT = u'"journal","publisher"\n"Annales Henri Poincaré","Springer"\n\n"","Ümlaut, Inc."\n'
+
+    @pytest.mark.parametrize("encoding", ["utf-8", "latin-1"])
+    def test_reader(self, encoding):
+        handle = StringIO(self.CONTENT.encode(encoding))
+        rows = list(oat.UnicodeReader(handle, encoding=encoding))
+        assert rows == [[u"journal", u"publisher"],
+                        [u"Annales Henri Poincaré", u"Springer"],
+                        [],
+                        [u"", u"Ümlaut, Inc."]]
+
+    @pytest.mark.parametrize("encoding", ["utf-8", "latin-1"])
+    def test_dict_reader(self, encoding):
+        handle = StringIO(self.CONTENT.encode(encoding))
+        rows = list(oat.UnicodeDictReader(handle, encoding=encoding))
+        assert rows == [{"journal": u"Annales Henri Poincaré", "publisher": u"Springer"},
+                        {"journal": u"", "publisher": u"Ümlaut, Inc."}]
+
+    def test_dict_reader_row_length(self):
+        rows = list(oat.UnicodeDictReader(StringIO("a,b\n1\n1,2,3\n")))
+        assert rows == [{"a": u"1", "b": None}, {"a": u"1", "b": u"2", None: [u"3"]}]
+
+    def test_invalid_utf8(self):
+        with pytest.raises(UnicodeDecodeError):
+            list(oat.UnicodeReader(StringIO("caf\xe9\n")))
+
+@pytest.mark.parametrize("quotemask, openapc_quote_rules, expected", [
+    (None, True, '"a","b","c"\n"x",NA,"1"\n"y",TRUE,"2","3"\n'),
+    ([False, True], True, '"a","b","c"\nx,NA,1\ny,TRUE,2,3\n'),
+    ([True, True, False], False, '"a","b","c"\n"x","NA",1\n"y","TRUE",2,3\n')
+])
+def test_writer_quotation(quotemask, openapc_quote_rules, expected):
+    rows = [[u"a", u"b", u"c"], [u"x", u"NA", u"1"], [u"y", u"TRUE", u"2", u"3"]]
+    out = StringIO()
+    writer = oat.OpenAPCUnicodeWriter(out, quotemask, openapc_quote_rules, True, 2)
+    writer.write_rows(rows)
+    assert out.getvalue() == expected
+
+class TestOpenAPCTable(object):
+
+    HEADER = [u"institution", u"period", u"euro", u"doi"]
+    ROWS = [[u"Uni A", u"2016", u"1200", u"10.1/a"],
+            [u"Uni A", u"2017", u"1234.50", u"10.1/b"],
+            [u"Uni B", u"NA", u"99.9", u"10.1/c"],
+            [u"Uni B", u"2015", u"10", u"10.1/d", u"surplus"]]
+
+    def test_round_trip(self):
+        table = oat.OpenAPCTable.from_rows(self.HEADER, self.ROWS)
+        assert len(table) == 4
+        assert list(table) == self.ROWS
+        assert table.column("euro") == [u"1200", u"1234.50", u"99.9", u"10"]
+        assert table.numeric_column("period").tolist() == [2016, 2017, 0, 2015]
+        assert table.column("institution")[0] is table.column("institution")[1]
+
+    def test_rows_and_indexes(self):
+        table = oat.OpenAPCTable.from_rows(self.HEADER, self.ROWS)
+        assert table.index("institution") == {u"Uni A": [0, 1], u"Uni B": [2, 3]}
+        row = table.row_dict(1)
+        assert row["doi"] == u"10.1/b"
+        assert dict(row.iteritems()) == dict(zip(self.HEADER, self.ROWS[1]))
+        assert [len(table.row_dict(index)) for index in range(4)] == [4, 4, 4, 5]
+
+    def test_load(self, tmpdir):
+        csv_file = tmpdir.join("apc.csv")
+        csv_file.write('"institution","period","euro","doi"\n\n"Uni A",2016,1200,"10.1/a"\n')
+        table = oat.OpenAPCTable.load(str(csv_file), cache_dir=None)
+        assert table.header == self.HEADER
+        assert list(table) == [self.ROWS[0]]
+
+    def test_snapshot(self, tmpdir):
+        csv_file = tmpdir.join("apc.csv")
+        csv_file.write('"institution","period","euro","doi"\n"Uni A",2016,1200,"10.1/a"\n')
+        cache_dir = str(tmpdir.join("cache"))
+        snapshot = py.path.local(oat._sidecar_path(str(csv_file), cache_dir, "snapshot"))
+        table = oat.OpenAPCTable.load(str(csv_file), cache_dir=cache_dir)
+        assert snapshot.check()
+        assert sorted(path.basename for path in tmpdir.listdir()) == ["apc.csv", "cache"]
+        # Served from the snapshot, which survives a touch of the CSV file
+        csv_file.setmtime(csv_file.mtime() + 10)
+        assert list(oat.OpenAPCTable.load(str(csv_file), cache_dir=cache_dir)) == list(table)
+        # A changed file invalidates the snapshot
+        csv_file.write('"institution","period","euro","doi"\n"Uni B",2017,1300,"10.1/b"\n')
+        csv_file.setmtime(csv_file.mtime() + 20)
+        table = oat.OpenAPCTable.load(str(csv_file), cache_dir=cache_dir)
+        assert list(table) == [[u"Uni B", u"2017", u"1300", u"10.1/b"]]
+        assert table.numeric_column("euro").tolist() == [1300.0]
+        # A damaged snapshot falls back to the CSV file
+        snapshot.write("garbage")
+        csv_file.setmtime(csv_file.mtime() + 30)
+        assert list(oat.OpenAPCTable.load(str(csv_file), cache_dir=cache_dir)) == list(table)
+
+    def test_unwritable_cache_dir(self, tmpdir):
+        csv_file = tmpdir.join("apc.csv")
+        csv_file.write('"institution","period","euro","doi"\n"Uni A",2016,1200,"10.1/a"\n')
+        # A file in the way, so the cache directory cannot be created
+        tmpdir.join("cache").write("")
+        table = oat.OpenAPCTable.load(str(csv_file), cache_dir=str(tmpdir.join("cache", "openapc")))
+        assert list(table) == [self.ROWS[0]]
+        assert sorted(path.basename for path in tmpdir.listdir()) == ["apc.csv", "cache"]
+
+@pytest.mark.parametrize("issn", ["0001-5547", "0317-8471", "1234-567X", "0000-0000"])
+def test_issn_int_round_trip(issn):
+    assert oat.int_to_issn(oat.issn_to_int(issn)) == issn
+    assert oat.issn_to_int(issn.replace("-", "").lower()) == oat.issn_to_int(issn)
+
+def test_issn_int_order():
+    issns = ["0001-5547", "0001-554X", "0001-5550", "1234-5670", "9999-999X"]
+    assert [oat.issn_to_int(issn) for issn in issns] == sorted(oat.issn_to_int(issn) for issn in issns)
+    assert oat.issn_to_int("NA") is None
+    assert oat.issn_to_int("9999-999X") < 2 ** 32
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_check_issn_columns(use_numpy, monkeypatch):
+    if use_numpy and oat.numpy is None:
+        pytest.skip("NumPy is not installed")
+    if not use_numpy:
+        monkeypatch.setattr(oat, "numpy", None)
+    values = ["0001-5547", "0001-5548", "1234-567X", "1234567x", "0000-0000", "NA", "", "0317-8471 "]
+    masks = oat.check_ISSN_columns([values, values[::-1], []])
+    wellformed = [oat.is_wellformed_ISSN(value) for value in values]
+    valid = [is_wellformed and oat.is_valid_ISSN(value) for value, is_wellformed in zip(values, wellformed)]
+    assert masks == [(wellformed, valid), (wellformed[::-1], valid[::-1]), ([], [])]
+
+def test_issn_l_index(tmpdir):
+    mapping_file = tmpdir.join("ISSN-to-ISSN-L.txt")
+    mapping_file.write("ISSN\tISSN-L\n0317-8471\t0317-8471\n0001-5547\t0317-8471\n" +
+                       "1234-567X\t1234-567X\nbroken line\n")
+    index_file = str(tmpdir.join("issn_l.idx"))
+    counts = oat.ISSNLIndex.build(str(mapping_file), index_file)
+    assert counts == {"itself": 2, "other": 1}
+    assert oat.ISSNLIndex.is_index_file(index_file)
+    assert not oat.ISSNLIndex.is_index_file(str(mapping_file))
+    index = oat.ISSNLIndex(index_file)
+    assert len(index) == 3
+    assert index.get("0001-5547") == "0317-8471"
+    assert index.get("00015547") == "0317-8471"
+    assert index.get("1234-567x") == "1234-567X"
+    assert index.get("0317-8471") == "0317-8471"
+    assert index.get("0001-5548") is None
+    assert index.get("NA") is None
+    index.close()
+    with pytest.raises(ValueError):
+        oat.ISSNLIndex(str(mapping_file))
+
+def test_doaj_offline_analysis(tmpdir):
+    doaj_file = tmpdir.join("doaj.csv")
+    doaj_file.write("Journal title,Journal ISSN (print version),Journal EISSN (online version)\n" +
+                    "Journal A,0001-5547,1234-567X\nJournal B,,0317-8471\nJournal C,1234-567X,\n")
+    cache_dir = str(tmpdir.join("cache"))
+    doaj = oat.DOAJOfflineAnalysis(str(doaj_file), cache_dir)
+    assert py.path.local(oat._sidecar_path(str(doaj_file), cache_dir, "index")).check()
+    assert doaj.lookup("0001-5547") == u"Journal A"
+    assert doaj.lookup("03178471") == u"Journal B"
+    # Print ISSNs take precedence over electronic ones
+    assert doaj.lookup("1234-567x") == u"Journal C"
+    assert doaj.lookup("0000-0000") is None
+    assert doaj.lookup("NA") is None
+    assert oat.DOAJOfflineAnalysis(str(doaj_file), cache_dir).doaj_map == doaj.doaj_map
+    # The index is rebuilt after the dump changes
+    doaj_file.write("Journal title,Journal ISSN (print version),Journal EISSN (online version)\n" +
+                    "Journal D,0001-5547,\n")
+    doaj_file.setmtime(doaj_file.mtime() + 10)
+    doaj = oat.DOAJOfflineAnalysis(str(doaj_file))
+    assert doaj.lookup("0001-5547") == u"Journal D"
+    assert doaj.lookup("03178471") is None
@@ -0,0 +1,65 @@
+import csv
+
+import pytest
+
+import resolve_conflicts
+
+CONFLICTS = [
+    {"line": 2, "row_num": 2, "column": "issn", "old": u"1234-5678", "new": u"2345-6789"},
+    {"line": 3, "row_num": 4, "column": "publisher", "old": u"Springer", "new": u"Elsevier"},
+    {"line": 4, "row_num": 5, "column": "issn", "old": u"1234-5678", "new": u"2345-6789"},
+    {"line": 4, "row_num": 5, "column": "publisher", "old": u"Springer", "new": u"Wiley"}
+]
+
+def test_group_conflicts():
+    groups = resolve_conflicts.group_conflicts(CONFLICTS)
+    assert groups.items() == [(("issn", u"1234-5678", u"2345-6789"), [2, 4]),
+                              (("publisher", u"Springer", u"Elsevier"), [3]),
+                              (("publisher", u"Springer", u"Wiley"), [4])]
+
+def test_decide_always_overwrite():
+    groups = resolve_conflicts.group_conflicts(CONFLICTS)
+    accepted = resolve_conflicts.decide(groups, always_overwrite=True)
+    assert accepted == {2: [("issn", u"1234-5678", u"2345-6789")],
+                        3: [("publisher", u"Springer", u"Elsevier")],
+                        4: [("issn", u"1234-5678", u"2345-6789"),
+                            ("publisher", u"Springer", u"Wiley")]}
+
+def test_decide(monkeypatch):
+    # Keep the ISSNs line by line, always overwrite publisher names
+    answers = iter(["5", "y", "n", "2"])
+    monkeypatch.setattr(resolve_conflicts, "ask", lambda msg, choices: next(answers))
+    accepted = resolve_conflicts.decide(resolve_conflicts.group_conflicts(CONFLICTS))
+    assert accepted == {2: [("issn", u"1234-5678", u"2345-6789")],
+                        3: [("publisher", u"Springer", u"Elsevier")],
+                        4: [("publisher", u"Springer", u"Wiley")]}
+
+@pytest.fixture
+def csv_file(tmpdir):
+    content = ('"institution",doi,"issn","publisher"\n' +
+               '"Uni",10.1/a,"1234-5678","Springer"\n' +
+               '"Uni\nwith a line break",10.1/b,"1234-5678","Springer"\n' +
+               '"Uni",10.1/c,"1234-5678","Springer"\n')
+    path = tmpdir.join("out.csv")
+    path.write(content)
+    return str(path)
+
+def test_patch_csv_file(csv_file):
+    accepted = {3: [("publisher", u"Springer", u"Elsevier")],
+                4: [("issn", u"1234-5678", u"2345-6789"),
+                    ("publisher", u"Springer", u"Wiley")]}
+    assert resolve_conflicts.patch_csv_file(csv_file, accepted) == (2, [4])
+    with open(csv_file) as patched:
+        content = patched.read()
+    # Records without replacements are copied unchanged
+    assert content.startswith('"institution",doi,"issn","publisher"\n' +
+                              '"Uni",10.1/a,"1234-5678","Springer"\n')
+    rows = list(csv.reader(content.splitlines(True)))
+    assert rows[2] == ["Uni\nwith a line break", "10.1/b", "1234-5678", "Elsevier"]
+    assert rows[3] == ["Uni", "10.1/c", "2345-6789", "Wiley"]
+
+def test_patch_csv_file_outdated(csv_file):
+    accepted = {2: [("issn", u"0000-0000", u"2345-6789")]}
+    assert resolve_conflicts.patch_csv_file(csv_file, accepted) == (1, [])
+    with open(csv_file) as patched:
+        assert list(csv.reader(patched))[1] == ["Uni", "10.1/a", "1234-5678", "Springer"]